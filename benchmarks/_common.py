@@ -0,0 +1,83 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from functions.sumo_pipelines_adapter.cf_config import CFModelParameters
+
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_ROOT = PROJECT_ROOT / "config" / "sumo-pipelines"
+
+
+def load_pair_config(
+    model_file: str = "idm_calibration.yaml",
+    row: int = 0,
+    **sim_overrides,
+) -> DictConfig:
+    """
+    Build the same config `sumo-pipe` would hand to a consumer, for the
+    leader-follower pair in row `row` of `leaders.parquet`.
+    """
+    os.environ.setdefault("PROJECT_ROOT", str(PROJECT_ROOT))
+    os.environ.setdefault("DATA_PATH", str(PROJECT_ROOT / "data"))
+    if not OmegaConf.has_resolver("datetime.now"):
+        OmegaConf.register_new_resolver(
+            "datetime.now", lambda fmt: datetime.now().strftime(fmt)
+        )
+
+    conf = OmegaConf.merge(
+        OmegaConf.load(CONFIG_ROOT / "sumo_pipelines.yaml"),
+        OmegaConf.load(CONFIG_ROOT / model_file),
+    )
+
+    pair = pl.read_parquet(conf.Blocks.TrajectoryGenerator.pair_file).row(
+        row, named=True
+    )
+    conf.Blocks.TrajectoryGenerator.leader_id = pair["vehicle_id_leader"]
+    conf.Blocks.TrajectoryGenerator.follower_id = [
+        pair["vehicle_id"],
+        pair["lane"],
+        pair["lane_index"],
+        pair["other_leader"],
+    ]
+    conf.Metadata.run_id = f"bench_{row}"
+    conf.Metadata.output = tempfile.mkdtemp(prefix="cf_bench_")
+    conf.Blocks.SimulationConfig.gui = False
+    # measure the simulation, not hits of earlier runs
+    if "EvaluationCache" in conf.Blocks:
+        conf.Blocks.EvaluationCache.enabled = False
+    # and every candidate over the whole trajectory: an aborted candidate
+    # simulates fewer steps and would inflate the steps/s
+    conf.Blocks.Error.early_abort = False
+    for k, v in sim_overrides.items():
+        conf.Blocks.SimulationConfig[k] = v
+
+    Path(conf.Metadata.cwd).mkdir(parents=True, exist_ok=True)
+    return conf
+
+
+def sample_candidates(conf: DictConfig, n: int, seed: int = 42) -> List[Dict]:
+    """Draw `n` parameter vectors from the search space of the config"""
+    return CFModelParameters.sample(conf.Blocks.CFModelParameters, n, seed)
+
+
+@contextmanager
+def timer(results: list):
+    t0 = time.perf_counter()
+    yield
+    results.append(time.perf_counter() - t0)
+
+
+def summarize(name: str, times: List[float]) -> str:
+    s = pl.Series(times)
+    return (
+        f"{name:<28} n={len(times):<5} total={s.sum():8.3f}s "
+        f"mean={s.mean() * 1e3:9.3f}ms median={s.median() * 1e3:9.3f}ms"
+    )
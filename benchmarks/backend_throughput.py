@@ -0,0 +1,52 @@
+"""
+Step-loop throughput of the socket TraCI backend vs. in-process libsumo.
+
+Both run with a persistent session, so the numbers are dominated by the
+per-step calls in `BasicRunner.run`.
+
+    python -m benchmarks.backend_throughput --model idm_calibration.yaml -n 50
+"""
+import argparse
+
+from benchmarks._common import load_pair_config, sample_candidates, summarize, timer
+from functions.sumo import BasicRunner
+from functions.sumo_backends import LIBSUMO
+
+
+def run(model: str, n: int, row: int, backend: str) -> tuple:
+    conf = load_pair_config(
+        model, row=row, backend=backend, persistent_session=True
+    )
+    candidates = sample_candidates(conf, n)
+
+    runner = BasicRunner()
+    runner.setup(conf)
+    used = runner._backend.name
+
+    times = []
+    for candidate in candidates:
+        with timer(times):
+            runner(**candidate)
+    steps = int(
+        runner._trajectories.max_time / conf.Blocks.SimulationConfig.step_length
+    )
+    runner.cleanup()
+    return used, steps, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="idm_calibration.yaml")
+    parser.add_argument("-n", type=int, default=50)
+    parser.add_argument("--row", type=int, default=0)
+    args = parser.parse_args()
+
+    backends = ["traci"] + (["libsumo"] if LIBSUMO else [])
+    for backend in backends:
+        used, steps, times = run(args.model, args.n, args.row, backend)
+        print(summarize(used, times))
+        print(f"{'':<28} {steps * len(times) / sum(times):,.0f} steps/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Fidelity of the NumPy emulator (`functions/cf_emulator.py`) against SUMO.
+
+The same candidates, drawn from the IDM, Krauss and W99 search spaces, are
+simulated by SUMO and by the emulator (see `functions/emulator_fidelity.py`).
+For each model it reports the gap between the follower trajectories, how
+close the losses are, whether they rank the candidates the same way
+(Spearman), whether they agree on collisions, and whether all of it is within
+the model's `THRESHOLDS`. The exit status is non-zero when a model fails.
+`tests/test_cf_emulator.py` asserts the same on the first pair.
+
+    python -m benchmarks.emulator_fidelity -n 20
+"""
+import argparse
+
+from benchmarks._common import load_pair_config, summarize
+from functions.emulator_fidelity import check, compare
+
+
+MODELS = ("idm_calibration.yaml", "krauss_calibration.yaml", "w99_calibration.yaml")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=20)
+    parser.add_argument("--row", type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    for model_file in MODELS:
+        res = compare(load_pair_config(model_file, row=args.row), args.n)
+        failures = check(res)
+        failed |= bool(failures)
+        print(
+            f"{res['model']:<8} median follower rmse s={res['s_rmse']:.3f}m "
+            f"v={res['v_rmse']:.3f}m/s  median loss rel. err={res['loss_rel_err']:.3f}  "
+            f"spearman={res['spearman']:.3f}  "
+            f"collisions agree={res['collision_agreement']:.0%}"
+        )
+        print("    " + summarize("sumo (per candidate)", res["sumo_times"]))
+        print("    " + summarize("emulator (whole population)", res["emulator_times"]))
+        print(f"    {'FAIL: ' + ', '.join(failures) if failures else 'ok'}")
+
+    raise SystemExit(int(failed))
+
+
+if __name__ == "__main__":
+    main()
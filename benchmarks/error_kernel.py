@@ -0,0 +1,54 @@
+"""
+Per-call latency of the pandas `fast_error` path vs. the NumPy `ErrorKernel`,
+for every metric, on one simulated trajectory of a pair. The pandas path is
+timed the way the runner used it, `to_df` of the simulation included.
+
+    python -m benchmarks.error_kernel -n 1000
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks._common import load_pair_config, sample_candidates, summarize, timer
+from functions.error_metrics import KERNELS, ErrorKernel, fast_error
+from functions.sumo import BasicRunner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="idm_calibration.yaml")
+    parser.add_argument("-n", type=int, default=1000)
+    parser.add_argument("--row", type=int, default=0)
+    args = parser.parse_args()
+
+    conf = load_pair_config(args.model, row=args.row)
+    runner = BasicRunner()
+    runner.setup(conf)
+    runner.keep_trajectory = True
+    runner(**sample_candidates(conf, 1)[0])
+    sim_data = runner._sim_data
+    reference = runner._reference
+    runner.cleanup()
+
+    error_conf = conf.Blocks.Error
+    for error_func in KERNELS:
+        error_conf.error_func = error_func
+        kernel = ErrorKernel(reference, error_conf)
+
+        pandas_times, kernel_times = [], []
+        for _ in range(args.n):
+            with timer(pandas_times):
+                expected = fast_error(reference.df, sim_data.to_df(), error_conf)
+            with timer(kernel_times):
+                got = kernel(sim_data)
+
+        print(f"{error_func}: |pandas - kernel| = {abs(expected - got):.3e}")
+        print("    " + summarize("pandas", pandas_times))
+        print("    " + summarize("numpy kernel", kernel_times))
+        print(
+            f"    speedup x{np.median(pandas_times) / np.median(kernel_times):.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
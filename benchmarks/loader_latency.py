@@ -0,0 +1,56 @@
+"""
+Trajectory loader latency with a full parquet scan per pair vs. slicing the
+indexed store (`functions/trajectory_loaders/trajectory_store.py`), as the
+number of pairs loaded by one worker grows.
+
+    python -m benchmarks.loader_latency --pairs 1 10 100 1000
+"""
+import argparse
+import tempfile
+
+import polars as pl
+
+from benchmarks._common import load_pair_config, summarize, timer
+from functions.trajectory_loaders.read_trajectories import database_loader
+from functions.trajectory_loaders.trajectory_store import build_store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pairs", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    conf = load_pair_config()
+    kwargs = conf.Blocks.TrajectoryProcessing.kwargs
+    pairs = pl.read_parquet(conf.Blocks.TrajectoryGenerator.pair_file)
+
+    store_dir = tempfile.mkdtemp(prefix="cf_store_")
+    build_times = []
+    with timer(build_times):
+        build_store(kwargs.traj_file, store_dir)
+    print(f"one-time index build: {build_times[0]:.3f}s")
+
+    for n in args.pairs:
+        rows = list(pairs.head(n).iter_rows(named=True))
+        for use_index in (False, True):
+            times = []
+            for pair in rows:
+                with timer(times):
+                    database_loader(
+                        traj_file=kwargs.traj_file,
+                        follower_id=[
+                            pair["vehicle_id"],
+                            pair["lane"],
+                            pair["lane_index"],
+                            pair["other_leader"],
+                        ],
+                        leader_id=pair["vehicle_id_leader"],
+                        step_length=kwargs.step_length,
+                        use_index=use_index,
+                        store_dir=store_dir,
+                    )
+            print(summarize(f"{len(rows)} pairs, {'index' if use_index else 'scan'}", times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Per-candidate wall time of restarting SUMO for every candidate vs. keeping one
+persistent session per pair (`SimulationConfig.persistent_session`).
+
+    python -m benchmarks.session_reuse --model idm_calibration.yaml -n 50
+"""
+import argparse
+
+from benchmarks._common import load_pair_config, sample_candidates, summarize, timer
+from functions.sumo import BasicRunner
+
+
+def run(model: str, n: int, row: int, persistent: bool) -> list:
+    conf = load_pair_config(model, row=row, persistent_session=persistent)
+    candidates = sample_candidates(conf, n)
+
+    runner = BasicRunner()
+    runner.setup(conf)
+
+    times = []
+    for candidate in candidates:
+        with timer(times):
+            runner(**candidate)
+    runner.cleanup()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="idm_calibration.yaml")
+    parser.add_argument("-n", type=int, default=50)
+    parser.add_argument("--row", type=int, default=0)
+    args = parser.parse_args()
+
+    restart = run(args.model, args.n, args.row, persistent=False)
+    persistent = run(args.model, args.n, args.row, persistent=True)
+
+    print(summarize("restart per candidate", restart))
+    print(summarize("persistent session", persistent))
+    print(f"speedup: {sum(restart) / sum(persistent):.2f}x")
+
+
+if __name__ == "__main__":
+    main()
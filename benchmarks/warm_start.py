@@ -0,0 +1,85 @@
+"""
+Budget used by cold vs. warm-started calibrations of the same pairs.
+
+Every pair is first calibrated cold. Each pair is then calibrated again,
+warm-started from the cold results of the *other* pairs only (the k nearest
+by trajectory features), plus `--results` if given. Early stopping ends both
+runs, so the saving shows up as fewer evaluations.
+
+    python -m benchmarks.warm_start --model idm_calibration.yaml --rows 0 1 2 3 4 --budget 300
+"""
+import argparse
+import tempfile
+from pathlib import Path
+
+import polars as pl
+
+from benchmarks._common import load_pair_config
+from functions.sumo_pipelines_adapter.optimizer import optimize
+from functions.sumo_pipelines_adapter.results import read_results
+
+
+def _run(model: str, row: int, budget: int, output: str, **opt_overrides) -> dict:
+    conf = load_pair_config(model, row=row)
+    conf.Metadata.output = output
+    Path(conf.Metadata.cwd).mkdir(parents=True, exist_ok=True)
+    conf.Blocks.CFOptimizeConfig.budget = budget
+    for k, v in opt_overrides.items():
+        conf.Blocks.CFOptimizeConfig[k] = v
+    optimize(conf.Blocks.CFOptimizeConfig, conf)
+    # `optimize` only returns a receipt, the row is in the output directory
+    rows = read_results(output).to_dicts()
+    return rows[0] if rows else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="idm_calibration.yaml")
+    parser.add_argument("--rows", type=int, nargs="+", default=[0, 1, 2, 3, 4])
+    parser.add_argument("--budget", type=int, default=300)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--results", nargs="*", default=[])
+    args = parser.parse_args()
+
+    cold = [
+        _run(args.model, row, args.budget, tempfile.mkdtemp(prefix="cf_cold_"))
+        for row in args.rows
+    ]
+    cold_df = pl.DataFrame([r for r in cold if r])
+
+    warm = []
+    for row, cold_result in zip(args.rows, cold):
+        others = Path(tempfile.mkdtemp(prefix="cf_warm_")) / "others.parquet"
+        cold_df.filter(pl.col("run_id") != cold_result.get("run_id")).write_parquet(
+            others
+        )
+        warm.append(
+            _run(
+                args.model,
+                row,
+                args.budget,
+                str(others.parent),
+                warm_start=True,
+                warm_start_k=args.k,
+                warm_start_results=[str(others), *args.results],
+            )
+        )
+
+    print(f"{'row':>4} {'cold evals':>10} {'warm evals':>10} {'cold loss':>10} {'warm loss':>10}")
+    for row, c, w in zip(args.rows, cold, warm):
+        if not c or not w:
+            print(f"{row:>4} failed")
+            continue
+        print(
+            f"{row:>4} {c['evaluations']:>10} {w['evaluations']:>10} "
+            f"{c['val']:>10.4f} {w['val']:>10.4f}"
+        )
+    done = [(c, w) for c, w in zip(cold, warm) if c and w]
+    if done:
+        saved = sum(c["evaluations"] - w["evaluations"] for c, w in done)
+        total = sum(c["evaluations"] for c, _ in done)
+        print(f"warm start saved {saved} of {total} evaluations ({saved / total:.0%})")
+
+
+if __name__ == "__main__":
+    main()
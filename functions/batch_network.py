@@ -0,0 +1,110 @@
+import os
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+import sumolib
+
+
+# lateral distance between the lane copies (m)
+COPY_SPACING = 10
+
+
+@dataclass
+class LaneCopy:
+    lane: str
+    route: str
+    # appended to the vehicle and vType ids simulated on the copy
+    suffix: str = ""
+
+
+def _copy_id(base: str, k: int) -> str:
+    return f"{base}__{k}"
+
+
+def build_batch_network(
+    net_file: str,
+    lane_id: str,
+    copies: int,
+    output_dir: Path,
+) -> Tuple[Path, Path, List[LaneCopy]]:
+    """
+    Build a network holding `copies` disconnected copies of the edge of
+    `lane_id`, each with a single lane and a route of its own, so that many
+    leader-follower pairs can be simulated side by side without interacting.
+
+    The network is built once per (network, copies) in `output_dir` and
+    shared by every runner writing there.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"{Path(net_file).name.split('.')[0]}_{lane_id}_x{copies}"
+    out_net = output_dir / f"{stem}.net.xml"
+    out_route = output_dir / f"{stem}.rou.xml"
+
+    lane = sumolib.net.readNet(net_file).getLane(lane_id)
+    edge = lane.getEdge()
+    lane_copies = [
+        LaneCopy(
+            lane=f"{_copy_id(edge.getID(), k)}_0",
+            route=_copy_id("r", k),
+            suffix=f"__{k}",
+        )
+        for k in range(copies)
+    ]
+
+    if out_net.exists() and out_route.exists():
+        return out_net, out_route, lane_copies
+
+    shape = lane.getShape()
+    nodes, edges, routes = [], [], []
+    for k, lane_copy in enumerate(lane_copies):
+        dy = k * COPY_SPACING
+        from_id, to_id = _copy_id(f"{edge.getID()}_from", k), _copy_id(
+            f"{edge.getID()}_to", k
+        )
+        nodes.extend(
+            [
+                f'<node id="{from_id}" x="{shape[0][0]}" y="{shape[0][1] + dy}" type="dead_end"/>',
+                f'<node id="{to_id}" x="{shape[-1][0]}" y="{shape[-1][1] + dy}" type="dead_end"/>',
+            ]
+        )
+        edges.append(
+            f'<edge id="{_copy_id(edge.getID(), k)}" from="{from_id}" to="{to_id}" '
+            f'numLanes="1" speed="{lane.getSpeed()}" length="{lane.getLength()}" '
+            f'shape="{" ".join(f"{x},{y + dy}" for x, y in shape)}"/>'
+        )
+        routes.append(
+            f'<route id="{lane_copy.route}" edges="{_copy_id(edge.getID(), k)}"/>'
+        )
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp:
+        node_file, edge_file = Path(tmp) / "copies.nod.xml", Path(tmp) / "copies.edg.xml"
+        node_file.write_text("<nodes>\n" + "\n".join(nodes) + "\n</nodes>\n")
+        edge_file.write_text("<edges>\n" + "\n".join(edges) + "\n</edges>\n")
+        (Path(tmp) / out_route.name).write_text(
+            "<routes>\n" + "\n".join(routes) + "\n</routes>\n"
+        )
+        subprocess.run(
+            [
+                sumolib.checkBinary("netconvert"),
+                "--node-files",
+                str(node_file),
+                "--edge-files",
+                str(edge_file),
+                "--no-internal-links",
+                "--no-turnarounds",
+                "--offset.disable-normalization",
+                "--output-file",
+                str(Path(tmp) / out_net.name),
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        # other workers may be building the same network, move it in atomically
+        os.replace(Path(tmp) / out_route.name, out_route)
+        os.replace(Path(tmp) / out_net.name, out_net)
+
+    return out_net, out_route, lane_copies
@@ -0,0 +1,296 @@
+"""
+Vectorized NumPy emulation of SUMO's IDM, Krauss and W99 car-following models.
+
+A whole population of candidate parameter sets is integrated at once against
+the recorded leader, with the ballistic position update of
+`--step-method.ballistic`. The update rules follow SUMO's `MSCFModel_IDM`,
+`MSCFModel_Krauss` and `MSCFModel_W99` but leave out what doesn't vectorize
+cheaply (W99's random terms, Krauss' exact dawdling, SUMO's speed deviation
+sampling). Use `benchmarks/emulator_fidelity.py` to see how far it can be
+trusted before using it to pre-screen candidates for the SUMO-in-the-loop
+calibration.
+"""
+from typing import Dict, List
+
+import numpy as np
+
+from functions.config import Error
+from functions.error_metrics import KERNELS
+from functions.sumo_default_params import attribute_dict
+from functions.trajectory_loaders.trajectory import VelocityData
+
+
+NUMERICAL_EPS = 0.001
+# gap used when there is no leader to follow
+FREE_GAP = 1e4
+# same as the runner
+COLLISION_LOSS = 1e6
+
+MODEL_PARAMETERS = {
+    "IDM": (
+        "tau", "accel", "decel", "emergencyDecel", "minGap", "speedFactor",
+        "actionStepLength", "delta", "stepping",
+    ),
+    "Krauss": (
+        "tau", "accel", "decel", "emergencyDecel", "minGap", "speedFactor",
+        "actionStepLength", "sigma", "sigmaStep",
+    ),
+    "W99": (
+        "emergencyDecel", "minGap", "speedFactor", "actionStepLength",
+        "cc1", "cc2", "cc3", "cc4", "cc5", "cc6", "cc7", "cc8", "cc9",
+    ),
+}
+
+
+class CFEmulator:
+    def __init__(
+        self,
+        trajectories: VelocityData,
+        step_length: float,
+        max_speed: float,
+        error_conf: Error = None,
+        collision_mingap_factor: float = 1.0,
+        seed: int = 42,
+    ) -> None:
+        self.dt = step_length
+        self.max_speed = max_speed
+        self.error_conf = error_conf
+        self.collision_mingap_factor = collision_mingap_factor
+        self._rng = np.random.default_rng(seed)
+
+        # same number of steps as `BasicRunner._run_copies`
+        step_ms = int(step_length * 1000)
+        self.n_steps = -(-int(trajectories.max_time * 1000) // step_ms)
+
+        # the leader during each step, before SUMO moves it
+        schedule = trajectories.leader_schedule(step_length)
+        self._lead_s = np.full(self.n_steps, np.nan)
+        self._lead_v = np.full(self.n_steps, np.nan)
+        self._lead_present = np.zeros(self.n_steps, dtype=bool)
+        s, v, present, j = np.nan, np.nan, False, 0
+        for t in range(self.n_steps):
+            if j == len(schedule):
+                # the runner removes the leader once its trajectory is done
+                present = False
+            elif schedule.step[j] <= t:
+                present = not schedule.null[j]
+                s, v = schedule.s[j], schedule.velocity[j]
+                j += 1
+            elif present:
+                # no new sample, it keeps its speed
+                s += v * self.dt
+            self._lead_s[t], self._lead_v[t], self._lead_present[t] = s, v, present
+        self._lead_a = np.append(0, np.diff(np.nan_to_num(self._lead_v)) / self.dt)
+        # where the leader is after the step, which is what the runner records
+        self._lead_s_after = self._lead_s + self._lead_v * self.dt
+        self._lead_length = trajectories.lead_data[0].length or 0.0
+
+        self._s0 = trajectories.follow_data[0].s
+        self._v0 = trajectories.follow_data[0].velocity
+
+        # reference rows, paired by position with the simulated rows
+        reference = trajectories.reference()
+        n = min(self.n_steps, len(reference))
+        self._ref_valid = reference.valid[:n] & self._lead_present[:n]
+        self._ref_length = reference.length_lead[:n]
+        self._ref = {
+            c: reference.column(c)[:n] for c in ("spacing", "velocity", "accel")
+        }
+
+    @staticmethod
+    def stack_parameters(model: str, params: List[Dict]) -> Dict[str, np.ndarray]:
+        """One array per parameter, falling back to SUMO's defaults"""
+        if model not in MODEL_PARAMETERS:
+            raise ValueError(f"No emulator for car-following model {model}")
+        return {
+            k: np.array(
+                [
+                    float(p[k]) if p.get(k) is not None else float(attribute_dict[k])
+                    for p in params
+                ]
+            )
+            for k in MODEL_PARAMETERS[model]
+        }
+
+    def simulate(self, model: str, params: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        Integrate every candidate against the leader.
+
+        Returns the follower position, speed and acceleration after each step
+        (shape `(len(params), n_steps)`) and a per-candidate collision flag.
+        """
+        p = self.stack_parameters(model, params)
+        n = len(params)
+        dt = self.dt
+
+        s = np.full(n, self._s0, dtype=np.float64)
+        v = np.full(n, self._v0, dtype=np.float64)
+        acc = np.zeros(n)
+        v_max = p["speedFactor"] * self.max_speed
+        action_steps = np.maximum(1, np.round(p["actionStepLength"] / dt)).astype(int)
+        state = {"dawdle": np.zeros(n)}
+
+        out = {k: np.empty((n, self.n_steps)) for k in ("s", "velocity", "accel")}
+        collision = np.zeros(n, dtype=bool)
+
+        for t in range(self.n_steps):
+            if self._lead_present[t]:
+                gap = self._lead_s[t] - self._lead_length - s - p["minGap"]
+                pred_v, pred_a = self._lead_v[t], self._lead_a[t]
+            else:
+                gap = np.full(n, FREE_GAP)
+                pred_v, pred_a = v_max, 0.0
+
+            v_model = getattr(self, f"_{model.lower()}")(
+                p, t, v, acc, gap, pred_v, pred_a, v_max, state
+            )
+            # SUMO never brakes harder than the emergency deceleration
+            v_decided = np.clip(
+                v_model, np.maximum(v - p["emergencyDecel"] * dt, 0), v_max
+            )
+            # between action points the acceleration is kept
+            v_next = np.where(
+                t % action_steps == 0,
+                v_decided,
+                np.clip(v + acc * dt, 0, v_max),
+            )
+
+            acc = (v_next - v) / dt
+            s = s + dt * (v + v_next) / 2
+            v = v_next
+
+            out["s"][:, t], out["velocity"][:, t], out["accel"][:, t] = s, v, acc
+            if self._lead_present[t]:
+                collision |= (self._lead_s_after[t] - self._lead_length - s) < (
+                    self.collision_mingap_factor * p["minGap"]
+                )
+
+        out["collision"] = collision
+        return out
+
+    # --- car-following models. Each returns the speed it wants after the step
+
+    def _idm(self, p, t, v, acc, gap, pred_v, pred_a, v_max, state) -> np.ndarray:
+        dt = self.dt
+        iterations = np.maximum(
+            1, (p["actionStepLength"] / p["stepping"] + 0.5).astype(int)
+        )
+        two_sqrt_accel_decel = 2 * np.sqrt(p["accel"] * p["decel"])
+        # `gap` comes with minGap already subtracted
+        g = gap + p["minGap"]
+        new_v = v.copy()
+        for i in range(int(iterations.max())):
+            active = i < iterations
+            delta_v = new_v - pred_v
+            s_star = (
+                np.maximum(0, new_v * p["tau"] + new_v * delta_v / two_sqrt_accel_decel)
+                + p["minGap"]
+            )
+            g = np.maximum(NUMERICAL_EPS, g)
+            a = p["accel"] * (
+                1
+                - np.power(new_v / np.maximum(NUMERICAL_EPS, v_max), p["delta"])
+                - (s_star * s_star) / (g * g)
+            )
+            updated = np.maximum(0, new_v + a * dt / iterations)
+            g = np.where(
+                active, g - np.maximum(0, (updated - pred_v) * dt / iterations), g
+            )
+            new_v = np.where(active, updated, new_v)
+        return np.maximum(0, new_v)
+
+    def _krauss(self, p, t, v, acc, gap, pred_v, pred_a, v_max, state) -> np.ndarray:
+        dt = self.dt
+        b_tau = p["decel"] * p["tau"]
+        v_safe = -b_tau + np.sqrt(
+            b_tau * b_tau + pred_v * pred_v + 2 * p["decel"] * np.maximum(gap, 0)
+        )
+        v_next = np.minimum(np.minimum(v + p["accel"] * dt, v_safe), v_max)
+        # the dawdling draw is renewed every sigmaStep seconds
+        renew = t % np.maximum(1, np.round(p["sigmaStep"] / dt)).astype(int) == 0
+        state["dawdle"] = np.where(
+            renew, self._rng.random(len(v)), state["dawdle"]
+        )
+        return np.maximum(0, v_next - p["sigma"] * p["accel"] * dt * state["dawdle"])
+
+    def _w99(self, p, t, v, acc, gap, pred_v, pred_a, v_max, state) -> np.ndarray:
+        cc0 = p["minGap"]
+        dx = gap + cc0
+        dv = pred_v - v
+
+        # thresholds, with the random term of the slower speed at its mean
+        v_slower = np.where((dv >= 0) | (pred_a < 1), v, pred_v)
+        sdxc = cc0 + np.where(pred_v > 0, p["cc1"] * np.maximum(0, v_slower), 0)
+        sdxo = sdxc + p["cc2"]
+        sdxv = sdxo + p["cc3"] * (dv - p["cc4"])
+
+        sdv = p["cc6"] * dx * dx / 10000
+        sdvc = np.where(v > 0, p["cc4"] - sdv, 0)
+        sdvo = np.where(pred_v > p["cc5"], sdv + p["cc5"], sdv)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # decelerate - increase distance
+            a_increase = np.where(
+                dv < 0,
+                np.where(
+                    dx > cc0,
+                    np.minimum(pred_a + dv * dv / (cc0 - dx), 0),
+                    np.minimum(pred_a + 0.5 * (dv - sdvo), 0),
+                ),
+                0,
+            )
+            a_increase = np.where(
+                a_increase > -p["cc7"],
+                -p["cc7"],
+                np.maximum(a_increase, -10 + 0.5 * np.sqrt(v)),
+            )
+            a_increase = np.where(pred_v > 0, a_increase, 0)
+            # decelerate - decrease distance
+            a_decrease = 0.5 * dv * dv / (sdxc - dx - 0.1)
+            # keep distance
+            a_keep = np.where(
+                acc <= 0, np.minimum(acc, -p["cc7"]), np.maximum(acc, p["cc7"])
+            )
+            # accelerate / relax
+            acc_max = p["cc8"] + p["cc9"] * np.minimum(v, 80 / 3.6)
+            a_relax = np.where(
+                dx > sdxc,
+                np.where(dx < sdxo, np.minimum(dv * dv / (sdxo - dx), acc_max), acc_max),
+                0,
+            )
+
+        accel = np.select(
+            [
+                (dv < sdvo) & (dx <= sdxc),
+                (dv < sdvc) & (dx < sdxv),
+                (dv < sdvo) & (dx < sdxo),
+            ],
+            [a_increase, a_decrease, a_keep],
+            default=a_relax,
+        )
+        return v + accel * self.dt
+
+    # --- scoring
+
+    def spacing(self, sim: Dict[str, np.ndarray]) -> np.ndarray:
+        n = len(self._ref_valid)
+        return (
+            self._lead_s_after[:n] - self._ref_length - sim["s"][:, :n]
+        )
+
+    def evaluate(self, model: str, params: List[Dict]) -> np.ndarray:
+        """The configured error of every candidate, like `BasicRunner.float_step`"""
+        sim = self.simulate(model, params)
+        n = len(self._ref_valid)
+        sims = {
+            "spacing": self.spacing(sim),
+            "velocity": sim["velocity"][:, :n],
+            "accel": sim["accel"][:, :n],
+        }
+        valid = self._ref_valid
+        losses = KERNELS[self.error_conf.error_func](
+            {c: x[:, valid] for c, x in sims.items()},
+            {c: x[valid] for c, x in self._ref.items()},
+            "spacing" if self.error_conf.method == "spacing" else "velocity",
+        )
+        return np.where(sim["collision"], COLLISION_LOSS, losses)
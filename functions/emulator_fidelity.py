@@ -0,0 +1,140 @@
+"""
+Fidelity of the NumPy emulator (`cf_emulator.py`) against SUMO.
+
+`compare` simulates the same candidates with SUMO and with the emulator and
+measures the gap between the follower trajectories, how close the losses are,
+whether they rank the candidates the same way (Spearman) and whether they
+agree on collisions. `check` holds the result against the `THRESHOLDS` of the
+model, the range in which the emulator can stand in for SUMO in the
+pre-screen. Used by `tests/test_cf_emulator.py` and
+`benchmarks/emulator_fidelity.py`.
+"""
+import math
+import time
+from typing import List
+
+import numpy as np
+from omegaconf import DictConfig
+
+from functions.sumo import BasicRunner
+from functions.sumo_pipelines_adapter.cf_config import CFModelParameters
+
+
+# per model: upper bounds of the median follower rmse (s in m, v in m/s) and of
+# the median relative loss error, lower bounds of the rank correlation of the
+# losses and of the share of candidates both agree collide or not. W99 is
+# looser, the emulator leaves out its random terms
+THRESHOLDS = {
+    "IDM": {
+        "s_rmse": 0.5,
+        "v_rmse": 0.2,
+        "loss_rel_err": 0.05,
+        "spearman": 0.95,
+        "collision_agreement": 0.95,
+    },
+    "Krauss": {
+        "s_rmse": 1.0,
+        "v_rmse": 0.3,
+        "loss_rel_err": 0.1,
+        "spearman": 0.9,
+        "collision_agreement": 0.9,
+    },
+    "W99": {
+        "s_rmse": 2.0,
+        "v_rmse": 0.5,
+        "loss_rel_err": 0.25,
+        "spearman": 0.8,
+        "collision_agreement": 0.9,
+    },
+}
+# the metrics that have to stay above their threshold, the others below
+LOWER_BOUNDS = ("spearman", "collision_agreement")
+
+
+def _rank(x: np.ndarray) -> np.ndarray:
+    return np.argsort(np.argsort(x)).astype(np.float64)
+
+
+def spearman(a: np.ndarray, b: np.ndarray) -> float:
+    if len(a) < 2:
+        return float("nan")
+    return float(np.corrcoef(_rank(a), _rank(b))[0, 1])
+
+
+def compare(conf: DictConfig, n: int) -> dict:
+    """
+    SUMO against the emulator on `n` candidates of the pair and model of
+    `conf`. Krauss is compared with `sigma` forced to 0, the dawdling can't
+    be reproduced draw for draw
+    """
+    conf.Blocks.Error.early_abort = False
+    model = conf.Blocks.CFModelParameters.model
+    candidates = CFModelParameters.sample(conf.Blocks.CFModelParameters, n)
+    if model == "Krauss":
+        candidates = [{**c, "sigma": 0} for c in candidates]
+
+    runner = BasicRunner()
+    runner.setup(conf)
+    runner.keep_trajectory = True
+    emulator = runner.build_emulator()
+
+    sumo_times, emulator_times = [], []
+    sumo_losses, s_rmse, v_rmse, sumo_collisions = [], [], [], []
+    try:
+        for candidate in candidates:
+            t0 = time.perf_counter()
+            sumo_losses.append(runner(**candidate))
+            sumo_times.append(time.perf_counter() - t0)
+            follow = runner._sim_data.follow_data
+            sumo_collisions.append(sumo_losses[-1] >= 1e6)
+
+            sim = emulator.simulate(model, [runner.emulator_params(candidate)])
+            rows = min(len(follow), emulator.n_steps)
+            s_rmse.append(
+                np.sqrt(np.mean((follow.column("s")[:rows] - sim["s"][0, :rows]) ** 2))
+            )
+            v_rmse.append(
+                np.sqrt(
+                    np.mean(
+                        (follow.column("velocity")[:rows] - sim["velocity"][0, :rows]) ** 2
+                    )
+                )
+            )
+    finally:
+        runner.cleanup()
+
+    params = [runner.emulator_params(c) for c in candidates]
+    t0 = time.perf_counter()
+    emulator_losses = emulator.evaluate(model, params)
+    emulator_times.append(time.perf_counter() - t0)
+    emulator_collisions = emulator_losses >= 1e6
+
+    sumo_losses = np.array(sumo_losses)
+    both = ~np.array(sumo_collisions) & ~emulator_collisions
+    return {
+        "model": model,
+        "s_rmse": np.nanmedian(s_rmse),
+        "v_rmse": np.nanmedian(v_rmse),
+        "loss_rel_err": np.median(
+            np.abs(emulator_losses[both] - sumo_losses[both]) / sumo_losses[both]
+        )
+        if both.any()
+        else float("nan"),
+        "spearman": spearman(sumo_losses[both], emulator_losses[both]),
+        "collision_agreement": np.mean(np.array(sumo_collisions) == emulator_collisions),
+        "sumo_times": sumo_times,
+        "emulator_times": emulator_times,
+    }
+
+
+def check(res: dict) -> List[str]:
+    """The metrics of `res` outside the thresholds of its model"""
+    failures = []
+    for metric, bound in THRESHOLDS[res["model"]].items():
+        value = float(res[metric])
+        if math.isnan(value):
+            # every candidate collided, nothing to compare
+            failures.append(f"{metric}=n/a")
+        elif (value < bound) if metric in LOWER_BOUNDS else (value > bound):
+            failures.append(f"{metric}={value:.3f} (limit {bound})")
+    return failures
@@ -1,7 +1,15 @@
+from copy import copy
+from typing import Any, Dict, List, Tuple
+
 import numpy as np
 import pandas as pd
 
 from functions.config import Error
+from functions.trajectory_loaders.trajectory import (
+    ReferenceArrays,
+    VelocityData,
+    _as_array,
+)
 
 
 def _join_n_add_spacing(rw_df: pd.DataFrame, sim_df: pd.DataFrame) -> pd.DataFrame:
@@ -104,3 +112,371 @@ def nrmse_s_v_a(df: pd.DataFrame, *args, **kwargs) -> float:
     return (
         nrmse(df, col="spacing") + nrmse(df, col="velocity") + nrmse(df, col="accel")
     ) / 3
+
+
+# the reference columns each metric is computed over
+_STREAMING_COLUMNS = {
+    "nrmse_s_v": ("spacing", "velocity"),
+    "nrmse_s_v_a": ("spacing", "velocity", "accel"),
+}
+
+
+class StreamingError:
+    """
+    The configured error, accumulated one simulated row at a time from running
+    sums against the reference arrays.
+
+    Rows pair up by position, like the index join in `_join_n_add_spacing`.
+    `lower_bound` can never exceed the final `value`, so a candidate can be
+    aborted as soon as the bound passes the best loss seen for the pair.
+    """
+
+    def __init__(self, reference: ReferenceArrays, conf: Error) -> None:
+        self.error_func = conf.error_func
+        col = "spacing" if conf.method == "spacing" else "velocity"
+        self.columns = _STREAMING_COLUMNS.get(self.error_func, (col,))
+
+        # rows with a gap in the reference are dropped by the join
+        self._valid = reference.valid
+        self._length_lead = reference.length_lead
+        self._ref = {c: reference.column(c) for c in self.columns}
+
+        # what the rows from i on can still add to the normalizers
+        def _rest(x: np.ndarray) -> np.ndarray:
+            x = np.where(self._valid, x, 0)
+            return np.append(np.cumsum(x[::-1])[::-1], 0)
+
+        self._rest_n = _rest(np.ones(len(self._valid)))
+        self._rest_sq = {c: _rest(np.square(r)) for c, r in self._ref.items()}
+        self._rest_sum = {c: _rest(r) for c, r in self._ref.items()}
+        # rmsn is only bounded when the normalizer can't shrink
+        self._non_negative = {
+            c: bool(np.all(r[self._valid] >= 0)) for c, r in self._ref.items()
+        }
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.row = 0
+        self.aborted = False
+        # n, sum of squared error, sum of squared ref, sum of ref,
+        # sum of squared relative error, sum of relative error
+        self._stats = {c: [0, 0.0, 0.0, 0.0, 0.0, 0.0] for c in self.columns}
+
+    def copy(self) -> "StreamingError":
+        """A fresh accumulator sharing the reference arrays"""
+        other = copy(self)
+        other.reset()
+        return other
+
+    def skip(self) -> None:
+        """A simulated row with a gap, it drops out of the join"""
+        self.row += 1
+
+    def update(
+        self, s_lead: float, s_follow: float, velocity: float, accel: float
+    ) -> None:
+        i = self.row
+        self.row += 1
+        if i >= len(self._valid) or not self._valid[i]:
+            return
+
+        sim = {
+            "spacing": s_lead - self._length_lead[i] - s_follow,
+            "velocity": velocity,
+            "accel": accel,
+        }
+        for c in self.columns:
+            ref = self._ref[c][i]
+            diff = sim[c] - ref
+            stats = self._stats[c]
+            stats[0] += 1
+            stats[1] += diff * diff
+            stats[2] += ref * ref
+            stats[3] += ref
+            if ref != 0:
+                stats[4] += (diff / ref) ** 2
+                stats[5] += diff / ref
+            else:
+                stats[4] = stats[5] = np.nan
+
+    def _metric(self, c: str, func: str, bound: bool) -> float:
+        n, sse, sq, sm, spe, pe = self._stats[c]
+        if bound:
+            i = min(self.row, len(self._valid))
+            n, sq, sm = (
+                n + self._rest_n[i],
+                sq + self._rest_sq[c][i],
+                sm + self._rest_sum[c][i],
+            )
+            if func == "mpe" or (func == "rmsn" and not self._non_negative[c]):
+                return -np.inf
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if func == "rmse":
+                return np.sqrt(np.float64(sse) / n)
+            if func in ("nrmse", "nrmse_s_v", "nrmse_s_v_a"):
+                return np.sqrt(np.float64(sse) / sq)
+            if func == "rmsn":
+                return np.sqrt(np.float64(sse)) / sm
+            if func == "rmspe":
+                return np.sqrt(np.float64(spe) / n)
+            if func == "mpe":
+                return np.float64(pe) / n
+        raise ValueError(f"Invalid error function {func}")
+
+    def _combine(self, bound: bool) -> float:
+        total = sum(self._metric(c, self.error_func, bound) for c in self.columns)
+        if self.error_func == "nrmse_s_v_a":
+            total /= 3
+        return float(total)
+
+    @property
+    def value(self) -> float:
+        return self._combine(bound=False)
+
+    def lower_bound(self) -> float:
+        # an empty accumulator bounds nothing (0 / 0)
+        return float(np.nan_to_num(self._combine(bound=True), nan=0.0))
+
+
+# NumPy versions of the metrics. They reduce over the last axis of arrays
+# holding only the rows kept by the join, so a (candidates, rows) batch works too
+
+
+def _k_rmse(sim: dict, ref: dict, col: str) -> np.ndarray:
+    return np.sqrt(np.mean(np.square(sim[col] - ref[col]), axis=-1))
+
+
+def _k_rmsn(sim: dict, ref: dict, col: str) -> np.ndarray:
+    return np.sqrt(
+        ref[col].shape[-1] * np.mean(np.square(sim[col] - ref[col]), axis=-1)
+    ) / np.sum(ref[col], axis=-1)
+
+
+def _k_rmspe(sim: dict, ref: dict, col: str) -> np.ndarray:
+    return np.sqrt(np.mean(np.square((sim[col] - ref[col]) / ref[col]), axis=-1))
+
+
+def _k_mpe(sim: dict, ref: dict, col: str) -> np.ndarray:
+    return np.mean((sim[col] - ref[col]) / ref[col], axis=-1)
+
+
+def _k_nrmse(sim: dict, ref: dict, col: str) -> np.ndarray:
+    return _k_rmse(sim, ref, col) / np.sqrt(np.mean(np.square(ref[col]), axis=-1))
+
+
+def _k_nrmse_s_v(sim: dict, ref: dict, col: str = None) -> np.ndarray:
+    return _k_nrmse(sim, ref, "spacing") + _k_nrmse(sim, ref, "velocity")
+
+
+def _k_nrmse_s_v_a(sim: dict, ref: dict, col: str = None) -> np.ndarray:
+    return (
+        _k_nrmse(sim, ref, "spacing")
+        + _k_nrmse(sim, ref, "velocity")
+        + _k_nrmse(sim, ref, "accel")
+    ) / 3
+
+
+KERNELS = {
+    "rmse": _k_rmse,
+    "rmsn": _k_rmsn,
+    "rmspe": _k_rmspe,
+    "mpe": _k_mpe,
+    "nrmse": _k_nrmse,
+    "nrmse_s_v": _k_nrmse_s_v,
+    "nrmse_s_v_a": _k_nrmse_s_v_a,
+}
+
+
+class ErrorKernel:
+    """
+    `fast_error` without pandas. The reference side of the join and the
+    metric are worked out once per pair, a call only scatters the simulated
+    rows into preallocated arrays and runs one NumPy reduction.
+    """
+
+    def __init__(self, reference: ReferenceArrays, conf: Error) -> None:
+        if conf.error_func not in KERNELS:
+            raise ValueError(f"Invalid error function {conf.error_func}")
+        self.error_func = conf.error_func
+        self.col = "spacing" if conf.method == "spacing" else "velocity"
+        self.columns = _STREAMING_COLUMNS.get(self.error_func, (self.col,))
+        self._kernel = KERNELS[self.error_func]
+
+        self._valid = reference.valid
+        self._length_lead = reference.length_lead
+        self._ref = {c: reference.column(c) for c in REPORT_COLUMNS.values()}
+
+        # simulated rows, scattered to the position they take in the join
+        n = len(reference)
+        self._s_lead = np.empty(n)
+        self._s_follow = np.empty(n)
+        self._velocity = np.empty(n)
+        self._accel = np.empty(n)
+
+    def aligned(
+        self, sim_data: VelocityData
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], np.ndarray]:
+        """
+        The simulated and reference `spacing`, `velocity` and `accel` rows as
+        the join pairs them, and the mask of the rows it keeps. The simulated
+        arrays are views of buffers that the next call overwrites.
+        """
+        lead, follow = _as_array(sim_data.lead_data), _as_array(sim_data.follow_data)
+        lead_ms = np.rint(lead.column("time") * 1000).astype(np.int64)
+        follow_ms = np.rint(follow.column("time") * 1000).astype(np.int64)
+        # the rows of the outer merge in `VelocityData.to_df`
+        times = np.union1d(lead_ms, follow_ms)
+        n = min(len(times), len(self._valid))
+
+        for buffer in (self._s_lead, self._s_follow, self._velocity, self._accel):
+            buffer[:n] = np.nan
+
+        rows = np.searchsorted(times, lead_ms)
+        keep = rows < n
+        # any gap on the leader's side drops the row too
+        gap = np.isnan(lead.column("velocity")) | np.isnan(lead.column("accel"))
+        self._s_lead[rows[keep]] = np.where(gap, np.nan, lead.column("s"))[keep]
+        rows = np.searchsorted(times, follow_ms)
+        keep = rows < n
+        self._s_follow[rows[keep]] = follow.column("s")[keep]
+        self._velocity[rows[keep]] = follow.column("velocity")[keep]
+        self._accel[rows[keep]] = follow.column("accel")[keep]
+
+        sim = {
+            "spacing": self._s_lead[:n] - self._length_lead[:n] - self._s_follow[:n],
+            "velocity": self._velocity[:n],
+            "accel": self._accel[:n],
+        }
+        valid = (
+            self._valid[:n]
+            & ~np.isnan(sim["spacing"])
+            & ~np.isnan(sim["velocity"])
+            & ~np.isnan(sim["accel"])
+        )
+        return sim, {c: r[:n] for c, r in self._ref.items()}, valid
+
+    def __call__(self, sim_data: VelocityData) -> float:
+        sim, ref, valid = self.aligned(sim_data)
+        return float(
+            self._kernel(
+                {c: sim[c][valid] for c in self.columns},
+                {c: ref[c][valid] for c in self.columns},
+                self.col,
+            )
+        )
+
+    def report(self, sim_data: VelocityData, include_accel: bool = True) -> Dict:
+        return metric_report(*self.aligned(sim_data), include_accel=include_accel)
+
+
+# report name -> column
+REPORT_COLUMNS = {"s": "spacing", "velocity": "velocity", "accel": "accel"}
+# the per-column metrics of `metric_report`
+REPORT_METRICS = ("rmsn", "rmspe", "mpe", "nrmse", "rmse")
+
+
+def report_names(include_accel: bool = True) -> List[str]:
+    """The keys of `metric_report`"""
+    return [
+        f"{metric}_{name}"
+        for name in REPORT_COLUMNS
+        if include_accel or name != "accel"
+        for metric in REPORT_METRICS
+    ] + ["nrmse_s_v", "nrmse_s_v_a"]
+
+
+def sufficient_statistics(
+    sim: np.ndarray, ref: np.ndarray, valid: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """
+    Everything the metrics need from one column, in one pass over the rows:
+    count, sum of squared error, sum of squared and plain reference, sum of
+    squared and plain relative error. Reduces over the last axis.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        err = np.where(valid, sim - ref, 0.0)
+        ref = np.where(valid, ref, 0.0)
+        rel = np.where(valid, err / ref, 0.0)
+    return {
+        "n": valid.sum(axis=-1),
+        "sse": np.sum(err * err, axis=-1),
+        "sq_ref": np.sum(ref * ref, axis=-1),
+        "sum_ref": np.sum(ref, axis=-1),
+        "sq_rel": np.sum(rel * rel, axis=-1),
+        "sum_rel": np.sum(rel, axis=-1),
+    }
+
+
+def metric_report(
+    sim: Dict[str, np.ndarray],
+    ref: Dict[str, np.ndarray],
+    valid: np.ndarray = None,
+    include_accel: bool = True,
+) -> Dict[str, Any]:
+    """
+    Every metric of `error_metrics` as a plain dict, derived from the
+    sufficient statistics of each column instead of metric by metric.
+
+    The arrays may be `(rows,)` or stacked `(..., rows)` (e.g. all pairs and
+    models, padded with nan and masked by `valid`), the metrics then have the
+    leading shape. Without `valid`, rows with a nan anywhere are left out.
+    """
+    if valid is None:
+        valid = np.logical_and.reduce(
+            [
+                ~np.isnan(sim[c]) & ~np.isnan(ref[c])
+                for c in REPORT_COLUMNS.values()
+            ]
+        )
+
+    report, nrmse = {}, {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for name, c in REPORT_COLUMNS.items():
+            st = sufficient_statistics(sim[c], ref[c], valid)
+            nrmse[c] = np.sqrt(st["sse"] / st["sq_ref"])
+            if name == "accel" and not include_accel:
+                continue
+            report[f"rmsn_{name}"] = np.sqrt(st["sse"]) / st["sum_ref"]
+            report[f"rmspe_{name}"] = np.sqrt(st["sq_rel"] / st["n"])
+            report[f"mpe_{name}"] = st["sum_rel"] / st["n"]
+            report[f"nrmse_{name}"] = nrmse[c]
+            report[f"rmse_{name}"] = np.sqrt(st["sse"] / st["n"])
+        report["nrmse_s_v"] = nrmse["spacing"] + nrmse["velocity"]
+        report["nrmse_s_v_a"] = (
+            nrmse["spacing"] + nrmse["velocity"] + nrmse["accel"]
+        ) / 3
+    return report
+
+
+def pad_stack(arrays: List[np.ndarray]) -> np.ndarray:
+    """Stack rows of different lengths into one nan-padded 2D array"""
+    out = np.full((len(arrays), max((len(a) for a in arrays), default=0)), np.nan)
+    for i, a in enumerate(arrays):
+        out[i, : len(a)] = a
+    return out
+
+
+def batch_report(
+    items: List[Tuple[ErrorKernel, VelocityData]], include_accel: bool = True
+) -> Dict[str, np.ndarray]:
+    """
+    `metric_report` of many simulated trajectories (e.g. the best one of every
+    pair and model) in one vectorized call. Metric `i` belongs to `items[i]`.
+    """
+    sims, refs, valids = [], [], []
+    for kernel, sim_data in items:
+        sim, ref, valid = kernel.aligned(sim_data)
+        # the kernel's buffers are reused by its next call
+        sims.append({c: x.copy() for c, x in sim.items()})
+        refs.append(ref)
+        valids.append(valid.astype(np.float64))
+
+    columns = REPORT_COLUMNS.values()
+    return metric_report(
+        {c: pad_stack([s[c] for s in sims]) for c in columns},
+        {c: pad_stack([r[c] for r in refs]) for c in columns},
+        pad_stack(valids) == 1,
+        include_accel=include_accel,
+    )
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+
+
+# where the disk tier lives when no cache_dir is configured. Node local, so
+# every worker on the node shares it
+DEFAULT_CACHE_DIR = Path(tempfile.gettempdir()) / "sumo-cf-eval-cache"
+
+# the caches opened in this process, by directory
+_CACHES: Dict[Path, "EvaluationCache"] = {}
+
+
+def quantize(params: Dict[str, Any], decimals: int = 6) -> Dict[str, Any]:
+    """Round the float parameters, so that near-identical points share a key"""
+    return {
+        k: round(float(v), decimals) if isinstance(v, float) else v
+        for k, v in sorted(params.items())
+    }
+
+
+def array_digest(*arrays: np.ndarray) -> str:
+    """Hash of the content of `arrays`, for the data an evaluation replays"""
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def file_stamp(path: Union[str, Path, None]) -> Optional[str]:
+    """Size and modification time of `path`, to tell edited inputs apart"""
+    if path is None:
+        return None
+    try:
+        stat = Path(path).stat()
+    except OSError:
+        return None
+    return f"{stat.st_size}_{stat.st_mtime_ns}"
+
+
+def cache_key(**parts: Any) -> str:
+    """Content address of an evaluation, from everything its loss depends on"""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class EvaluationCache:
+    """
+    Losses of already simulated candidates. A bounded in-process LRU in front
+    of a directory with one small json file per key, shared by every process
+    that points at it. Files are written atomically, so concurrent writers of
+    the same key are harmless. The directory keeps the `max_disk_entries`
+    most recently used files, it is pruned when opened and every
+    `prune_every` writes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = None,
+        maxsize: int = 4096,
+        max_disk_entries: int = 100_000,
+        prune_every: int = 1000,
+    ) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+        self.max_disk_entries = max_disk_entries
+        self.prune_every = max(prune_every, 1)
+        self._lru: "OrderedDict[str, dict]" = OrderedDict()
+        # runners of a pair may share the cache across threads
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.prune()
+
+    @classmethod
+    def shared(
+        cls,
+        cache_dir: Union[str, Path] = None,
+        maxsize: int = 4096,
+        max_disk_entries: int = 100_000,
+    ) -> "EvaluationCache":
+        """The cache of `cache_dir`, opened once per process"""
+        cache_dir = Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+        if cache_dir not in _CACHES:
+            _CACHES[cache_dir] = cls(cache_dir, maxsize, max_disk_entries)
+        return _CACHES[cache_dir]
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._lru[key] = value
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            value = self._lru.get(key)
+            if value is not None:
+                self._lru.move_to_end(key)
+        if value is None:
+            path = self._path(key)
+            try:
+                value = json.loads(path.read_text())
+                # recently used, for `prune`
+                os.utime(path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                value = None
+            if value is not None:
+                self._remember(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: dict) -> None:
+        self._remember(key, value)
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(value, f)
+        os.replace(f.name, path)
+
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """Drop the least recently used files above `max_disk_entries`"""
+        if self.max_disk_entries <= 0:
+            return 0
+        files = []
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                files.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # pruned by another worker
+                continue
+        excess = len(files) - self.max_disk_entries
+        if excess <= 0:
+            return 0
+        files.sort()
+        for _, path in files[:excess]:
+            path.unlink(missing_ok=True)
+        return excess
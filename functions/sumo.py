@@ -1,39 +1,40 @@
 import contextlib
 import os
-import uuid
+import time
 
 from sumo_pipelines.blocks.simulation.functions import make_cmd
 from sumo_pipelines.utils.config_helpers import load_function
 
 from functions.config import Root, Error
-from functions.error_metrics import error_metrics, fast_error
+from functions.error_metrics import ErrorKernel, StreamingError
 from functions.trajectory_loaders.read_trajectories import TimeStep, VelocityData
-from functions.sumo_pipelines_adapter.cf_config import CFModelParameters
+from functions.trajectory_loaders.trajectory import LeaderSchedule, ReferenceArrays
+from functions.sumo_pipelines_adapter.cf_config import (
+    CFModelParameters,
+    write_vtypes,
+)
+from functions.batch_network import LaneCopy, build_batch_network
+from functions.sumo_backends import SimulationBackend, get_backend
+from functions.cf_emulator import CFEmulator
+from functions.eval_cache import (
+    EvaluationCache,
+    array_digest,
+    cache_key,
+    file_stamp,
+    quantize,
+)
 
 from copy import deepcopy
 from pathlib import Path
 
 import sumolib
+from omegaconf import OmegaConf
 from shapely import line_interpolate_point
 from shapely.geometry import LineString
 import traci.constants as tc
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-
-# check if windows
-import platform
-
-# try:
-#     if platform.system() != "Windows":
-#         import libsumo as traci
-
-#         LIBSUMO = True
-#     else:
-#         raise ImportError
-# except ImportError:
-import traci
-
-LIBSUMO = False
+import numpy as np
 
 
 if TYPE_CHECKING:
@@ -41,36 +42,93 @@ if TYPE_CHECKING:
 
 wand_b_ok = False
 
+# SUMO time (in ms) after which a running session is reset
+SIM_TIME_WRAP = 1e6
+
 
 class BasicRunner:
     def __init__(self) -> None:
         self._config: Root = None
         self._traci: traci_conn.connection = None
+        self._backend: SimulationBackend = None
 
         self._step_counter = 0
         self._initialized = False
 
         self._cf_params: CFModelParameters = None
         self._record_video = False
-
-    def _gen_traci_conn(self):
-        # generate a random hash for the traci connection
-        return str(uuid.uuid4())
-        # return f"{uuidrandom.randint(0, 1000)}"
-
-    def setup(self, run_config: Root = None, record_video: bool = False):
+        self._persistent_session = False
+        self._lane_copies: List[LaneCopy] = []
+        self._vtype_file: Path = None
+        # SUMO round trips of every evaluation
+        self.round_trips: List[int] = []
+        # store the simulated trajectory even when the error is streamed
+        self.keep_trajectory = False
+        self._cache: EvaluationCache = None
+        # `OptimizationTrace` recording every evaluation, set by the optimizer
+        self.trace = None
+        # hold on to the trajectory of the best candidate so far, so that the
+        # pair can be reported without simulating it again
+        self.keep_incumbent = True
+        self._incumbent: Dict[str, Any] = None
+        self._worker = 0
+
+    def setup(
+        self,
+        run_config: Root = None,
+        record_video: bool = False,
+        batch_size: int = 1,
+        worker: int = 0,
+    ):
         self._config = deepcopy(run_config)
+        self._worker = worker
+        # runners of the same pair share Metadata.cwd
+        self._vtype_file = Path(self._config.Metadata.cwd) / (
+            "cf_params.add.xml" if worker == 0 else f"cf_params_{worker}.add.xml"
+        )
         self._trajectories: VelocityData = load_function(
             self._config.Blocks.TrajectoryProcessing.generate_function
         )(**self._config.Blocks.TrajectoryProcessing.kwargs)
+        self._leader_schedule: LeaderSchedule = self._trajectories.leader_schedule(
+            self._config.Blocks.SimulationConfig.step_length
+        )
+        # the real-world frame never changes during the calibration
+        self._reference: ReferenceArrays = self._trajectories.reference()
+        self._error_kernel = ErrorKernel(self._reference, self._config.Blocks.Error)
+
+        # accumulate the error while simulating and stop candidates that can't
+        # beat the best loss of the pair (or the configured threshold)
+        self._streaming_error: StreamingError = None
+        if self._config.Blocks.Error.get("early_abort", False):
+            self._streaming_error = StreamingError(
+                self._reference, self._config.Blocks.Error
+            )
+        self._abort_threshold = self._config.Blocks.Error.get("abort_threshold", None)
+        self._best_loss = float("inf")
+        self._incumbent = None
 
         self._cf_params = run_config.Blocks.CFModelParameters
         self._record_video = record_video
+        # keep one SUMO server alive for the whole calibration of the pair.
+        # the gui has to be restarted to record each iteration
+        self._persistent_session = (
+            bool(self._config.Blocks.SimulationConfig.get("persistent_session", False))
+            and not record_video
+        )
 
         if self._initialized is False:
             self._init_sumo()
 
-        if self._sim_time > 1e6:
+        self._lane_copies = [
+            LaneCopy(
+                lane=self._config.Blocks.SimulationConfig.target_lane,
+                route=self._config.Blocks.SimulationConfig.route_name,
+            )
+        ]
+        if batch_size > 1 and not record_video:
+            self._setup_batch(batch_size)
+
+        if self._sim_time > SIM_TIME_WRAP:
             self._sim_time = 0
             self.cleanup_sim()
 
@@ -78,98 +136,411 @@ class BasicRunner:
             print("Starting SUMO")
             self._start_sumo()
 
+        # losses of candidates simulated before, by this or any other worker
+        self._cache: EvaluationCache = None
+        cache_conf = self._config.Blocks.get("EvaluationCache", None)
+        if cache_conf is not None and cache_conf.get("enabled", False):
+            self._cache = EvaluationCache.shared(
+                cache_conf.get("cache_dir", None),
+                cache_conf.get("maxsize", 4096),
+                cache_conf.get("max_disk_entries", 100_000),
+            )
+            self._cache_decimals = cache_conf.get("decimals", 6)
+            self._sumo_version = self._traci.getVersion()[1]
+            # what the pair replays, rather than where it was read from
+            self._data_digest = array_digest(
+                self._leader_schedule.step,
+                self._leader_schedule.velocity,
+                self._leader_schedule.s,
+                self._leader_schedule.null,
+                self._reference.time,
+                self._reference.spacing,
+                self._reference.velocity,
+                self._reference.accel,
+                self._reference.length_lead,
+                self._reference.valid,
+            )
+            sim = OmegaConf.to_container(
+                self._config.Blocks.SimulationConfig, resolve=True
+            )
+            # the display doesn't change a loss
+            sim.pop("gui", None)
+            self._sim_key = {
+                **sim,
+                "net_stamp": file_stamp(sim.get("net_file")),
+                "route_stamps": [file_stamp(f) for f in sim.get("route_files") or []],
+            }
+
+    def set_model(self, cf_params: CFModelParameters, cwd: str = None) -> None:
+        """
+        Switch to another car-following model of the same pair. The
+        trajectories, the network and the SUMO session are kept, what was
+        learned about the previous model is not.
+        """
+        self._config.Blocks.CFModelParameters = cf_params
+        self._cf_params = self._config.Blocks.CFModelParameters
+        if cwd is not None:
+            self._config.Metadata.cwd = cwd
+        self._best_loss = float("inf")
+        self._incumbent = None
+        self.keep_trajectory = False
+        self.round_trips = []
+
     def _init_sumo(
         self,
     ) -> None:
-        self._traci_conn = self._gen_traci_conn()
+        # libsumo where possible, otherwise a TraCI socket
+        self._backend = get_backend(
+            self._config.Blocks.SimulationConfig.get("backend", "traci"),
+            gui=self._config.Blocks.SimulationConfig.gui or self._record_video,
+        )
         self._sim_time = 0
         self._sim_step = int(self._config.Blocks.SimulationConfig.step_length * 1000)
         self._initialized = True
 
+        net = sumolib.net.readNet(
+            self._config.Blocks.SimulationConfig.net_file, withInternal=True
+        )
         self._lane_linestring = LineString(
-            sumolib.net.readNet(
-                self._config.Blocks.SimulationConfig.net_file, withInternal=True
-            )
-            .getLane("E2_0")
-            .getShape(includeJunctions=True)
+            net.getLane("E2_0").getShape(includeJunctions=True)
         )
+        self._lane_speed = net.getLane(
+            self._config.Blocks.SimulationConfig.target_lane
+        ).getSpeed()
+
+    def _setup_batch(self, batch_size: int) -> None:
+        """Swap the network for one with `batch_size` copies of the target lane"""
+        net_file, route_file, self._lane_copies = build_batch_network(
+            self._config.Blocks.SimulationConfig.net_file,
+            self._config.Blocks.SimulationConfig.target_lane,
+            batch_size,
+            Path(self._config.Metadata.output) / "batch_networks",
+        )
+        self._config.Blocks.SimulationConfig.net_file = str(net_file)
+        self._config.Blocks.SimulationConfig.route_files = [str(route_file)]
+        # a session started on the original network is of no use anymore
+        self._close_sumo()
 
     def _start_sumo(self):
         if self._record_video:
             self._config.Blocks.SimulationConfig.gui = True
 
-        if LIBSUMO:
-            traci.start(
-                make_cmd(self._config.Blocks.SimulationConfig),
-            )
-            self._traci = traci
-        else:
-            traci.start(
-                make_cmd(self._config.Blocks.SimulationConfig),
-                label=self._traci_conn,
-            )
-            self._traci = traci.getConnection(self._traci_conn)
-            print(f"Starting SUMO with connection number {self._traci_conn}")
-
-    def add_vehicle(self, traj_data: TimeStep, name: str, follower: bool = False):
-        self._traci.vehicle.add(
-            name,
-            self._config.Blocks.SimulationConfig.route_name,
-            departSpeed=str(traj_data.velocity),
-            departPos=0,  # cause I'm gonna move it to the correct position down below
-        )
+        self._backend.start(make_cmd(self._config.Blocks.SimulationConfig))
+        self._traci = self._backend.conn
 
-        if follower:
-            self._traci.vehicle.setType(name, self._cf_params.vehType)
-        else:
-            self._traci.vehicle.setLength(name, traj_data.length)
-            self._traci.vehicle.setSpeedMode(name, 32)
+    def _close_sumo(self):
+        if self._traci is not None:
+            with contextlib.suppress(*self._backend.errors):
+                self._backend.close()
+        self._traci = None
 
-        # force the vehicle in the position with vehicle moveTo
-        self._traci.vehicle.moveTo(
-            name,
-            self._config.Blocks.SimulationConfig.target_lane,
-            traj_data.s,
-            reason=tc.MOVE_AUTOMATIC,
-        )
+    def _reload_sumo(self):
+        """
+        Reset the running SUMO server instead of launching a new one.
+
+        `traci.load` re-reads the (freshly written) vType file, clears every
+        vehicle and restarts the simulation clock, so it also takes care of
+        the `SIM_TIME_WRAP`.
+        """
+        # the first element is the sumo binary
+        self._backend.load(make_cmd(self._config.Blocks.SimulationConfig)[1:])
+        self._sim_time = 0
+
+    def add_vehicle(
+        self,
+        traj_data: TimeStep,
+        name: str,
+        follower: bool = False,
+        lane_copy: LaneCopy = None,
+    ):
+        lane_copy = lane_copy or self._lane_copies[0]
+        # everything up to the subscription goes out in one message
+        with self._backend.batched():
+            self._traci.vehicle.add(
+                name,
+                lane_copy.route,
+                departSpeed=str(traj_data.velocity),
+                departPos=0,  # cause I'm gonna move it to the correct position down below
+            )
+
+            if follower:
+                self._traci.vehicle.setType(
+                    name, f"{self._cf_params.vehType}{lane_copy.suffix}"
+                )
+            else:
+                self._traci.vehicle.setLength(name, traj_data.length)
+                self._traci.vehicle.setSpeedMode(name, 32)
+
+            # force the vehicle in the position with vehicle moveTo
+            self._traci.vehicle.moveTo(
+                name,
+                lane_copy.lane,
+                traj_data.s,
+                reason=tc.MOVE_AUTOMATIC,
+            )
         self._traci.vehicle.subscribe(
             name, (tc.VAR_SPEED, tc.VAR_LANEPOSITION, tc.VAR_ACCELERATION)
         )
 
-    def __call__(self, **param_dict) -> Any:
+    @property
+    def reference(self) -> ReferenceArrays:
+        """The real-world trajectory of the pair, as the error code sees it"""
+        return self._reference
+
+    def build_emulator(self) -> CFEmulator:
+        """A NumPy emulation of this pair, for pre-screening candidates"""
+        return CFEmulator(
+            self._trajectories,
+            self._config.Blocks.SimulationConfig.step_length,
+            self._lane_speed,
+            self._config.Blocks.Error,
+        )
+
+    def emulator_params(self, param_dict: dict) -> Dict[str, float]:
+        """The full parameter set of a candidate, as the emulator takes it"""
+        return self._to_cf_params(param_dict).values()
+
+    def _to_cf_params(self, param_dict: dict) -> CFModelParameters:
         # this is for NgOpt
-        param_dict["model"] = self._cf_params.model
-        self._cf_params = CFModelParameters.from_flat_dict(param_dict)
-        param_dict.update({"model": self._cf_params.model})
+        return CFModelParameters.from_flat_dict(
+            {**param_dict, "model": self._cf_params.model}
+        )
 
-        with open(Path(self._config.Metadata.cwd) / "cf_params.add.xml", "w") as f:
-            self._cf_params.write_additional_file(f)
+    def _write_vtypes(self, cf_params: List[CFModelParameters]) -> None:
+        with open(self._vtype_file, "w") as f:
+            write_vtypes(
+                f,
+                [
+                    p.vtype_element(f"{p.vehType}{lane_copy.suffix}")
+                    for p, lane_copy in zip(cf_params, self._lane_copies)
+                ],
+            )
 
         self._config.Blocks.SimulationConfig.additional_files = [f.name]
 
-        try:
-            self._start_sumo()
-        except Exception as e:
-            self._traci.close(wait=False)
-            self._traci = None
+    def _prepare(self, cf_params: List[CFModelParameters]) -> None:
+        """Get a session with a vType per candidate, and no vehicles"""
+        self._cf_params = cf_params[0]
+        self._write_vtypes(cf_params)
+        self._restart_sumo()
+
+    def _restart_sumo(self) -> None:
+        if self._persistent_session and self._traci is not None:
+            try:
+                self._reload_sumo()
+            except self._backend.errors:
+                # the server died or refused the reload, start a fresh one
+                self._close_sumo()
+                self._start_sumo()
+        else:
+            # the session opened in `setup` doesn't know the new vType yet
+            self._close_sumo()
             self._start_sumo()
 
+    def __call__(self, **param_dict) -> Any:
+        t0 = time.perf_counter()
+        key = None
+        if self._cache is not None and not self.keep_trajectory:
+            key = self._cache_key(param_dict)
+            hit = self._cached(key)
+            if hit is not None:
+                self._record(param_dict, hit, time.perf_counter() - t0, cached=True)
+                self._offer_incumbent(param_dict, hit)
+                return hit["loss"]
+
+        round_trips = self._backend.round_trips
+        self._prepare([self._to_cf_params(param_dict)])
         res = self.float_step()
+        self.round_trips.append(self._backend.round_trips - round_trips)
+
+        if not self._persistent_session:
+            self.cleanup_sim()
 
-        self.cleanup()
+        if key is not None:
+            self._cache.put(key, self._last_summary)
+        self._record(param_dict, self._last_summary, time.perf_counter() - t0)
+        self._offer_incumbent(param_dict, self._last_summary, self._sim_data)
 
         return res
 
-    def run(self) -> VelocityData:
-        leader_name = f"leader_{int(self._sim_time)}"
-        follower_name = f"follower_{int(self._sim_time)}"
+    def evaluate_batch(self, param_dicts: List[dict]) -> List[float]:
+        """
+        Evaluate up to `batch_size` candidates in one simulation, each on its
+        own copy of the target lane replaying the same leader.
+        """
+        if len(param_dicts) > len(self._lane_copies):
+            raise ValueError(
+                f"Got {len(param_dicts)} candidates for {len(self._lane_copies)} lane copies"
+            )
+
+        t0 = time.perf_counter()
+        keys = [None] * len(param_dicts)
+        if self._cache is not None and not self.keep_trajectory:
+            keys = [self._cache_key(p) for p in param_dicts]
+        hits = [None if k is None else self._cached(k) for k in keys]
+        losses = [None if hit is None else hit["loss"] for hit in hits]
+        todo = [i for i, loss in enumerate(losses) if loss is None]
+        for i, hit in enumerate(hits):
+            if hit is not None:
+                self._record(param_dicts[i], hit, 0.0, cached=True)
+                self._offer_incumbent(param_dicts[i], hit)
+        if not todo:
+            return losses
+
+        cf_params = [self._to_cf_params(param_dicts[i]) for i in todo]
+
+        round_trips = self._backend.round_trips
+        self._prepare(cf_params)
+        results = self._run_copies(self._lane_copies[: len(cf_params)])
+        self.round_trips.append(self._backend.round_trips - round_trips)
+        simulated = [self._score(*result) for result in results]
+        self._sim_data = results[simulated.index(min(simulated))][0]
+
+        # the candidates shared the simulation, so they share its wall time
+        wall_time = (time.perf_counter() - t0) / len(todo)
+        for i, loss, result in zip(todo, simulated, results):
+            losses[i] = loss
+            summary = self._summarize(loss, *result)
+            if keys[i] is not None:
+                self._cache.put(keys[i], summary)
+            self._record(param_dicts[i], summary, wall_time)
+            self._offer_incumbent(param_dicts[i], summary, result[0])
+
+        if not self._persistent_session:
+            self.cleanup_sim()
 
-        self.add_vehicle(self._trajectories.lead_data[0], leader_name, follower=False)
-        # add the follower
-        self.add_vehicle(
-            self._trajectories.follow_data[0], follower_name, follower=True
+        return losses
+
+    def _cache_key(self, param_dict: dict) -> str:
+        blocks = self._config.Blocks
+        return cache_key(
+            leader_id=blocks.TrajectoryGenerator.leader_id,
+            follower_id=list(blocks.TrajectoryGenerator.follower_id),
+            data=self._data_digest,
+            model=self._cf_params.model,
+            sim=self._sim_key,
+            sumo=self._sumo_version,
+            seed=self._config.Metadata.get("random_seed"),
+            error=[blocks.Error.error_func, blocks.Error.method],
+            params=quantize(
+                self._to_cf_params(param_dict).values(), self._cache_decimals
+            ),
         )
 
+    def _cached(self, key: str) -> Optional[Dict[str, Any]]:
+        """The summary of an earlier evaluation, if it still answers this one"""
+        hit = self._cache.get(key)
+        if hit is None:
+            return None
+        if hit["aborted"]:
+            # only a bound. Good enough while it can't beat the best loss
+            return hit if hit["loss"] > self._abort_above() else None
+        if not hit["collision"]:
+            self._best_loss = min(self._best_loss, hit["loss"])
+        return hit
+
+    def _record(
+        self,
+        param_dict: dict,
+        summary: Dict[str, Any],
+        wall_time: float,
+        cached: bool = False,
+    ) -> None:
+        if self.trace is not None and not self.keep_trajectory:
+            self.trace.record(
+                param_dict, summary, wall_time, cached=cached, worker=self._worker
+            )
+
+    @staticmethod
+    def _summarize(
+        loss: float,
+        sim_data: VelocityData,
+        collision: bool,
+        stream: StreamingError = None,
+    ) -> Dict[str, Any]:
+        return {
+            "loss": float(loss),
+            "collision": bool(collision),
+            "aborted": bool(stream is not None and stream.aborted),
+            # simulated steps
+            "rows": stream.row if stream is not None else len(sim_data.follow_data),
+        }
+
+    def _offer_incumbent(
+        self,
+        param_dict: dict,
+        summary: Dict[str, Any],
+        sim_data: VelocityData = None,
+    ) -> None:
+        """Keep the candidate if it is the best complete evaluation so far"""
+        if self.keep_trajectory or summary["collision"] or summary["aborted"]:
+            return
+        if self._incumbent is None or summary["loss"] < self._incumbent["loss"]:
+            self._incumbent = {
+                "loss": summary["loss"],
+                "params": dict(param_dict),
+                # None for a cache hit, nothing was simulated
+                "sim_data": sim_data if self.keep_incumbent else None,
+            }
+
+    @property
+    def incumbent(self) -> Dict[str, Any]:
+        """The best complete evaluation so far (loss, params, sim_data)"""
+        return self._incumbent
+
+    def restore_incumbent(self) -> Dict[str, Any]:
+        """
+        Make the best simulated candidate the one `get_all_error` and
+        `save_best_trajectory` report. Returns its parameters, or None when
+        there is no trajectory to restore (every candidate collided or was
+        aborted, or the best one came from the cache)
+        """
+        if self._incumbent is None or self._incumbent["sim_data"] is None:
+            return None
+        self._sim_data = self._incumbent["sim_data"]
+        return self._incumbent["params"]
+
+    def run(self) -> Tuple[VelocityData, bool]:
+        return self._run_copies(self._lane_copies[:1])[0][:2]
+
+    def _abort_above(self) -> float:
+        if self._streaming_error is None or self.keep_trajectory:
+            return float("inf")
+        if self._abort_threshold is None:
+            return self._best_loss
+        return min(self._best_loss, self._abort_threshold)
+
+    def _run_copies(
+        self, lane_copies: List[LaneCopy]
+    ) -> List[Tuple[VelocityData, bool, StreamingError]]:
+        copies = range(len(lane_copies))
+        leader_names = [
+            f"leader_{int(self._sim_time)}{c.suffix}" for c in lane_copies
+        ]
+        follower_names = [
+            f"follower_{int(self._sim_time)}{c.suffix}" for c in lane_copies
+        ]
+        # which copy a vehicle belongs to
+        owner = {
+            **{name: k for k, name in enumerate(leader_names)},
+            **{name: k for k, name in enumerate(follower_names)},
+        }
+
+        for k in copies:
+            self.add_vehicle(
+                self._trajectories.lead_data[0],
+                leader_names[k],
+                follower=False,
+                lane_copy=lane_copies[k],
+            )
+            # add the follower
+            self.add_vehicle(
+                self._trajectories.follow_data[0],
+                follower_names[k],
+                follower=True,
+                lane_copy=lane_copies[k],
+            )
+
         if self._record_video:
             poi_pos = line_interpolate_point(
                 self._lane_linestring, distance=self._trajectories.follow_data[0].s + 40
@@ -181,70 +552,130 @@ class BasicRunner:
                 color=(255, 0, 0, 255),
             )
 
+        # collisions arrive with the step results instead of being polled
+        self._traci.simulation.subscribe((tc.VAR_COLLIDING_VEHICLES_IDS,))
+
         # reset the sim time
         self._sim_time = int(self._traci.simulation.getTime() * 1000)
         start_time = self._sim_time
 
-        sim_trajs = VelocityData(
-            [],
-            [],
+        sim_trajs = [
+            VelocityData.preallocated(
+                self._trajectories.max_time,
+                self._config.Blocks.SimulationConfig.step_length,
+            )
+            for _ in copies
+        ]
+        collision = [False for _ in copies]
+        streams = [
+            self._streaming_error.copy() if self._streaming_error is not None else None
+            for _ in copies
+        ]
+        # a streamed error doesn't need the trajectory, the incumbent does
+        keep = (
+            self._streaming_error is None
+            or self.keep_trajectory
+            or self.keep_incumbent
         )
+        abort_above = self._abort_above()
+        last_lead_s = [None for _ in copies]
+        last_follow_s = [None for _ in copies]
+        # the copies that are still being simulated
+        active = list(copies)
+
+        def _retire(k: int) -> None:
+            collision[k] = True
+            active.remove(k)
+
         # step the sim once top get the vehicles on the lane
         # self._traci.simulationStep()
         # self._sim_time += self._sim_step
 
-        lane = self._traci.vehicle.getLaneID(leader_name)
         removed = False
-        collision = False
         leader_nulled = False
 
-        leader_traj = deepcopy(self._trajectories.lead_data)
+        schedule = self._leader_schedule
         max_time = int(self._trajectories.max_time * 1000)
+        # the next leader sample to apply
         j = 0
+        step = 0
         while (self._sim_time - start_time) < max_time:
-            done = len(leader_traj) == 0
+            done = j == len(schedule)
+            # the copies with leader commands queued for this step
+            commanded = []
 
             if done and not removed:
-                self._traci.vehicle.unsubscribe(leader_name)
-                self._traci.vehicle.remove(leader_name)
+                for k in active:
+                    self._traci.vehicle.unsubscribe(leader_names[k])
+                    self._traci.vehicle.remove(leader_names[k])
                 removed = True
 
-            elif not removed and (
-                ((self._sim_time - start_time) - self._sim_step)
-                <= int(leader_traj[0].time * 1000)
-                < ((self._sim_time - start_time) + self._sim_step)
-            ):
+            elif not removed and schedule.step[j] <= step:
                 j += 1
-                leader = leader_traj.pop(0)
 
-                if leader.velocity is None:
+                if schedule.null[j - 1]:
                     # remove the leader
-                    self._traci.vehicle.remove(leader_name)
-                    self._traci.vehicle.unsubscribe(leader_name)
+                    for k in active:
+                        self._traci.vehicle.remove(leader_names[k])
+                        self._traci.vehicle.unsubscribe(leader_names[k])
                     leader_nulled = True
                 else:
                     if leader_nulled:
-                        self.add_vehicle(leader, leader_name, follower=False)
+                        for k in active:
+                            self.add_vehicle(
+                                self._trajectories.lead_data[j - 1],
+                                leader_names[k],
+                                follower=False,
+                                lane_copy=lane_copies[k],
+                            )
                         leader_nulled = False
-                    try:
-                        self._traci.vehicle.setSpeed(leader_name, leader.velocity)
-                        self._traci.vehicle.setPreviousSpeed(
-                            leader_name, leader.velocity
-                        )
-                        self._traci.vehicle.moveTo(leader_name, lane, leader.s)
-                    except traci.exceptions.TraCIException:
-                        print(f"Leader: {leader_name} not found")
-                        print(f"Sim time: {self._sim_time}")
-                        print(f"Leader position: {leader.s}")
-                        if not done:
-                            collision = True
-                            break
-
-            self._traci.simulationStep()
-            self._sim_time += self._sim_step
+                    # the leader commands travel with the step request below
+                    with self._backend.batched():
+                        for k in list(active):
+                            try:
+                                self._traci.vehicle.setSpeed(
+                                    leader_names[k], schedule.velocity[j - 1]
+                                )
+                                self._traci.vehicle.setPreviousSpeed(
+                                    leader_names[k], schedule.velocity[j - 1]
+                                )
+                                self._traci.vehicle.moveTo(
+                                    leader_names[k],
+                                    lane_copies[k].lane,
+                                    schedule.s[j - 1],
+                                )
+                                commanded.append(k)
+                            except self._backend.errors:
+                                print(f"Leader: {leader_names[k]} not found")
+                                print(f"Sim time: {self._sim_time}")
+                                print(f"Leader position: {schedule.s[j - 1]}")
+                                _retire(k)
+
+            if not active:
+                break
 
-            # get subscription results
-            positions = self._traci.vehicle.getAllSubscriptionResults()
+            try:
+                self._traci.simulationStep()
+                # get subscription results
+                positions = self._traci.vehicle.getAllSubscriptionResults()
+                colliding = self._traci.simulation.getSubscriptionResults().get(
+                    tc.VAR_COLLIDING_VEHICLES_IDS, ()
+                )
+            except self._backend.errors:
+                # a leader command queued with the step failed, like the
+                # unbatched command would have. There is no telling which one,
+                # so every copy that had one is scored as a collision. The
+                # step went through, but its subscription results are lost
+                positions, colliding = {}, ()
+                for k in commanded:
+                    if k in active:
+                        _retire(k)
+                # the others keep their place in the join
+                for k in active:
+                    if streams[k] is not None:
+                        streams[k].skip()
+            self._sim_time += self._sim_step
+            step += 1
 
             if self._record_video:
                 # prints(
@@ -271,95 +702,129 @@ class BasicRunner:
                         "View #0",
                         str(output_path / f"time_{int(self._sim_time / 100):03}.png"),
                     )
-                # self._traci.polygon.
-                # self._traci.poi.add(
-                #     f"leader_{int(self._sim_time)}",
-                #     poi_pos.x,
-                #     poi_pos.y,
-                #     color=(255, 0, 0, 255),
-                #     # height=50,
-                #     # width=50
-                # )
-
-            # print(f"Sim time: {self._sim_time}")
-            # print(positions)
-
-            # print(f"Sim time: {self._sim_time}")
-            # print(positions)
 
             # add the data to the VelocityData object
-            if leader_name in positions:
-                sim_trajs.lead_data.append(
-                    TimeStep(
-                        time=(self._sim_time - start_time) / 1000,
-                        velocity=positions[leader_name][tc.VAR_SPEED],
-                        s=positions[leader_name][tc.VAR_LANEPOSITION],
-                        accel=positions[leader_name][tc.VAR_ACCELERATION],
-                    )
-                )
-            with contextlib.suppress(KeyError):
-                sim_trajs.follow_data.append(
-                    TimeStep(
-                        time=(self._sim_time - start_time) / 1000,
-                        velocity=positions[follower_name][tc.VAR_SPEED],
-                        s=positions[follower_name][tc.VAR_LANEPOSITION],
-                        accel=positions[follower_name][tc.VAR_ACCELERATION],
+            elapsed = (self._sim_time - start_time) / 1000
+            for k in list(active):
+                lead = positions.get(leader_names[k])
+                follow = positions.get(follower_names[k])
+                if lead is not None:
+                    last_lead_s[k] = lead[tc.VAR_LANEPOSITION]
+                    if keep:
+                        sim_trajs[k].lead_data.push(
+                            elapsed,
+                            lead[tc.VAR_SPEED],
+                            lead[tc.VAR_LANEPOSITION],
+                            lead[tc.VAR_ACCELERATION],
+                        )
+                if follow is not None:
+                    last_follow_s[k] = follow[tc.VAR_LANEPOSITION]
+                    if keep:
+                        sim_trajs[k].follow_data.push(
+                            elapsed,
+                            follow[tc.VAR_SPEED],
+                            follow[tc.VAR_LANEPOSITION],
+                            follow[tc.VAR_ACCELERATION],
+                        )
+
+                if streams[k] is None or (lead is None and follow is None):
+                    continue
+                if lead is not None and follow is not None:
+                    streams[k].update(
+                        lead[tc.VAR_LANEPOSITION],
+                        follow[tc.VAR_LANEPOSITION],
+                        follow[tc.VAR_SPEED],
+                        follow[tc.VAR_ACCELERATION],
                     )
-                )
+                else:
+                    streams[k].skip()
+                if streams[k].lower_bound() > abort_above:
+                    # provably worse than what we already have
+                    streams[k].aborted = True
+                    active.remove(k)
 
             # check if there was a collision
-            if self._traci.simulation.getCollisions():
+            if colliding:
                 print(f"Collision at time {self._sim_time}")
-                collision = True
-                break
-
-            # if the leader is ever behind the follower, break the loop
-            if (
-                (sim_trajs.lead_data[-1].s < sim_trajs.follow_data[-1].s)
-                and not done
-                and not removed
-                and not leader_nulled
-            ):
-                print(f"Leader behind follower at time {self._sim_time}")
-                collision = True
+                collided = {owner.get(name) for name in colliding}
+                for k in list(active):
+                    if k in collided or None in collided:
+                        _retire(k)
+
+            # if the leader is ever behind the follower, stop simulating the copy
+            for k in list(active):
+                if (
+                    last_lead_s[k] is not None
+                    and last_follow_s[k] is not None
+                    and (last_lead_s[k] < last_follow_s[k])
+                    and not done
+                    and not removed
+                    and not leader_nulled
+                ):
+                    print(f"Leader behind follower at time {self._sim_time}")
+                    _retire(k)
+
+            if not active:
                 break
         self._step_counter += 1
-        return sim_trajs, collision
+        return list(zip(sim_trajs, collision, streams))
 
     def cleanup_sim(self):
-        self._traci.close()
-        self._traci = None
+        self._close_sumo()
         self._sim_time = 0
         # remove the temp file
-        os.remove(Path(self._config.Metadata.cwd) / "cf_params.add.xml")
+        if self._vtype_file is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._vtype_file)
 
     def cleanup(self):
         self.cleanup_sim()
+        if self._backend is not None:
+            self._backend.release()
+
+    def _score(
+        self,
+        sim_data: VelocityData,
+        collision: bool,
+        stream: StreamingError = None,
+    ) -> float:
+        if collision:
+            return 1e6
+
+        if stream is None:
+            loss = self._error_kernel(sim_data)
+        elif stream.aborted:
+            # the bound is all we know, and it is already worse than the best
+            return stream.lower_bound()
+        else:
+            loss = stream.value
+
+        self._best_loss = min(self._best_loss, loss)
+        return loss
 
     def float_step(
         self,
     ) -> float:
-        sim_data, collision = self.run()
+        sim_data, collision, stream = self._run_copies(self._lane_copies[:1])[0]
         self._sim_data = sim_data
-        if not collision:
-            return fast_error(
-                rw_df=self._trajectories.to_df(),
-                sim_df=sim_data.to_df(),
-                conf=self._config.Blocks.Error,
-            )
-        else:
-            return 1e6
+        loss = self._score(sim_data, collision, stream)
+        self._last_summary = self._summarize(loss, sim_data, collision, stream)
+        return loss
 
     def get_all_error(
         self,
-    ) -> Error:
-        error_metrics(
-            rw_df=self._trajectories.to_df(),
-            sim_df=self._sim_data.to_df(),
-            conf=self._config.Blocks.Error,
+    ) -> Dict[str, Any]:
+        report = self._error_kernel.report(
+            self._sim_data,
+            include_accel=self._config.Blocks.Error.get("include_accel", False),
+        )
+        # merged in one go, so that interpolations like `val` see the metrics
+        return OmegaConf.to_container(
+            OmegaConf.merge(
+                self._config.Blocks.Error, {k: float(v) for k, v in report.items()}
+            ),
+            resolve=True,
         )
-
-        return self._config.Blocks.Error
 
     def save_best_trajectory(
         self,
@@ -368,7 +833,7 @@ class BasicRunner:
 
         (
             _join_n_add_spacing(
-                self._trajectories.to_df(),
+                self._reference.df,
                 self._sim_data.to_df(),
             )
             .assign(
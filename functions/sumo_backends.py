@@ -0,0 +1,181 @@
+import platform
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple, Type
+
+import traci
+
+
+try:
+    if platform.system() != "Windows":
+        import libsumo
+
+        LIBSUMO = True
+    else:
+        raise ImportError
+except ImportError:
+    libsumo = None
+    LIBSUMO = False
+
+
+class SimulationBackend:
+    """
+    The handle the runner talks to SUMO through.
+
+    `conn` exposes the TraCI domain API (`vehicle`, `simulation`, `poi`, ...)
+    regardless of whether it is backed by a socket or by the in-process
+    library.
+    """
+
+    name: str = ""
+    errors: Tuple[Type[Exception], ...] = ()
+
+    def __init__(self) -> None:
+        self.conn = None
+        # messages exchanged with the SUMO server
+        self.round_trips = 0
+
+    @property
+    def running(self) -> bool:
+        return self.conn is not None
+
+    def start(self, cmd: List[str]) -> None:
+        raise NotImplementedError
+
+    def load(self, args: List[str]) -> None:
+        self.conn.load(args)
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def release(self) -> None:
+        """Give up any process-wide resources held by the backend"""
+        pass
+
+    @contextmanager
+    def batched(self) -> Iterator[None]:
+        """
+        Queue the commands issued inside the block and send them together
+        with the next request that needs an answer (e.g. `simulationStep`).
+        Only commands whose result is ignored may be issued inside.
+        """
+        yield
+
+
+class TraCIBackend(SimulationBackend):
+    """SUMO in a separate process, driven over a TraCI socket"""
+
+    name = "traci"
+    errors = (traci.exceptions.TraCIException, traci.exceptions.FatalTraCIError)
+
+    def __init__(self) -> None:
+        super().__init__()
+        # a random label so that many runners can live in one process
+        self.label = str(uuid.uuid4())
+
+    def start(self, cmd: List[str]) -> None:
+        traci.start(cmd, label=self.label)
+        self.conn = traci.getConnection(self.label)
+        self._wrap_send()
+        print(f"Starting SUMO with connection number {self.label}")
+
+    def _wrap_send(self) -> None:
+        # every TraCI command ends in `_sendExact`, which flushes the commands
+        # collected in `_string`/`_queue` as one message and parses the answer
+        # of each of them. Holding it back merges commands into one round trip
+        self._queueing = False
+        send = self.conn._sendExact
+
+        def _send():
+            if self._queueing:
+                return None
+            self.round_trips += 1
+            return send()
+
+        self.conn._sendExact = _send
+
+    @contextmanager
+    def batched(self) -> Iterator[None]:
+        self._queueing = True
+        try:
+            yield
+        finally:
+            self._queueing = False
+
+    def close(self) -> None:
+        try:
+            self.conn.close()
+        finally:
+            self.conn = None
+
+
+class LibsumoBackend(SimulationBackend):
+    """
+    SUMO linked into the python process. No socket round trips, but libsumo
+    holds a single simulation per process and has no gui.
+    """
+
+    name = "libsumo"
+    errors = (
+        (
+            libsumo.TraCIException,
+            getattr(libsumo, "FatalTraCIError", libsumo.TraCIException),
+        )
+        if LIBSUMO
+        else ()
+    )
+
+    # the backend owning the process-wide libsumo simulation. It is claimed
+    # on construction and held until `release`, so restarts between
+    # candidates can't be raced by another runner in the same process
+    _owner: "LibsumoBackend" = None
+
+    def __init__(self) -> None:
+        if LibsumoBackend._owner is not None:
+            raise RuntimeError("libsumo is already claimed in this process")
+        super().__init__()
+        LibsumoBackend._owner = self
+
+    @classmethod
+    def available(cls, gui: bool = False) -> bool:
+        return LIBSUMO and not gui and cls._owner is None
+
+    def start(self, cmd: List[str]) -> None:
+        if LibsumoBackend._owner is not self:
+            raise RuntimeError("libsumo is claimed by another runner in this process")
+        libsumo.start(cmd)
+        self.conn = libsumo
+
+    def close(self) -> None:
+        try:
+            libsumo.close()
+        finally:
+            self.conn = None
+
+    def release(self) -> None:
+        if self.running:
+            self.close()
+        if LibsumoBackend._owner is self:
+            LibsumoBackend._owner = None
+
+
+BACKENDS = {
+    TraCIBackend.name: TraCIBackend,
+    LibsumoBackend.name: LibsumoBackend,
+}
+
+
+def get_backend(name: str = "traci", gui: bool = False) -> SimulationBackend:
+    """
+    Build the requested backend, falling back to TraCI when libsumo is not
+    installed, a gui is requested or this process already runs a libsumo
+    simulation.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Invalid simulation backend {name}")
+
+    if name == LibsumoBackend.name and not LibsumoBackend.available(gui=gui):
+        print("libsumo is not usable here, falling back to TraCI")
+        name = TraCIBackend.name
+
+    return BACKENDS[name]()
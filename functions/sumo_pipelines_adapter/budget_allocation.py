@@ -0,0 +1,209 @@
+"""
+Sweep-level budget allocation with successive halving.
+
+Every pair first gets `min_budget` evaluations. After each rung, the pairs
+whose best loss is still improving are promoted to a budget `eta` times
+larger, at most 1/`eta` of them, until `CFOptimizeConfig.budget`. Pairs that
+early stopping ended, that only ever collided or that are shorter than
+`min_duration` are stopped where they are. Between rungs a pair waits in its
+checkpoint, so nothing is evaluated twice. Every pair is then finalized like a
+regular `sumo-pipe` run and the results are dumped to `Metadata.output`.
+
+    python -m functions.sumo_pipelines_adapter.budget_allocation \\
+        config/sumo-pipelines/sumo_pipelines.yaml config/sumo-pipelines/idm_calibration.yaml
+"""
+import argparse
+import math
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List
+
+import ray
+from omegaconf import DictConfig, OmegaConf
+
+from functions.sumo_pipelines_adapter.checkpoint import Checkpoint, read_pair_summary
+from functions.sumo_pipelines_adapter.loader_adapter import (
+    pair_config,
+    pair_overlays,
+    write_base_config,
+)
+from functions.sumo_pipelines_adapter.optimizer import dump_results, optimize
+from functions.sumo_pipelines_adapter.warm_start import FEATURE_PREFIX
+
+
+@dataclass
+class BudgetAllocation:
+    # evaluations of every pair in the first rung
+    min_budget: int = 100
+    # the budget grows by eta per rung, and at most 1/eta of the pairs go on
+    eta: int = 3
+    # relative drop of the best loss over the last rung needed to go on
+    min_improvement: float = 0.01
+    # pairs shorter than that (s) stop after the first rung
+    min_duration: float = 10.0
+
+
+def rung_budgets(min_budget: int, eta: int, max_budget: int) -> List[int]:
+    """Total evaluations of a pair at the end of each rung"""
+    budgets = [min(min_budget, max_budget)]
+    while budgets[-1] < max_budget:
+        budgets.append(min(budgets[-1] * eta, max_budget))
+    return budgets
+
+
+def recent_improvement(losses: List[float], since: int) -> float:
+    """Relative drop of the best loss over the evaluations after `since`"""
+    before = min(losses[:since], default=math.inf)
+    now = min(losses, default=math.inf)
+    if not math.isfinite(now):
+        return 0.0
+    if not math.isfinite(before):
+        return 1.0
+    return (before - now) / before if before > 0 else 0.0
+
+
+def promote(
+    progress: Dict[str, Dict[str, Any]],
+    conf: BudgetAllocation,
+    slots: int,
+) -> List[str]:
+    """The run ids of the pairs worth the next rung, most improving first"""
+    eligible = [
+        run_id
+        for run_id, p in progress.items()
+        if not p["converged"]
+        and math.isfinite(p["loss"])
+        and p[f"{FEATURE_PREFIX}duration"] >= conf.min_duration
+        and p["improvement"] >= conf.min_improvement
+    ]
+    eligible.sort(key=lambda run_id: -progress[run_id]["improvement"])
+    return eligible[:slots]
+
+
+def _run(
+    overlays: List[DictConfig],
+    opt_conf: DictConfig,
+    num_cpus: int,
+    **optimize_kwargs,
+) -> List[Dict[str, Any]]:
+    task = ray.remote(num_cpus=num_cpus)(optimize)
+    # shipped to the object store once for all tasks
+    opt_conf = ray.put(opt_conf)
+    return ray.get(
+        [task.remote(opt_conf, o, **optimize_kwargs) for o in overlays]
+    )
+
+
+def successive_halving(global_config: DictConfig) -> List[Dict[str, Any]]:
+    conf = OmegaConf.merge(
+        OmegaConf.structured(BudgetAllocation),
+        global_config.Blocks.get("BudgetAllocation", {}),
+    )
+    opt_conf = global_config.Blocks.CFOptimizeConfig
+    # pairs wait between rungs in their checkpoint
+    if opt_conf.checkpoint_interval <= 0:
+        opt_conf.checkpoint_interval = opt_conf.budget
+
+    # the overlays are what the tasks get, the full configs stay local
+    overlays = {
+        o.Metadata.run_id: o
+        for o in pair_overlays(
+            global_config.Blocks.TrajectoryGenerator,
+            "Blocks.TrajectoryGenerator",
+            write_base_config(global_config),
+        )
+    }
+    cwd = {run_id: pair_config(o).Metadata.cwd for run_id, o in overlays.items()}
+    num_cpus = max(opt_conf.parallel_runners, 1)
+
+    # pairs finished by an earlier run of the same output directory
+    results = []
+    active = []
+    for run_id in overlays:
+        summary = read_pair_summary(cwd[run_id])
+        if summary is None:
+            active.append(run_id)
+        else:
+            results.append(summary)
+
+    done: Dict[str, int] = {}
+    budgets = rung_budgets(conf.min_budget, conf.eta, opt_conf.budget)
+    for rung, budget in enumerate(budgets[:-1]):
+        progress = {}
+        for run_id, p in zip(
+            active,
+            _run(
+                [overlays[r] for r in active],
+                opt_conf,
+                num_cpus,
+                budget=budget,
+                final=False,
+            ),
+        ):
+            if not p:
+                # failed, `optimize` already printed why
+                continue
+            losses = [r["loss"] for r in Checkpoint(cwd[run_id]).history()]
+            since = budgets[rung - 1] if rung else len(losses) // 2
+            progress[run_id] = {
+                **p,
+                "improvement": recent_improvement(losses, since),
+            }
+
+        promoted = promote(progress, conf, math.ceil(len(active) / conf.eta))
+        for run_id, p in progress.items():
+            if run_id not in promoted:
+                done[run_id] = p["evaluations"]
+        print(
+            f"Rung {rung}: {len(active)} pairs at {budget} evaluations, "
+            f"{len(promoted)} promoted"
+        )
+        active = promoted
+        if not active:
+            break
+
+    # the pairs left get the full budget, the others are finalized as they are
+    if active:
+        results += _run(
+            [overlays[r] for r in active], opt_conf, num_cpus, budget=opt_conf.budget
+        )
+    for budget in sorted(set(done.values())):
+        results += _run(
+            [overlays[r] for r, b in done.items() if b == budget],
+            opt_conf,
+            num_cpus,
+            budget=budget,
+        )
+    # the rows are on disk, the finalized pairs only return receipts
+    results = [r for r in results if r]
+
+    evaluations = sum(r["evaluations"] for r in results)
+    print(
+        f"{evaluations} evaluations for {len(results)} pairs, "
+        f"{len(results) * opt_conf.budget} with a fixed budget"
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("config", nargs="+", help="merged in order, like sumo-pipe")
+    args = parser.parse_args()
+
+    if not OmegaConf.has_resolver("datetime.now"):
+        OmegaConf.register_new_resolver(
+            "datetime.now", lambda fmt: datetime.now().strftime(fmt)
+        )
+    global_config = OmegaConf.merge(*[OmegaConf.load(c) for c in args.config])
+    # every pair writes to the same, timestamped once, output directory
+    global_config.Metadata.output = str(global_config.Metadata.output)
+
+    ray.init(ignore_reinit_error=True)
+    results = successive_halving(global_config)
+    dump_results({}, global_config, results)
+
+
+if __name__ == "__main__":
+    main()
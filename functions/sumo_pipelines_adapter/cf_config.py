@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Any
+from typing import Any, Dict, List
 
 from omegaconf import DictConfig, ListConfig
 import nevergrad as ng
@@ -40,6 +40,13 @@ class CFModelParameters:
             **{k: CFModelParam.to_ng_opt(v) for k, v in cls.parameters.items()}
         )
 
+    @staticmethod
+    def sample(cls: "CFModelParameters", n: int, seed: int = 42) -> List[Dict]:
+        """`n` parameter vectors drawn from the search space"""
+        parametrization = CFModelParameters.to_ng_opt(cls)
+        parametrization.random_state.seed(seed)
+        return [parametrization.sample().kwargs for _ in range(n)]
+
     @classmethod
     def from_flat_dict(cls, d: dict):
         return cls(
@@ -47,19 +54,30 @@ class CFModelParameters:
             parameters={k: CFModelParam(val=v) for k, v in d.items()},
         )
 
-    def write_additional_file(self, f) -> None:
+    def vtype_element(self, vtype_id: str = None) -> str:
         param_string = " ".join(
             [f'{k}="{v.val}"' for k, v in self.parameters.items() if v.val is not None]
         )
-        # with open(path, "w") as f:
-        f.write(
-            f"""
-            <additional>
-                \t\t<vType id="{self.vehType}" carFollowModel="{self.model}" {param_string}/>
-            </additional>
-            """
-        )
+        return f'<vType id="{vtype_id or self.vehType}" carFollowModel="{self.model}" {param_string}/>'
+
+    def write_additional_file(self, f) -> None:
+        write_vtypes(f, [self.vtype_element()])
+
+    def values(self) -> Dict[str, Any]:
+        return {k: v.val for k, v in self.parameters.items() if v.val is not None}
 
     @property
     def vehType(self):
         return f"{self.model.upper()}_car"
+
+
+def write_vtypes(f, vtype_elements: List[str]) -> None:
+    """Write an additional file with the given vType elements"""
+    vtypes = "\n".join(f"\t\t{v}" for v in vtype_elements)
+    f.write(
+        f"""
+            <additional>
+{vtypes}
+            </additional>
+            """
+    )
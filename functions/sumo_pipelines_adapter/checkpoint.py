@@ -0,0 +1,138 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import nevergrad as ng
+
+
+# written to Metadata.cwd when a pair is done. A re-run of the same output
+# directory returns it instead of calibrating the pair again
+PAIR_SUMMARY = "pair_summary.json"
+
+
+# optimization time (s) the calls of a pair before the final one spent, see
+# `budget_allocation.py`
+SPENT_TIME = "opt_time_spent.json"
+
+
+def add_spent_time(cwd: Union[str, Path], seconds: float) -> None:
+    _write_atomic(
+        Path(cwd) / SPENT_TIME, json.dumps(spent_time(cwd) + seconds)
+    )
+
+
+def spent_time(cwd: Union[str, Path]) -> float:
+    try:
+        return float(json.loads((Path(cwd) / SPENT_TIME).read_text()))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return 0.0
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, suffix=".tmp", delete=False
+    ) as f:
+        f.write(text)
+    os.replace(f.name, path)
+
+
+def write_pair_summary(cwd: Union[str, Path], result: Dict[str, Any]) -> None:
+    _write_atomic(Path(cwd) / PAIR_SUMMARY, json.dumps(result, default=str))
+
+
+def read_pair_summary(cwd: Union[str, Path]) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads((Path(cwd) / PAIR_SUMMARY).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class Checkpoint:
+    """
+    `tell` callback that saves the optimizer of a pair every `interval`
+    evaluations to the working directory, along with the evaluations told
+    since the last save (appended to `evaluations.jsonl`). A re-run of the
+    pair picks the optimizer up from there.
+    """
+
+    STATE = "optimizer_checkpoint.pkl"
+    HISTORY = "evaluations.jsonl"
+
+    def __init__(self, working_dir: Union[str, Path], interval: int = 50) -> None:
+        self.working_dir = Path(working_dir)
+        self.interval = max(interval, 1)
+        self._pending: List[Dict[str, Any]] = []
+
+    @property
+    def state_file(self) -> Path:
+        return self.working_dir / self.STATE
+
+    @property
+    def history_file(self) -> Path:
+        return self.working_dir / self.HISTORY
+
+    def __call__(
+        self, optimizer: ng.optimizers.base.Optimizer, candidate: ng.p.Parameter, loss: float
+    ) -> None:
+        self._pending.append({"params": candidate.kwargs, "loss": float(loss)})
+        if len(self._pending) >= self.interval:
+            self.save(optimizer)
+
+    def attach(self, optimizer: ng.optimizers.base.Optimizer) -> None:
+        """
+        Make this the `tell` callback of `optimizer`. A loaded optimizer comes
+        with the checkpoint it was saved by, which would miss every
+        evaluation after the resume
+        """
+        callbacks = optimizer._callbacks.setdefault("tell", [])
+        callbacks[:] = [c for c in callbacks if not isinstance(c, Checkpoint)]
+        callbacks.append(self)
+
+    def save(self, optimizer: ng.optimizers.base.Optimizer) -> None:
+        # the history first, so it never lags the optimizer state
+        with open(self.history_file, "a") as f:
+            for record in self._pending:
+                f.write(json.dumps(record, default=float) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+        tmp = self.state_file.with_suffix(".tmp")
+        optimizer.dump(tmp)
+        os.replace(tmp, self.state_file)
+
+    def load(self) -> Optional[ng.optimizers.base.Optimizer]:
+        """The optimizer of the last save, if there is a usable one"""
+        if not self.state_file.exists():
+            return None
+        try:
+            return ng.optimizers.base.Optimizer.load(self.state_file)
+        except Exception as e:
+            print(f"Could not load {self.state_file}: {e}")
+            return None
+
+    def replay(self, optimizer: ng.optimizers.base.Optimizer) -> int:
+        """
+        Tell a fresh optimizer the saved evaluations, for when the state can't
+        be loaded. Register the callbacks after, or they see the replay too
+        """
+        history = self.history()
+        for record in history:
+            optimizer.suggest(**record["params"])
+            optimizer.tell(optimizer.ask(), record["loss"])
+        return len(history)
+
+    def history(self) -> List[Dict[str, Any]]:
+        if not self.history_file.exists():
+            return []
+        with open(self.history_file) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def best_loss(self) -> float:
+        return min((r["loss"] for r in self.history()), default=float("inf"))
+
+    def clear(self) -> None:
+        """The pair is done, only the history is kept"""
+        self.state_file.unlink(missing_ok=True)
@@ -1,25 +1,158 @@
+import functools
+import json
+import os
+import shutil
+import tempfile
+import time
 from copy import deepcopy
 from dataclasses import MISSING, dataclass
 from pathlib import Path
-from typing import Generator
-from omegaconf import OmegaConf
+from typing import Any, Callable, Dict, Generator, Optional, Tuple
+from omegaconf import DictConfig, OmegaConf
 import polars as pl
 
 from sumo_pipelines.config import PipelineConfig
 
+from functions.sumo_pipelines_adapter.scheduling import (
+    CostModel,
+    pair_durations,
+    plan,
+    write_schedule,
+)
+from functions.trajectory_loaders.trajectory_store import build_store
+
 
 @dataclass
 class TrajectoryGenerator:
     pair_file: Path
+    # pairs handed out and not finished yet (0 = no limit)
     max_queue_size: int
     trajectory_file: Path = MISSING
     db_path: Path = MISSING
     leader_id: int = MISSING
     follower_id: int = MISSING
+    # a pair handed out that long ago (s) without finishing is presumed lost
+    # (killed worker) and no longer counts against max_queue_size
+    pair_timeout: float = 4 * 3600.0
+    # fail if none of the pairs in flight started after that long (s): the
+    # executor is taking pairs before running them, and the cap can't hold
+    start_timeout: float = 300.0
+    # dispatch the longest pairs first ("lpt") or in file order ("file")
+    schedule: str = "lpt"
+    # workers the predicted makespan assumes
+    schedule_workers: int = 64
+    # wall time per recorded second of the earlier sweeps, by Metadata.name
+    cost_model: Optional[Path] = None
 
 
 TABLE_NAME = "trajectories"
 
+# the config shared by all pairs of a sweep, in Metadata.output
+BASE_CONFIG = "base_config.yaml"
+# a file per finished pair, named after its run_id, with its start and end
+DONE_DIR = "done"
+# an empty file per started pair
+STARTED_DIR = "started"
+
+
+def write_base_config(global_config: PipelineConfig) -> Path:
+    """
+    Save the config shared by every pair once, with the timestamped output
+    directory fixed. The pairs only carry what differs (see `pair_overlays`)
+    """
+    base = deepcopy(global_config)
+    base.Metadata.output = str(global_config.Metadata.output)
+    path = Path(base.Metadata.output) / BASE_CONFIG
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, suffix=".tmp", delete=False
+    ) as f:
+        OmegaConf.save(base, f)
+    os.replace(f.name, path)
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def _load_base_config(path: str) -> DictConfig:
+    # once per worker process
+    return OmegaConf.load(path)
+
+
+def pair_overlays(
+    config: TrajectoryGenerator,
+    dotpath: str,
+    base_config: Path,
+    schedule: dict = None,
+) -> Generator[DictConfig, None, None]:
+    """
+    The pairs of `pair_file`, as small overlays of the base config. In the
+    order of `schedule` if given (see `scheduling.plan`)
+    """
+    pair_df = pl.read_parquet(config.pair_file)
+    rows = pair_df.rows(named=True)
+    order = schedule["order"] if schedule else range(len(rows))
+    for i in order:
+        row = rows[i]
+        overlay = OmegaConf.create(
+            {"Metadata": {"run_id": str(i), "base_config": str(base_config)}}
+        )
+        OmegaConf.update(
+            overlay,
+            dotpath,
+            {
+                "leader_id": row["vehicle_id_leader"],
+                "follower_id": (
+                    row["vehicle_id"],
+                    row["lane"],
+                    row["lane_index"],
+                    row["other_leader"],
+                ),
+            },
+        )
+        yield overlay
+
+
+def pair_config(global_config: DictConfig) -> DictConfig:
+    """The full config of a pair, from an overlay or as it is"""
+    base_config = global_config.Metadata.get("base_config", None)
+    if base_config is None:
+        return global_config
+    return OmegaConf.merge(_load_base_config(base_config), global_config)
+
+
+def _done_marker(
+    global_config: DictConfig, marker_dir: str = DONE_DIR
+) -> Optional[Path]:
+    base_config = global_config.Metadata.get("base_config", None)
+    if base_config is None:
+        return None
+    return Path(base_config).parent / marker_dir / str(global_config.Metadata.run_id)
+
+
+def pair_task(func: Callable) -> Callable:
+    """
+    For the consumers of `trajectory_pair_generator`: expands the overlay
+    into the full config and marks the pair done however it ends, with the
+    start and end time of the task
+    """
+
+    @functools.wraps(func)
+    def wrapper(config: Any, global_config: DictConfig, *args, **kwargs):
+        marker = _done_marker(global_config)
+        start = time.time()
+        started = _done_marker(global_config, STARTED_DIR)
+        if started is not None:
+            started.parent.mkdir(parents=True, exist_ok=True)
+            started.touch()
+        try:
+            return func(config, pair_config(global_config), *args, **kwargs)
+        finally:
+            if marker is not None:
+                marker.parent.mkdir(parents=True, exist_ok=True)
+                marker.write_text(json.dumps({"start": start, "end": time.time()}))
+
+    return wrapper
+
 
 def trajectory_pair_generator(
     config: TrajectoryGenerator,
@@ -29,9 +162,6 @@ def trajectory_pair_generator(
     *args,
     **kwargs,
 ) -> Generator[PipelineConfig, None, None]:
-    # load the trajectory pair file
-    pair_df = pl.read_parquet(config.pair_file)
-
     # supress the error for missing
     try:
         if OmegaConf.select(
@@ -43,24 +173,69 @@ def trajectory_pair_generator(
     # this bad practice, but I am lazy
     except Exception as e:
         pass
-            
-    # iterate over the pairs
-    for i, row in enumerate(pair_df.iter_rows(named=True)):
-        new_conf = deepcopy(global_config)
-        OmegaConf.update(
-            new_conf,
-            f"{dotpath}.leader_id",
-            row["vehicle_id_leader"],
-        )
-        OmegaConf.update(
-            new_conf,
-            f"{dotpath}.follower_id",
-            (row["vehicle_id"], row["lane"], row["lane_index"], row["other_leader"]),
-        )
-        OmegaConf.update(
-            new_conf,
-            "Metadata.run_id",
-            str(i),
+
+    base_config = write_base_config(global_config)
+    done_dir = base_config.parent / DONE_DIR
+    # markers of an earlier run of the same output directory
+    shutil.rmtree(done_dir, ignore_errors=True)
+    shutil.rmtree(base_config.parent / STARTED_DIR, ignore_errors=True)
+
+    traj_kwargs = global_config.Blocks.TrajectoryProcessing.kwargs
+    if traj_kwargs.get("use_index", True):
+        # once, before any worker needs it
+        build_store(traj_kwargs.traj_file, traj_kwargs.get("store_dir", None))
+
+    schedule = None
+    if config.get("schedule", "file") == "lpt":
+        schedule = plan(
+            pair_durations(
+                pl.read_parquet(config.pair_file),
+                traj_kwargs.traj_file,
+                traj_kwargs.get("store_dir", None),
+                traj_kwargs.get("use_index", True),
+            ),
+            CostModel.load(config.cost_model, global_config.Metadata.name)
+            if config.get("cost_model", None)
+            else CostModel(),
+            config.get("schedule_workers", 64),
         )
+        write_schedule(base_config.parent, schedule)
 
-        yield new_conf
+    # iterate over the pairs, with at most max_queue_size of them in flight
+    pair_timeout = config.get("pair_timeout", 4 * 3600.0)
+    start_timeout = config.get("start_timeout", 300.0)
+    cap = config.max_queue_size
+    # done marker -> (started marker, when it was handed out)
+    in_flight: Dict[Path, Tuple[Path, float]] = {}
+    for overlay in pair_overlays(config, dotpath, base_config, schedule):
+        while cap > 0 and len(in_flight) >= cap:
+            now = time.time()
+            for marker, (_, since) in list(in_flight.items()):
+                if marker.exists():
+                    del in_flight[marker]
+                elif now - since > pair_timeout:
+                    print(
+                        f"Pair {marker.name} not done {pair_timeout:.0f}s after "
+                        "it was handed out, no longer counted as in flight"
+                    )
+                    del in_flight[marker]
+            if len(in_flight) < cap:
+                break
+            oldest = min(since for _, since in in_flight.values())
+            if now - oldest > start_timeout and not any(
+                started.exists() for started, _ in in_flight.values()
+            ):
+                # waiting longer would deadlock the sweep
+                raise RuntimeError(
+                    f"None of the {len(in_flight)} pairs in flight started after "
+                    f"{start_timeout:.0f}s. The executor takes pairs before "
+                    "running them, so max_queue_size can't be enforced; set it "
+                    "to 0"
+                )
+            time.sleep(0.5)
+
+        in_flight[_done_marker(overlay)] = (
+            _done_marker(overlay, STARTED_DIR),
+            time.time(),
+        )
+        yield overlay
@@ -3,17 +3,35 @@ import importlib
 import os
 from pathlib import Path
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from omegaconf import DictConfig
 
 # from ray.util.queue import Queue
-import polars as pl
 import nevergrad as ng
 
 # from sumo_pipelines.utils.queue_helpers import unpack_queue
 
 from functions.sumo import BasicRunner
 from functions.sumo_pipelines_adapter.cf_config import CFModelParameters
+from functions.sumo_pipelines_adapter.checkpoint import (
+    Checkpoint,
+    add_spent_time,
+    read_pair_summary,
+    spent_time,
+    write_pair_summary,
+)
+from functions.sumo_pipelines_adapter.loader_adapter import DONE_DIR, pair_task
+from functions.sumo_pipelines_adapter.results import compact_results, sink_results
+from functions.sumo_pipelines_adapter.scheduling import schedule_report
+from functions.sumo_pipelines_adapter.trace import OptimizationTrace
+from functions.sumo_pipelines_adapter.warm_start import (
+    load_history,
+    narrow_search_space,
+    pair_features,
+    warm_start_points,
+)
 
 
 RECORD_VIDEO = bool(os.environ.get("RECORD_VIDEO", False))
@@ -31,56 +49,250 @@ class CFOptimizeConfig:
     early_stopping: bool = True
     early_stopping_tolerance: int = 20
     seed: int = 42
+    # number of candidates simulated side by side in one SUMO run
+    batch_size: int = 1
+    # evaluations of a first optimization stage on the NumPy emulator (0 = off)
+    prescreen_budget: int = 0
+    prescreen_batch_size: int = 64
+    # best emulated candidates handed to the SUMO stage
+    prescreen_suggestions: int = 8
+    # runners (SUMO sessions) evaluating candidates of the pair concurrently
+    parallel_runners: int = 1
+    # suggest earlier results of the pair and of the k most similar pairs
+    warm_start: bool = False
+    warm_start_results: Optional[List[str]] = None
+    warm_start_k: int = 5
+    # shrink the uniform bounds to the warm start points, padded by this
+    # fraction of the range (None = keep the search space)
+    warm_start_narrow: Optional[float] = None
+    # save the optimizer to Metadata.cwd every that many evaluations (0 = off)
+    checkpoint_interval: int = 50
+    # evaluations buffered before the trace writes a parquet part
+    trace_flush_every: int = 500
+
+
+def _optimizer_cls(name: str):
+    try:
+        return ng.optimizers.registry[name]
+    except KeyError:
+        return getattr(
+            importlib.import_module("nevergrad.optimization.optimizerlib"),
+            name,
+        )
 
 
 def optimize_single(
     config: CFOptimizeConfig,
     cf_params: CFModelParameters,
-    runner: BasicRunner,
+    runner: Union[BasicRunner, List[BasicRunner]],
     working_dir: Path,
-) -> None:
-    try:
-        opt_cls = ng.optimizers.registry[config.optimization_algo]
-    except KeyError:
-        opt_cls = getattr(
-            importlib.import_module("nevergrad.optimization.optimizerlib"),
-            config.optimization_algo,
+    suggestions: List[Dict[str, Any]] = None,
+    trace: OptimizationTrace = None,
+    budget: int = None,
+    final: bool = True,
+) -> Tuple[ng.p.Parameter, int]:
+    """
+    Returns the recommendation and the number of evaluations it took. The
+    runners record their evaluations to `trace`, if given.
+
+    `budget` caps the total evaluations of the pair below `config.budget`.
+    Unless `final`, the optimizer is checkpointed at the end instead of
+    dropped, so that a later call can give the pair more budget.
+    """
+    runners = runner if isinstance(runner, list) else [runner]
+    runner = runners[0]
+
+    checkpoint = None
+    optimizer = None
+    if config.checkpoint_interval > 0:
+        checkpoint = Checkpoint(working_dir, config.checkpoint_interval)
+        optimizer = checkpoint.load()
+
+    if optimizer is not None:
+        # the callbacks and suggestions were saved with it, the checkpoint
+        # is this one
+        print(f"Resuming {working_dir} after {optimizer.num_tell} evaluations")
+        checkpoint.attach(optimizer)
+    else:
+        optimizer = _build_optimizer(config, cf_params, len(runners))
+        if checkpoint is not None and checkpoint.replay(optimizer):
+            print(f"Replayed {optimizer.num_tell} evaluations in {working_dir}")
+
+        # create the callbacks
+        if config.early_stopping:
+            # callbacks.append(ng.callbacks.EarlyStopping.no_improvement_stopper(tolerance_window=10))
+            optimizer.register_callback(
+                "ask",
+                ng.callbacks.EarlyStopping.no_improvement_stopper(
+                    tolerance_window=config.early_stopping_tolerance
+                ),
+            )
+
+        if checkpoint is not None:
+            checkpoint.attach(optimizer)
+
+        if optimizer.num_tell == 0:
+            # the suggestions are the first points asked
+            for candidate in suggestions or []:
+                optimizer.suggest(**candidate)
+
+            if config.prescreen_budget > 0:
+                for candidate in prescreen(config, cf_params, runner):
+                    optimizer.suggest(**candidate)
+
+    if checkpoint is not None:
+        # early abort against what the earlier attempt already found
+        for r in runners:
+            r._best_loss = min(r._best_loss, checkpoint.best_loss())
+
+    for r in runners:
+        r.trace = trace
+    # a resumed optimizer keeps the budget it was saved with, which is the
+    # budget of the last rung for a pair budget allocation promoted
+    optimizer.budget = (
+        config.budget if budget is None else min(budget, config.budget)
+    )
+
+    # run the optimization
+    if config.batch_size > 1 or len(runners) > 1:
+        recommendation = minimize_parallel(optimizer, runners, config.batch_size)
+    else:
+        recommendation = optimizer.minimize(
+            runner,
         )
 
+    for r in runners:
+        r.trace = None
+    if checkpoint is not None:
+        if final:
+            checkpoint.clear()
+        else:
+            checkpoint.save(optimizer)
+
+    return recommendation, optimizer.num_tell
+
+
+def _build_optimizer(
+    config: CFOptimizeConfig, cf_params: CFModelParameters, runners: int = 1
+) -> ng.optimizers.base.Optimizer:
     parameters = CFModelParameters.to_ng_opt(cf_params)
     parameters.random_state.seed(config.seed)
 
-    optimizer = opt_cls(
-        parametrization=CFModelParameters.to_ng_opt(cf_params),
+    optimizer = _optimizer_cls(config.optimization_algo)(
+        parametrization=parameters,
         budget=config.budget,
+        num_workers=config.batch_size * runners,
     )
 
-    # create the callbacks
-    if config.early_stopping:
-        # callbacks.append(ng.callbacks.EarlyStopping.no_improvement_stopper(tolerance_window=10))
-        optimizer.register_callback(
-            "ask",
-            ng.callbacks.EarlyStopping.no_improvement_stopper(
-                tolerance_window=config.early_stopping_tolerance
-            ),
-        )
+    if ("actionStepLength" in optimizer.parametrization.kwargs) and (
+        "tau" in optimizer.parametrization.kwargs
+    ):
+        optimizer.parametrization.register_cheap_constraint(actionStepLength_constraint)
 
-    logger = ng.callbacks.ParametersLogger(
-        working_dir / "optimization_dump.json", append=False
-    )
-    optimizer.register_callback("tell", logger)
+    return optimizer
+
+
+def minimize_parallel(
+    optimizer: ng.optimizers.base.Optimizer,
+    runners: List[BasicRunner],
+    batch_size: int = 1,
+) -> ng.p.Parameter:
+    """
+    Asynchronous ask/tell loop keeping one job in flight per runner. A job is
+    a single candidate, or `batch_size` of them for
+    `BasicRunner.evaluate_batch`.
+
+    The runners are driven from threads. Each talks to its own SUMO process
+    (or libsumo for one of them), so they don't share the GIL for the
+    simulation itself. Results are told as they come in, so the order of the
+    tells and the search path depend on timing when there are several
+    runners.
+    """
+
+    def _evaluate(runner: BasicRunner, candidates: List[ng.p.Parameter]):
+        if batch_size > 1:
+            return runner.evaluate_batch([c.kwargs for c in candidates])
+        return [runner(**candidates[0].kwargs)]
+
+    idle = list(runners)
+    in_flight = {}
+    stop = False
+    with ThreadPoolExecutor(max_workers=len(runners)) as pool:
+        while True:
+            while idle and not stop and optimizer.num_ask < optimizer.budget:
+                candidates = []
+                try:
+                    for _ in range(
+                        min(batch_size, optimizer.budget - optimizer.num_ask)
+                    ):
+                        candidates.append(optimizer.ask())
+                except ng.errors.NevergradEarlyStopping:
+                    stop = True
+                if not candidates:
+                    break
+                runner = idle.pop()
+                in_flight[pool.submit(_evaluate, runner, candidates)] = (
+                    runner,
+                    candidates,
+                )
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                runner, candidates = in_flight.pop(future)
+                losses = future.result()
+                for candidate, loss in zip(candidates, losses):
+                    optimizer.tell(candidate, loss)
+                idle.append(runner)
+                # every runner can abort against the best loss of the pair
+                for r in runners:
+                    r._best_loss = min(r._best_loss, *losses)
+
+    return optimizer.provide_recommendation()
+
+
+def prescreen(
+    config: CFOptimizeConfig,
+    cf_params: CFModelParameters,
+    runner: BasicRunner,
+) -> List[dict]:
+    """
+    First optimization stage on the NumPy emulator of the pair. Returns the
+    best `prescreen_suggestions` candidates, best first
+    """
+    emulator = runner.build_emulator()
 
+    parameters = CFModelParameters.to_ng_opt(cf_params)
+    parameters.random_state.seed(config.seed)
+    optimizer = _optimizer_cls(config.optimization_algo)(
+        parametrization=parameters,
+        budget=config.prescreen_budget,
+        num_workers=config.prescreen_batch_size,
+    )
     if ("actionStepLength" in optimizer.parametrization.kwargs) and (
         "tau" in optimizer.parametrization.kwargs
     ):
         optimizer.parametrization.register_cheap_constraint(actionStepLength_constraint)
 
-    # run the optimization
-    recommendation = optimizer.minimize(
-        runner,
-    )
+    evaluated = []
+    while optimizer.num_ask < optimizer.budget:
+        candidates = [
+            optimizer.ask()
+            for _ in range(
+                min(config.prescreen_batch_size, optimizer.budget - optimizer.num_ask)
+            )
+        ]
+        losses = emulator.evaluate(
+            cf_params.model, [runner.emulator_params(c.kwargs) for c in candidates]
+        )
+        for candidate, loss in zip(candidates, losses):
+            optimizer.tell(candidate, float(loss))
+            evaluated.append((float(loss), candidate.kwargs))
 
-    return recommendation
+    evaluated.sort(key=lambda x: x[0])
+    return [kwargs for _, kwargs in evaluated[: config.prescreen_suggestions]]
 
 
 # create a fail safely wrapper
@@ -97,49 +309,201 @@ def fail_safely(func):
 
 
 @fail_safely
+@pair_task
+@sink_results
 def optimize(
     config: CFOptimizeConfig,
     global_config: DictConfig,
     # queue: Queue,
     *args,
+    budget: int = None,
+    final: bool = True,
     **kwargs,
 ) -> None:
+    """
+    Calibrates one pair. `budget` and `final` are for the sweep-level budget
+    allocation (see `budget_allocation.py`): a call that isn't `final` spends
+    up to `budget` evaluations in total on the pair, checkpoints it and returns
+    its progress instead of the result.
+    """
     # build the ouptut directory
     if not Path(f"{global_config.Metadata.cwd}").exists():
         Path(f"{global_config.Metadata.cwd}").mkdir(parents=True)
 
-    # build the runner
-    runner = BasicRunner()
+    # a re-run of the same output directory skips the finished pairs
+    result = read_pair_summary(global_config.Metadata.cwd)
+    if result is not None:
+        return result
 
-    g_config = global_config
-    # run the simulation
-    runner.setup(
-        g_config,
-        record_video=RECORD_VIDEO,
-        # config.simulation_config,
+    runners = _build_runners(config, global_config)
+    try:
+        result = _calibrate(config, global_config, runners, budget, final)
+    finally:
+        # shut down the (possibly persistent) SUMO sessions
+        for r in runners:
+            r.cleanup()
+
+    if final:
+        # later pairs of the sweep warm start from it
+        write_pair_summary(global_config.Metadata.cwd, result)
+    return result
+
+
+def _build_runners(
+    config: CFOptimizeConfig, g_config: DictConfig
+) -> List[BasicRunner]:
+    """One runner (SUMO session) each. Recording needs the gui of a single one"""
+    runners = []
+    for worker in range(1 if RECORD_VIDEO else max(config.parallel_runners, 1)):
+        runner = BasicRunner()
+        runner.setup(
+            g_config,
+            record_video=RECORD_VIDEO,
+            batch_size=config.batch_size,
+            worker=worker,
+            # config.simulation_config,
+        )
+        runners.append(runner)
+    return runners
+
+
+def _calibrate(
+    config: CFOptimizeConfig,
+    g_config: DictConfig,
+    runners: List[BasicRunner],
+    budget: int = None,
+    final: bool = True,
+) -> Dict[str, Any]:
+    """Calibrates the model of `g_config` with set up runners"""
+    runner = runners[0]
+
+    features = pair_features(runner.reference)
+    cf_params = g_config.Blocks.CFModelParameters
+    suggestions = []
+    if config.warm_start:
+        suggestions = warm_start_points(
+            cf_params,
+            load_history(
+                config.warm_start_results,
+                g_config.Metadata.output,
+                model=cf_params.model,
+                # `optimize_models` calibrates in Metadata.cwd/<name>
+                model_dir=(
+                    Path(g_config.Metadata.cwd).name
+                    if "MultiModel" in g_config.Blocks
+                    else None
+                ),
+            ),
+            g_config.Blocks.TrajectoryGenerator.leader_id,
+            g_config.Blocks.TrajectoryGenerator.follower_id[0],
+            features,
+            k=config.warm_start_k,
+        )
+        if config.warm_start_narrow is not None:
+            cf_params = narrow_search_space(
+                cf_params, suggestions, config.warm_start_narrow
+            )
+
+    trace = OptimizationTrace(
+        g_config.Metadata.cwd,
+        flush_every=config.trace_flush_every,
+        leader_id=str(g_config.Blocks.TrajectoryGenerator.leader_id),
+        follower_id=str(g_config.Blocks.TrajectoryGenerator.follower_id[0]),
+        cf_model=cf_params.model,
+        run_id=g_config.Metadata.run_id,
     )
 
     t0 = time.time()
     # optimize the model
-    recommendation = optimize_single(
-        config,
-        cf_params=g_config.Blocks.CFModelParameters,
-        runner=runner,
-        working_dir=Path(f"{global_config.Metadata.cwd}"),
-    )
+    try:
+        recommendation, evaluations = optimize_single(
+            config,
+            cf_params=cf_params,
+            runner=runners,
+            working_dir=Path(f"{g_config.Metadata.cwd}"),
+            suggestions=suggestions,
+            trace=trace,
+            budget=budget,
+            final=final,
+        )
+    finally:
+        # whatever was evaluated stays on disk, even if the pair failed
+        trace.close()
     t1 = time.time()
 
-    # simulated with the best model (cause not sure if last value in model is the best)
-    runner(
-        **recommendation[1].value,
+    if not final:
+        # the final call reports the time of all of them
+        add_spent_time(g_config.Metadata.cwd, t1 - t0)
+        return {
+            "run_id": g_config.Metadata.run_id,
+            # inf while every candidate collided
+            "loss": min(r._best_loss for r in runners),
+            "evaluations": evaluations,
+            # early stopping ended it before the budget
+            "converged": evaluations < min(budget or config.budget, config.budget),
+            "opt_time": t1 - t0,
+            **features,
+        }
+
+    for other in runners[1:]:
+        runner.round_trips.extend(other.round_trips)
+
+    # report the best candidate the runners simulated, as it was scored
+    best = min(
+        (r for r in runners if r.incumbent is not None),
+        key=lambda r: r.incumbent["loss"],
+        default=runner,
     )
+    params = best.restore_incumbent()
+    if params is not None and best.incumbent["loss"] <= min(
+        r._best_loss for r in runners
+    ):
+        loss = best.incumbent["loss"]
+    else:
+        # nothing to restore, or the best candidate was found by an earlier
+        # attempt (checkpoint) and is gone. Simulate the recommendation
+        params = recommendation[1].value
+        best.keep_trajectory = True
+        loss = best(**params)
 
     # calculate the error across all metrics
-    all_errors = runner.get_all_error()
+    all_errors = best.get_all_error()
+    best.save_best_trajectory()
+
+    return {
+        **params,
+        **all_errors,
+        **{
+            "leader_id": g_config.Blocks.TrajectoryGenerator.leader_id,
+            "follower_id": g_config.Blocks.TrajectoryGenerator.follower_id[0],
+        },
+        # car following model
+        "cf_model": g_config.Blocks.CFModelParameters.model,
+        "run_id": g_config.Metadata.run_id,
+        "collision": loss > 1e3,
+        "opt_time": t1 - t0 + spent_time(g_config.Metadata.cwd),
+        "round_trips": sum(runner.round_trips) / max(len(runner.round_trips), 1),
+        # what early stopping left of the budget, to compare warm and cold starts
+        "evaluations": evaluations,
+        "budget_saved": config.budget - evaluations,
+        "warm_start_points": len(suggestions),
+        **features,
+    }
+
+
+def _evaluate_defaults(
+    runner: BasicRunner, g_config: DictConfig, param_dict: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Simulates `param_dict` once, with the full error report"""
+    runner.keep_trajectory = True
+    res = runner(**param_dict)
+
     runner.save_best_trajectory()
+    all_errors = runner.get_all_error()
+    runner.keep_trajectory = False
 
     return {
-        **recommendation[1].value,
+        **param_dict,
         **all_errors,
         **{
             "leader_id": g_config.Blocks.TrajectoryGenerator.leader_id,
@@ -148,12 +512,13 @@ def optimize(
         # car following model
         "cf_model": g_config.Blocks.CFModelParameters.model,
         "run_id": g_config.Metadata.run_id,
-        "collision": recommendation.loss > 1e3,
-        "opt_time": t1 - t0,
+        "collision": res > 1e3,
     }
 
 
 @fail_safely
+@pair_task
+@sink_results
 def dummy_optimize(
     config: CFOptimizeConfig,
     global_config: DictConfig,
@@ -170,29 +535,81 @@ def dummy_optimize(
 
     g_config = global_config
     # run the simulation
-    runner.setup(
-        g_config,
-        # config.simulation_config,
-    )
+    try:
+        runner.setup(
+            g_config,
+            # config.simulation_config,
+        )
 
-    # optimize the model
-    res = runner(**CFModelParameters.to_flat_dict(g_config.Blocks.CFModelParameters))
+        return _evaluate_defaults(
+            runner,
+            g_config,
+            CFModelParameters.to_flat_dict(g_config.Blocks.CFModelParameters),
+        )
+    finally:
+        # a failed evaluation must not leave SUMO (or the libsumo owner) behind
+        runner.cleanup()
 
-    runner.save_best_trajectory()
-    all_errors = runner.get_all_error()
 
-    return {
-        **CFModelParameters.to_flat_dict(g_config.Blocks.CFModelParameters),
-        **all_errors,
-        **{
-            "leader_id": g_config.Blocks.TrajectoryGenerator.leader_id,
-            "follower_id": g_config.Blocks.TrajectoryGenerator.follower_id[0],
-        },
-        # car following model
-        "cf_model": g_config.Blocks.CFModelParameters.model,
-        "run_id": g_config.Metadata.run_id,
-        "collision": res > 1e3,
-    }
+@fail_safely
+@pair_task
+@sink_results
+def optimize_models(
+    config: CFOptimizeConfig,
+    global_config: DictConfig,
+    # queue: Queue,
+    *args,
+    **kwargs,
+) -> List[Dict[str, Any]]:
+    """
+    Every model of `Blocks.MultiModel.models` on one pair: the SUMO defaults
+    and / or a calibration, one result row each (`mode` tells them apart).
+    The trajectories, the network and the SUMO sessions are loaded once and
+    shared by all of them. Each model works in its own `Metadata.cwd/<name>`
+    """
+    multi = global_config.Blocks.MultiModel
+    pair_cwd = Path(f"{global_config.Metadata.cwd}")
+    pair_cwd.mkdir(parents=True, exist_ok=True)
+
+    g_config = global_config
+    g_config.Blocks.CFModelParameters = next(iter(multi.models.values()))
+    runners = _build_runners(config, g_config)
+
+    results = []
+    try:
+        for name, cf_params in multi.models.items():
+            g_config.Blocks.CFModelParameters = cf_params
+
+            if multi.get("defaults", True):
+                g_config.Metadata.cwd = str(pair_cwd / name / "defaults")
+                Path(g_config.Metadata.cwd).mkdir(parents=True, exist_ok=True)
+                for r in runners:
+                    r.set_model(cf_params, g_config.Metadata.cwd)
+                results.append(
+                    {
+                        **_evaluate_defaults(
+                            runners[0],
+                            g_config,
+                            {k: None for k in cf_params.parameters},
+                        ),
+                        "mode": "defaults",
+                    }
+                )
+
+            if multi.get("calibrate", True):
+                g_config.Metadata.cwd = str(pair_cwd / name)
+                result = read_pair_summary(g_config.Metadata.cwd)
+                if result is None:
+                    for r in runners:
+                        r.set_model(cf_params, g_config.Metadata.cwd)
+                    result = _calibrate(config, g_config, runners)
+                    write_pair_summary(g_config.Metadata.cwd, result)
+                results.append({**result, "mode": "calibration"})
+    finally:
+        for r in runners:
+            r.cleanup()
+
+    return results
 
 
 def dump_results(
@@ -200,15 +617,17 @@ def dump_results(
     global_config,
     results,
 ):
-    if len(results) == 0:
-        return
-
-    if not Path(f"{global_config.Metadata.output}").exists():
-        Path(f"{global_config.Metadata.output}").mkdir(parents=True)
-
-    # print(len(my_results)
-
-    # print(my_results)
-    pl.DataFrame([r for r in results if r is not None]).write_parquet(
-        f"{global_config.Metadata.output}/results.parquet"
+    """
+    The workers already wrote their rows under `Metadata.output/results`.
+    Merge them, with any `results` they had not flushed yet, into
+    `results.parquet`, and report the makespan of the sweep against the
+    one its schedule predicted
+    """
+    compact_results(global_config, results)
+    output = Path(global_config.Metadata.output)
+    schedule_report(
+        output,
+        output / DONE_DIR,
+        global_config.Blocks.TrajectoryGenerator.get("cost_model", None),
+        global_config.Metadata.name,
     )
@@ -0,0 +1,265 @@
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Union
+
+import polars as pl
+from omegaconf import DictConfig, OmegaConf
+
+from functions.error_metrics import report_names
+from functions.sumo_pipelines_adapter.warm_start import FEATURE_NAMES, FEATURE_PREFIX
+
+
+# the compacted table of a sweep, in Metadata.output
+RESULTS_FILE = "results.parquet"
+# parts written by the workers while the sweep runs
+RESULTS_PARTS = "results"
+# a result row is one model (and mode) of one pair
+RESULT_KEYS = ["run_id", "cf_model", "mode"]
+# the rows a `receipt` stands for
+RECEIPT_ROWS = "result_rows"
+
+# the run metadata columns of a result row. The ids take the dtype of the
+# pair file, see `_id_columns`
+_RUN_COLUMNS = {
+    "cf_model": pl.Utf8,
+    "run_id": pl.Utf8,
+    "mode": pl.Utf8,
+    "collision": pl.Boolean,
+    "opt_time": pl.Float64,
+    "round_trips": pl.Float64,
+    "evaluations": pl.Int64,
+    "budget_saved": pl.Int64,
+    "warm_start_points": pl.Int64,
+    **{f"{FEATURE_PREFIX}{name}": pl.Float64 for name in FEATURE_NAMES},
+}
+
+# the sinks opened in this process, by output directory
+_SINKS: Dict[Path, "ResultSink"] = {}
+
+
+# the column of the pair file each id is taken from
+_ID_SOURCES = {"leader_id": "vehicle_id_leader", "follower_id": "vehicle_id"}
+
+
+def _id_columns(global_config: DictConfig) -> Dict[str, pl.DataType]:
+    """
+    `leader_id` and `follower_id` as the pair file stores them, like the
+    results written before the sink. Strings if it can't be read
+    """
+    pair_file = OmegaConf.select(global_config, "Blocks.TrajectoryGenerator.pair_file")
+    try:
+        source = pl.read_parquet_schema(pair_file)
+    except Exception:
+        source = {}
+    columns = {}
+    for name, source_name in _ID_SOURCES.items():
+        dtype = source.get(source_name)
+        columns[name] = (
+            dtype
+            if dtype is not None and (dtype.is_integer() or dtype.is_float())
+            else pl.Utf8
+        )
+    return columns
+
+
+def result_schema(global_config: DictConfig) -> Dict[str, pl.DataType]:
+    """
+    The columns of a result row: the model parameters, the `Error` block
+    with every metric, and the run metadata. Anything else a row holds goes
+    to the `extra` json column
+    """
+    blocks = global_config.Blocks
+    models = (
+        list(blocks.MultiModel.models.values())
+        if "MultiModel" in blocks
+        else [blocks.CFModelParameters]
+    )
+    schema = {
+        name: pl.Float64 for model in models for name in model.parameters
+    }
+
+    metrics = set(report_names())
+    for key, value in OmegaConf.to_container(blocks.Error, resolve=False).items():
+        if key in metrics or key == "val" or value is None:
+            schema[key] = pl.Float64
+        elif isinstance(value, bool):
+            schema[key] = pl.Boolean
+        elif isinstance(value, (int, float)):
+            schema[key] = pl.Float64
+        else:
+            schema[key] = pl.Utf8
+    schema.update({name: pl.Float64 for name in report_names()})
+
+    schema.update(_id_columns(global_config))
+    schema.update(_RUN_COLUMNS)
+    schema["extra"] = pl.Utf8
+    return schema
+
+
+def _conform(row: Dict[str, Any], schema: Dict[str, pl.DataType]) -> Dict[str, Any]:
+    out = {}
+    for name, dtype in schema.items():
+        value = row.get(name)
+        if value is None or name == "extra":
+            out[name] = None
+        elif dtype == pl.Utf8:
+            out[name] = str(value)
+        elif dtype == pl.Boolean:
+            out[name] = bool(value)
+        elif dtype.is_integer():
+            out[name] = int(value)
+        else:
+            out[name] = float(value)
+    extra = {k: v for k, v in row.items() if k not in schema}
+    out["extra"] = json.dumps(extra, default=str) if extra else None
+    return out
+
+
+def _rows(results: List[Any]) -> List[Dict[str, Any]]:
+    # `optimize_models` returns the rows of all models of a pair. Receipts
+    # stand for rows already written
+    return [
+        row
+        for r in results
+        if r is not None
+        for row in (r if isinstance(r, list) else [r])
+        if row and RECEIPT_ROWS not in row
+    ]
+
+
+class ResultSink:
+    """
+    Result rows of the pairs a worker process finishes. The rows of each pair
+    are written as a parquet part under `Metadata.output/results` as soon as
+    the pair is done, so nothing waits in memory for the next pair or for the
+    process to exit. `compact_results` merges the parts into
+    `results.parquet`.
+    """
+
+    def __init__(
+        self,
+        output_dir: Union[str, Path],
+        schema: Dict[str, pl.DataType],
+    ) -> None:
+        self.parts_dir = Path(output_dir) / RESULTS_PARTS
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+        self.schema = schema
+        self._lock = threading.Lock()
+        # pids get reused, and a resumed sweep writes to the same directory
+        self._prefix = (
+            f"part-{socket.gethostname()}-{os.getpid()}-{int(time.time() * 1000)}"
+        )
+        self._parts = 0
+
+    @classmethod
+    def shared(cls, global_config: DictConfig) -> "ResultSink":
+        """The sink of the sweep of `global_config`, opened once per process"""
+        output_dir = Path(global_config.Metadata.output)
+        if output_dir not in _SINKS:
+            _SINKS[output_dir] = cls(output_dir, result_schema(global_config))
+        return _SINKS[output_dir]
+
+    def write(self, rows: List[Dict[str, Any]]) -> Path:
+        """Write `rows` as one part, returns its path"""
+        with self._lock:
+            path = self.parts_dir / f"{self._prefix}-{self._parts:05d}.parquet"
+            self._parts += 1
+        tmp = path.with_suffix(".tmp")
+        pl.DataFrame(
+            [_conform(r, self.schema) for r in rows], schema=self.schema
+        ).write_parquet(tmp)
+        os.replace(tmp, path)
+        return path
+
+
+def receipt(rows: List[Dict[str, Any]], part: Path) -> Dict[str, Any]:
+    """
+    What a consumer hands back to the driver instead of its rows: enough to
+    count them, and the evaluations the budget allocation reports
+    """
+    return {
+        "run_id": rows[0].get("run_id"),
+        RECEIPT_ROWS: len(rows),
+        "part": part.name,
+        "evaluations": sum(r.get("evaluations") or 0 for r in rows),
+    }
+
+
+def sink_results(func: Callable) -> Callable:
+    """
+    Writes the rows a consumer returns to the `ResultSink` of its sweep, and
+    returns a `receipt` for them
+    """
+
+    @functools.wraps(func)
+    def wrapper(config: Any, global_config: DictConfig, *args, **kwargs):
+        result = func(config, global_config, *args, **kwargs)
+        # the progress of a budget allocation rung is not a result
+        if not kwargs.get("final", True):
+            return result
+        rows = _rows([result])
+        if not rows:
+            return result
+        return receipt(rows, ResultSink.shared(global_config).write(rows))
+
+    return wrapper
+
+
+def _part_files(output_dir: Path) -> List[Path]:
+    return sorted(
+        (output_dir / RESULTS_PARTS).glob("part-*.parquet"),
+        key=lambda p: p.stat().st_mtime,
+    )
+
+
+def read_results(output_dir: Union[str, Path], lazy: bool = False):
+    """
+    The results of a sweep as one frame: the compacted table and the parts
+    written since, one row per pair, model and mode (the latest one)
+    """
+    output_dir = Path(output_dir)
+    files = [output_dir / RESULTS_FILE] if (output_dir / RESULTS_FILE).exists() else []
+    files += _part_files(output_dir)
+    if not files:
+        return pl.LazyFrame() if lazy else pl.DataFrame()
+    frame = pl.concat(
+        [pl.scan_parquet(f) for f in files], how="diagonal_relaxed"
+    ).unique(subset=RESULT_KEYS, keep="last", maintain_order=True)
+    return frame if lazy else frame.collect()
+
+
+def compact_results(global_config: DictConfig, results: List[Any] = None) -> pl.DataFrame:
+    """
+    Merge the parts (and the full rows among `results`, receipts are
+    skipped) into `results.parquet`, then drop the merged parts
+    """
+    output_dir = Path(global_config.Metadata.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    parts = _part_files(output_dir)
+
+    frames = [read_results(output_dir)]
+    rows = _rows(results or [])
+    if rows:
+        schema = result_schema(global_config)
+        frames.append(
+            pl.DataFrame([_conform(r, schema) for r in rows], schema=schema)
+        )
+    frames = [f for f in frames if not f.is_empty()]
+    if not frames:
+        return pl.DataFrame()
+    df = pl.concat(frames, how="diagonal_relaxed").unique(
+        subset=RESULT_KEYS, keep="last", maintain_order=True
+    )
+
+    path = output_dir / RESULTS_FILE
+    tmp = path.with_suffix(".tmp")
+    df.write_parquet(tmp)
+    os.replace(tmp, path)
+    for p in parts:
+        p.unlink()
+    return df
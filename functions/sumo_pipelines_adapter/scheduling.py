@@ -0,0 +1,184 @@
+"""
+Cost-aware dispatch of the pairs of a sweep.
+
+The evaluation cost of a pair scales with its recorded duration. The producer
+estimates every pair's wall time from the trajectory store index (or the
+trajectory parquet) and a cost model fit on earlier sweeps. It dispatches the
+pairs longest first (LPT), so that no long pair starts last. The predicted
+makespan is saved with the schedule. At the end of the sweep it is reported next to the
+actual one, and the cost model is refit.
+"""
+import heapq
+import json
+import math
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import polars as pl
+
+from functions.trajectory_loaders.trajectory_store import (
+    DURATION,
+    KEY_COLUMNS,
+    build_store,
+    read_index,
+    source_stamp,
+)
+
+
+# in Metadata.output
+SCHEDULE = "schedule.json"
+SCHEDULE_REPORT = "schedule_report.json"
+
+
+@dataclass
+class CostModel:
+    """Wall time of a pair task as `intercept + slope * duration` (seconds)"""
+
+    intercept: float = 0.0
+    slope: float = 1.0
+    # False until fit on a sweep, costs are then only relative
+    calibrated: bool = False
+
+    @classmethod
+    def load(cls, path: Union[str, Path], name: str) -> "CostModel":
+        """The model of the sweeps called `name`, if there is one"""
+        try:
+            return cls(**json.loads(Path(path).read_text())[name])
+        except (FileNotFoundError, KeyError, json.JSONDecodeError, TypeError):
+            return cls()
+
+    def save(self, path: Union[str, Path], name: str) -> None:
+        path = Path(path)
+        try:
+            models = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            models = {}
+        models[name] = asdict(self)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(models, indent=2))
+
+    @classmethod
+    def fit(cls, durations: np.ndarray, times: np.ndarray) -> "CostModel":
+        if len(durations) < 2 or np.ptp(durations) == 0:
+            return cls(float(np.mean(times)) if len(times) else 0.0, 0.0, True)
+        slope, intercept = np.polyfit(durations, times, 1)
+        return cls(float(intercept), float(slope), True)
+
+    def __call__(self, durations: np.ndarray) -> np.ndarray:
+        return np.maximum(self.intercept + self.slope * durations, 0.0)
+
+
+def pair_durations(
+    pair_df: pl.DataFrame,
+    traj_file: Union[str, Path],
+    store_dir: Union[str, Path] = None,
+    use_index: bool = True,
+) -> np.ndarray:
+    """
+    Recorded seconds of every pair of `pair_df`, from the index of the
+    trajectory store. Older indexes only have the row count. Without
+    `use_index`, from a scan of `traj_file`
+    """
+    if use_index:
+        index = read_index(build_store(traj_file, store_dir), source_stamp(traj_file))
+    else:
+        index = (
+            pl.scan_parquet(traj_file).group_by(*KEY_COLUMNS).agg(DURATION).collect()
+        )
+    column = "duration" if "duration" in index.columns else "length"
+    return (
+        pair_df.with_row_index("_row")
+        .join(index.select(*KEY_COLUMNS, column), on=list(KEY_COLUMNS), how="left")
+        .sort("_row")[column]
+        .fill_null(0)
+        .cast(pl.Float64)
+        .to_numpy()
+    )
+
+
+def lpt_makespan(costs: List[float], workers: int) -> float:
+    """Makespan of list scheduling `costs` in the given order on `workers`"""
+    loads = [0.0] * max(workers, 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def plan(
+    durations: np.ndarray,
+    cost_model: CostModel,
+    workers: int,
+) -> Dict[str, Any]:
+    """The dispatch order (row indices, longest first) and the predicted makespan"""
+    costs = cost_model(durations)
+    order = np.argsort(-costs, kind="stable")
+
+    return {
+        "order": order.tolist(),
+        "cost": costs.tolist(),
+        "duration": durations.tolist(),
+        "workers": workers,
+        "predicted_makespan": lpt_makespan(costs[order].tolist(), workers),
+        "calibrated": cost_model.calibrated,
+    }
+
+
+def write_schedule(output_dir: Union[str, Path], schedule: Dict[str, Any]) -> None:
+    (Path(output_dir) / SCHEDULE).write_text(json.dumps(schedule))
+
+
+def schedule_report(
+    output_dir: Union[str, Path],
+    done_dir: Union[str, Path],
+    cost_model_file: Union[str, Path] = None,
+    name: str = None,
+) -> Dict[str, Any]:
+    """
+    The predicted and actual makespan of a sweep. The actual one spans the
+    first start to the last end of the pair tasks. The cost model of `name`
+    is refit on the pair tasks
+    """
+    output_dir = Path(output_dir)
+    try:
+        schedule = json.loads((output_dir / SCHEDULE).read_text())
+    except FileNotFoundError:
+        return {}
+
+    spans = {}
+    for marker in Path(done_dir).glob("*"):
+        try:
+            spans[marker.name] = json.loads(marker.read_text())
+        except json.JSONDecodeError:
+            continue
+    if not spans:
+        return {}
+
+    report = {
+        "predicted_makespan": schedule["predicted_makespan"],
+        "actual_makespan": max(s["end"] for s in spans.values())
+        - min(s["start"] for s in spans.values()),
+        "calibrated": schedule["calibrated"],
+        "workers": schedule["workers"],
+        "pairs": len(spans),
+    }
+
+    tasks = [
+        (schedule["duration"][int(run_id)], s["end"] - s["start"])
+        for run_id, s in spans.items()
+        if run_id.isdigit() and int(run_id) < len(schedule["duration"])
+    ]
+    if cost_model_file is not None and name is not None and tasks:
+        durations, times = map(np.array, zip(*tasks))
+        model = CostModel.fit(durations, times)
+        model.save(cost_model_file, name)
+        report["cost_model"] = asdict(model)
+
+    (output_dir / SCHEDULE_REPORT).write_text(json.dumps(report, indent=2))
+    print(
+        f"Makespan: predicted {report['predicted_makespan']:.0f}"
+        f"{'s' if report['calibrated'] else ' (uncalibrated units)'}, "
+        f"actual {report['actual_makespan']:.0f}s over {report['pairs']} pairs"
+    )
+    return report
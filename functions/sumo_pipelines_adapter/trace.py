@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import polars as pl
+
+
+# the trace of a finished pair, in its Metadata.cwd
+TRACE_FILE = "optimization_trace.parquet"
+# parts flushed while the pair runs, merged into TRACE_FILE on close
+TRACE_PART = "optimization_trace.part-{:05d}.parquet"
+TRACE_PART_GLOB = "optimization_trace.part-*.parquet"
+
+# why an evaluation did not produce a full error
+ABORT_COLLISION = "collision"
+ABORT_EARLY = "early_abort"
+
+
+def abort_reason(summary: Dict[str, Any]) -> Optional[str]:
+    """The abort reason of a `BasicRunner._summarize` record"""
+    if summary["collision"]:
+        return ABORT_COLLISION
+    if summary["aborted"]:
+        return ABORT_EARLY
+    return None
+
+
+class OptimizationTrace:
+    """
+    Every evaluation of a pair: the parameters, the loss, the wall time and
+    why it was aborted, if it was. Records are buffered in memory and written
+    `flush_every` at a time as parquet parts, which `close` merges into a
+    single file. The runners of a pair share one trace across threads.
+    """
+
+    def __init__(
+        self,
+        working_dir: Union[str, Path],
+        flush_every: int = 500,
+        **pair: Any,
+    ) -> None:
+        self.working_dir = Path(working_dir)
+        self.flush_every = max(flush_every, 1)
+        # constant columns (leader_id, cf_model, ...) so that the traces of
+        # a sweep can be concatenated as they are
+        self.pair = pair
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._t0 = time.time()
+        # a resumed pair keeps the records of the earlier attempt, and
+        # numbers its evaluations after them
+        self._parts = len(self._part_files())
+        self._count = sum(
+            pl.scan_parquet(f).select(pl.len()).collect().item()
+            for f in self._files()
+        )
+
+    def _part_files(self) -> List[Path]:
+        return sorted(self.working_dir.glob(TRACE_PART_GLOB))
+
+    def _files(self) -> List[Path]:
+        path = self.working_dir / TRACE_FILE
+        return ([path] if path.exists() else []) + self._part_files()
+
+    def record(
+        self,
+        params: Dict[str, Any],
+        summary: Dict[str, Any],
+        wall_time: float,
+        cached: bool = False,
+        worker: int = 0,
+    ) -> None:
+        record = {
+            **params,
+            "loss": summary["loss"],
+            "abort_reason": abort_reason(summary),
+            "cached": cached,
+            "wall_time": wall_time,
+            "elapsed": time.time() - self._t0,
+            "rows": summary.get("rows"),
+            "worker": worker,
+        }
+        with self._lock:
+            record["evaluation"] = self._count
+            self._count += 1
+            self._buffer.append(record)
+            if len(self._buffer) >= self.flush_every:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        df = pl.DataFrame(self._buffer, infer_schema_length=None).with_columns(
+            [pl.lit(v).alias(k) for k, v in self.pair.items()]
+        )
+        path = self.working_dir / TRACE_PART.format(self._parts)
+        tmp = path.with_suffix(".tmp")
+        df.write_parquet(tmp)
+        os.replace(tmp, path)
+        self._parts += 1
+        self._buffer = []
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        """Write what is left and merge the parts into TRACE_FILE"""
+        with self._lock:
+            self._flush()
+            parts = self._part_files()
+            if not parts:
+                return
+            frames = [pl.read_parquet(f) for f in self._files()]
+            path = self.working_dir / TRACE_FILE
+            tmp = path.with_suffix(".tmp")
+            pl.concat(frames, how="diagonal_relaxed").write_parquet(tmp)
+            os.replace(tmp, path)
+            for p in parts:
+                p.unlink()
+
+
+def read_traces(
+    output_dir: Union[str, Path], lazy: bool = False, model: str = None
+):
+    """
+    The traces of every pair of a sweep in one frame, the parts of pairs
+    still running included. A multi-model sweep keeps the trace of a model
+    in `<run_id>/<model_dir>`, the `cf_model` column tells them apart. With
+    `model`, only the traces of that car-following model
+    """
+    output_dir = Path(output_dir)
+    files = [
+        f
+        for pattern in (TRACE_FILE, TRACE_PART_GLOB)
+        for depth in ("*", "*/*")
+        for f in sorted(output_dir.glob(f"{depth}/{pattern}"))
+    ]
+    if not files:
+        return pl.LazyFrame() if lazy else pl.DataFrame()
+    frame = pl.concat([pl.scan_parquet(f) for f in files], how="diagonal_relaxed")
+    if "cf_model" not in frame.collect_schema().names():
+        frame = frame.with_columns(pl.lit(None, dtype=pl.Utf8).alias("cf_model"))
+    if model is not None:
+        frame = frame.filter(pl.col("cf_model") == model)
+    return frame if lazy else frame.collect()
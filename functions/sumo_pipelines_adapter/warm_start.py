@@ -0,0 +1,146 @@
+import json
+from copy import deepcopy
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import polars as pl
+from omegaconf import DictConfig
+
+from functions.sumo_pipelines_adapter.cf_config import CFModelParameters
+from functions.sumo_pipelines_adapter.checkpoint import PAIR_SUMMARY
+from functions.trajectory_loaders.trajectory import ReferenceArrays
+
+
+# result columns holding the trajectory features of the pair
+FEATURE_PREFIX = "feature_"
+FEATURE_NAMES = (
+    "duration",
+    "velocity_mean",
+    "velocity_std",
+    "spacing_mean",
+    "spacing_std",
+    "accel_std",
+)
+
+
+def pair_features(reference: ReferenceArrays) -> Dict[str, float]:
+    """A few numbers describing the recorded pair, to find similar ones"""
+    valid = reference.valid
+    return {
+        f"{FEATURE_PREFIX}duration": float(
+            reference.time[valid][-1] - reference.time[valid][0]
+        )
+        if valid.any()
+        else 0.0,
+        f"{FEATURE_PREFIX}velocity_mean": float(np.mean(reference.velocity[valid])),
+        f"{FEATURE_PREFIX}velocity_std": float(np.std(reference.velocity[valid])),
+        f"{FEATURE_PREFIX}spacing_mean": float(np.mean(reference.spacing[valid])),
+        f"{FEATURE_PREFIX}spacing_std": float(np.std(reference.spacing[valid])),
+        f"{FEATURE_PREFIX}accel_std": float(np.std(reference.accel[valid])),
+    }
+
+
+def load_history(
+    results_files: List[Union[str, Path]] = None,
+    output_dir: Union[str, Path] = None,
+    model: str = None,
+    model_dir: str = None,
+) -> pl.DataFrame:
+    """
+    Earlier results: the given results parquet files plus the pairs already
+    finished in `output_dir` (the current sweep). A multi-model sweep keeps
+    the summaries of a model in `<run_id>/<model_dir>`. With `model`, only
+    the results of that car-following model
+    """
+    frames = [pl.read_parquet(f) for f in results_files or [] if Path(f).exists()]
+    if output_dir is not None:
+        pattern = f"*/{model_dir}/{PAIR_SUMMARY}" if model_dir else f"*/{PAIR_SUMMARY}"
+        summaries = [json.loads(p.read_text()) for p in Path(output_dir).glob(pattern)]
+        if summaries:
+            frames.append(pl.DataFrame(summaries, infer_schema_length=None))
+    if not frames:
+        return pl.DataFrame()
+    history = pl.concat(frames, how="diagonal_relaxed")
+    if model is not None and "cf_model" in history.columns:
+        history = history.filter(pl.col("cf_model") == model)
+    return history
+
+
+def _fit(value: Any, param: DictConfig) -> Any:
+    """`value` moved inside the search space of `param`"""
+    if param.search_space == "uniform":
+        return float(np.clip(value, param.args[0], param.args[1]))
+    # the closest choice
+    return min(param.args, key=lambda c: abs(c - value))
+
+
+def warm_start_points(
+    cf_params: CFModelParameters,
+    history: pl.DataFrame,
+    leader_id: Any,
+    follower_id: Any,
+    features: Dict[str, float],
+    k: int = 5,
+) -> List[Dict[str, Any]]:
+    """
+    Parameter sets to suggest to the optimizer: earlier results of the same
+    pair first, then those of the `k` pairs with the closest features
+    """
+    names = [
+        n for n, p in cf_params.parameters.items() if p.get("search_space") is not None
+    ]
+    if history.is_empty() or not set(names) <= set(history.columns):
+        return []
+
+    history = history.filter(pl.col("cf_model") == cf_params.model)
+    if "collision" in history.columns:
+        history = history.filter(~pl.col("collision").fill_null(False))
+    history = history.drop_nulls(names)
+
+    same_pair = (pl.col("leader_id").cast(pl.Utf8) == str(leader_id)) & (
+        pl.col("follower_id").cast(pl.Utf8) == str(follower_id)
+    )
+    rows = history.filter(same_pair).select(names).to_dicts()
+
+    feature_cols = [c for c in features if c in history.columns]
+    others = history.filter(~same_pair).drop_nulls(feature_cols)
+    if feature_cols and len(others):
+        x = others.select(feature_cols).to_numpy().astype(np.float64)
+        scale = np.where(x.std(axis=0) > 0, x.std(axis=0), 1.0)
+        target = np.array([features[c] for c in feature_cols])
+        distance = np.linalg.norm((x - target) / scale, axis=1)
+        nearest = np.argsort(distance)[:k]
+        rows.extend(others.select(names)[nearest.tolist()].to_dicts())
+
+    points, seen = [], set()
+    for row in rows:
+        point = {n: _fit(row[n], cf_params.parameters[n]) for n in names}
+        key = tuple(point.values())
+        if key not in seen:
+            seen.add(key)
+            points.append(point)
+    return points
+
+
+def narrow_search_space(
+    cf_params: CFModelParameters, points: List[Dict[str, Any]], margin: float = 0.25
+) -> CFModelParameters:
+    """
+    The uniform bounds shrunk to the span of `points`, widened by `margin`
+    times the original range and kept inside the original bounds
+    """
+    cf_params = deepcopy(cf_params)
+    if not points:
+        return cf_params
+    for name, param in cf_params.parameters.items():
+        if param.get("search_space") != "uniform" or name not in points[0]:
+            continue
+        lower, upper = param.args[0], param.args[1]
+        values = [p[name] for p in points]
+        pad = margin * (upper - lower)
+        param.args = [
+            max(lower, min(values) - pad),
+            min(upper, max(values) + pad),
+        ]
+    return cf_params
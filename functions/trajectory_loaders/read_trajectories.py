@@ -1,7 +1,12 @@
 from pathlib import Path
 from typing import List, Union
 import polars as pl
-from functions.trajectory_loaders.trajectory import TimeStep, VelocityData
+from functions.trajectory_loaders.trajectory import (
+    TimeStep,
+    TimeStepArray,
+    VelocityData,
+)
+from functions.trajectory_loaders.trajectory_store import TrajectoryStore
 
 
 def database_loader(
@@ -9,18 +14,28 @@ def database_loader(
     follower_id: Union[int, List[int]],
     leader_id: int,
     step_length: int = 0.1,
+    use_index: bool = True,
+    store_dir: Union[Path, str] = None,
 ) -> pl.DataFrame:
-    traj_df = (
-        pl.scan_parquet(traj_file)
-        .filter(
+    if use_index and not isinstance(traj_file, pl.DataFrame):
+        # slice the pair out of the memory-mapped, key-sorted copy of the file
+        pair_df = TrajectoryStore.open(traj_file, store_dir).get(
+            follower_id, leader_id
+        )
+    else:
+        pair_df = (
+            traj_file.lazy()
+            if isinstance(traj_file, pl.DataFrame)
+            else pl.scan_parquet(traj_file)
+        ).filter(
             (pl.col("vehicle_id") == follower_id[0])
             & (pl.col("lane") == follower_id[1])
             & (pl.col("lane_index") == follower_id[2])
             & (pl.col("vehicle_id_leader") == leader_id)
             & (pl.col("other_leader") == follower_id[3])
         )
-        .sort("epoch_time", "front_s_smooth")
-    )
+
+    traj_df = pair_df.lazy().sort("epoch_time", "front_s_smooth")
 
     interest_df = (
         traj_df.with_columns(
@@ -53,25 +68,15 @@ def database_loader(
 
     # fill the nulls in the leader column with
 
-    def build_traj(ext: str = "") -> List[TimeStep]:
-        return [
-            TimeStep(
-                time=t["sim_time"],
-                velocity=t[f"s_velocity_smooth{ext}_filtered"],
-                s=t[f"front_s_smooth{ext}"],
-                length=t.get(f"length_s{ext}", 0.0),
-                accel=t[f"s_velocity_smooth{ext}_filtered_diff"],
-            )
-            for t in interest_df[
-                [
-                    "sim_time",
-                    f"front_s_smooth{ext}",
-                    f"s_velocity_smooth{ext}_filtered",
-                    f"length_s{ext}",
-                    f"s_velocity_smooth{ext}_filtered_diff",
-                ]
-            ].to_dicts()
-        ]
+    def build_traj(ext: str = "") -> TimeStepArray:
+        # the columns go straight into the buffers, no per-row objects
+        return TimeStepArray.from_columns(
+            time=interest_df["sim_time"].to_numpy(),
+            velocity=interest_df[f"s_velocity_smooth{ext}_filtered"].to_numpy(),
+            s=interest_df[f"front_s_smooth{ext}"].to_numpy(),
+            length=interest_df[f"length_s{ext}"].to_numpy(),
+            accel=interest_df[f"s_velocity_smooth{ext}_filtered_diff"].to_numpy(),
+        )
 
     return VelocityData(
         lead_data=build_traj("_leader"),
@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
-from dataclasses import dataclass
-from typing import List, Tuple
+import polars as pl
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple, Union
 
 
 @dataclass
@@ -12,11 +14,146 @@ class TimeStep:
     accel: float = None
 
 
+class TimeStepArray:
+    """
+    Struct-of-arrays counterpart of a `List[TimeStep]`, backed by preallocated
+    NumPy buffers. Indexing and iteration yield `TimeStep` objects, so code
+    written against the list version keeps working.
+    """
+
+    FIELDS = ("time", "velocity", "s", "accel", "length")
+
+    def __init__(self, capacity: int = 0) -> None:
+        self._time = np.full(capacity, np.nan)
+        self._velocity = np.full(capacity, np.nan)
+        self._s = np.full(capacity, np.nan)
+        self._accel = np.full(capacity, np.nan)
+        self._length = np.zeros(capacity)
+        self._n = 0
+
+    @classmethod
+    def from_time_steps(cls, data: List[TimeStep]) -> "TimeStepArray":
+        arr = cls(0)
+        for name in cls.FIELDS:
+            # None -> nan
+            setattr(
+                arr,
+                f"_{name}",
+                np.array([getattr(t, name) for t in data], dtype=np.float64),
+            )
+        arr._n = len(data)
+        return arr
+
+    @classmethod
+    def from_columns(cls, **columns: np.ndarray) -> "TimeStepArray":
+        """
+        Wrap existing column arrays (`FIELDS`), without copying those that
+        already are float64. Missing columns are filled like `push` does.
+        The arrays may be read-only views (e.g. of a polars frame), so the
+        result is not meant to be pushed to.
+        """
+        n = len(next(iter(columns.values())))
+        arr = cls(0)
+        for name in cls.FIELDS:
+            if name in columns:
+                col = np.asarray(columns[name], dtype=np.float64)
+            else:
+                col = np.full(n, 0.0 if name == "length" else np.nan)
+            setattr(arr, f"_{name}", col)
+        arr._n = n
+        return arr
+
+    def _grow(self) -> None:
+        capacity = max(2 * len(self._time), 16)
+        for name in self.FIELDS:
+            old = getattr(self, f"_{name}")
+            new = np.full(capacity, 0.0 if name == "length" else np.nan)
+            new[: self._n] = old[: self._n]
+            setattr(self, f"_{name}", new)
+
+    def push(
+        self,
+        time: float,
+        velocity: float,
+        s: float,
+        accel: float = np.nan,
+        length: float = 0.0,
+    ) -> None:
+        if self._n == len(self._time):
+            self._grow()
+        n = self._n
+        self._time[n] = time
+        self._velocity[n] = velocity
+        self._s[n] = s
+        self._accel[n] = accel
+        self._length[n] = length
+        self._n += 1
+
+    def append(self, t: TimeStep) -> None:
+        self.push(
+            t.time,
+            np.nan if t.velocity is None else t.velocity,
+            t.s,
+            np.nan if t.accel is None else t.accel,
+            t.length,
+        )
+
+    def last(self, name: str) -> float:
+        return getattr(self, f"_{name}")[self._n - 1]
+
+    def column(self, name: str) -> np.ndarray:
+        """A view of the filled part of a buffer"""
+        return getattr(self, f"_{name}")[: self._n]
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {name: self.column(name) for name in self.FIELDS}
+
+    def to_df(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns(), copy=False)
+
+    def to_pl(self) -> pl.DataFrame:
+        return pl.DataFrame(self.columns())
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __getitem__(self, i: int) -> TimeStep:
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("TimeStepArray index out of range")
+        velocity = self._velocity[i]
+        accel = self._accel[i]
+        return TimeStep(
+            time=float(self._time[i]),
+            velocity=None if np.isnan(velocity) else float(velocity),
+            s=float(self._s[i]),
+            length=float(self._length[i]),
+            accel=None if np.isnan(accel) else float(accel),
+        )
+
+    def __iter__(self) -> Iterator[TimeStep]:
+        return (self[i] for i in range(self._n))
+
+
+def _as_array(data: Union[List[TimeStep], TimeStepArray]) -> TimeStepArray:
+    return data if isinstance(data, TimeStepArray) else TimeStepArray.from_time_steps(data)
+
+
 @dataclass
 class VelocityData:
-    lead_data: List[TimeStep]
-    follow_data: List[TimeStep]
+    lead_data: Union[List[TimeStep], TimeStepArray]
+    follow_data: Union[List[TimeStep], TimeStepArray]
     real_world: bool = False
+    _reference: "ReferenceArrays" = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @classmethod
+    def preallocated(cls, max_time: float, step_length: float) -> "VelocityData":
+        """Empty simulated trajectories with room for `max_time / step_length` steps"""
+        capacity = int(max_time / step_length) + 2
+        return cls(TimeStepArray(capacity), TimeStepArray(capacity))
 
     # def an iterator that returns all the data in the VelocityData object
     def __iter__(self) -> Tuple[TimeStep, TimeStep]:
@@ -26,14 +163,27 @@ class VelocityData:
         return next(self.__iter__())
 
     def to_df(self) -> pd.DataFrame:
+        lead = _as_array(self.lead_data)
         lead_df = pd.DataFrame(
-            [(t.time, t.velocity, t.s, t.accel, t.length) for t in self.lead_data],
-            columns=["time", "velocity_lead", "s_lead", "accel_lead", "length_lead"],
+            {
+                "time": lead.column("time"),
+                "velocity_lead": lead.column("velocity"),
+                "s_lead": lead.column("s"),
+                "accel_lead": lead.column("accel"),
+                "length_lead": lead.column("length"),
+            },
+            copy=False,
         )
 
+        follow = _as_array(self.follow_data)
         follow_df = pd.DataFrame(
-            [(t.time, t.velocity, t.s, t.accel) for t in self.follow_data],
-            columns=["time", "velocity_follow", "s_follow", "accel_follow"],
+            {
+                "time": follow.column("time"),
+                "velocity_follow": follow.column("velocity"),
+                "s_follow": follow.column("s"),
+                "accel_follow": follow.column("accel"),
+            },
+            copy=False,
         )
 
         if self.real_world:
@@ -44,9 +194,106 @@ class VelocityData:
 
         return pd.merge(lead_df, follow_df, on="time", how="outer")
 
+    def reference(self) -> "ReferenceArrays":
+        """
+        `to_df` and the arrays the error code compares against, built on the
+        first call and reused after. Only for trajectories that don't change
+        anymore, i.e. the real-world ones.
+        """
+        if self._reference is None:
+            self._reference = ReferenceArrays.from_df(self.to_df())
+        return self._reference
+
     @property
     def max_time(self) -> float:
         return max(
             self.lead_data[-1].time,
             self.follow_data[-1].time,
         )
+
+    def leader_schedule(self, step_length: float) -> "LeaderSchedule":
+        lead = _as_array(self.lead_data)
+        return LeaderSchedule.from_columns(
+            lead.column("time"), lead.column("velocity"), lead.column("s"), step_length
+        )
+
+
+@dataclass
+class ReferenceArrays:
+    """
+    The reference trajectory as flat arrays. Row `i` is compared with the
+    `i`-th simulation step, like the index join in `_join_n_add_spacing`.
+    """
+
+    df: pd.DataFrame
+    time: np.ndarray
+    spacing: np.ndarray
+    velocity: np.ndarray
+    accel: np.ndarray
+    length_lead: np.ndarray
+    # rows with a gap, which the join with the simulation drops
+    valid: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> "ReferenceArrays":
+        return cls(
+            df=df,
+            time=df["time"].to_numpy(dtype=np.float64),
+            spacing=(df["s_lead"] - df["length_lead"] - df["s_follow"]).to_numpy(
+                dtype=np.float64
+            ),
+            velocity=df["velocity_follow"].to_numpy(dtype=np.float64),
+            accel=df["accel_follow"].to_numpy(dtype=np.float64),
+            length_lead=df["length_lead"].to_numpy(dtype=np.float64),
+            valid=df.notna().all(axis=1).to_numpy(),
+        )
+
+    def column(self, col: str) -> np.ndarray:
+        """`spacing`, `velocity` or `accel`"""
+        return getattr(self, col)
+
+
+@dataclass
+class LeaderSchedule:
+    """
+    The leader trajectory as flat arrays. `step` is the index of the
+    simulation step each sample is due at, `null` marks the gaps where the
+    leader is not observed.
+    """
+
+    step: np.ndarray
+    velocity: np.ndarray
+    s: np.ndarray
+    null: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.step)
+
+    @classmethod
+    def from_columns(
+        cls,
+        time: np.ndarray,
+        velocity: np.ndarray,
+        s: np.ndarray,
+        step_length: float,
+    ) -> "LeaderSchedule":
+        step_ms = int(step_length * 1000)
+        null = np.isnan(velocity)
+        return cls(
+            step=(time * 1000).astype(np.int64) // step_ms,
+            velocity=velocity,
+            s=np.where(null, np.nan, s),
+            null=null,
+        )
+
+    @classmethod
+    def from_time_steps(
+        cls, data: List[TimeStep], step_length: float
+    ) -> "LeaderSchedule":
+        arr = _as_array(data)
+        return cls.from_columns(
+            arr.column("time"), arr.column("velocity"), arr.column("s"), step_length
+        )
@@ -0,0 +1,193 @@
+"""
+Indexed copy of `processed_followers.parquet`.
+
+The rows are rewritten as one uncompressed Arrow IPC file, sorted on the pair
+key so that every leader-follower pair occupies one contiguous row range, plus
+a small key -> (offset, length, duration) index. A worker memory-maps the file
+once and slices the pair it needs instead of scanning and filtering the whole
+parquet.
+
+Build it once up front (otherwise the first loader does it):
+
+    python -m functions.trajectory_loaders.trajectory_store $DATA_PATH/processed_followers.parquet
+"""
+import argparse
+import contextlib
+import fcntl
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import polars as pl
+
+
+KEY_COLUMNS = ("vehicle_id", "lane", "lane_index", "vehicle_id_leader", "other_leader")
+SORT_COLUMNS = (*KEY_COLUMNS, "epoch_time", "front_s_smooth")
+# recorded seconds of a pair, what its evaluation cost scales with
+DURATION = (
+    (pl.col("epoch_time").max() - pl.col("epoch_time").min()).dt.total_milliseconds()
+    / 1000
+).alias("duration")
+
+# the stores opened in this process, by directory and source stamp
+_STORES: Dict[Tuple[Path, str], "TrajectoryStore"] = {}
+
+
+def default_store_dir(traj_file: Union[str, Path]) -> Path:
+    traj_file = Path(traj_file)
+    return traj_file.parent / f"{traj_file.name.split('.')[0]}_store"
+
+
+def pair_key(follower_id: List, leader_id: int) -> Tuple:
+    """The follower id list of the config, as a key of the index"""
+    return (follower_id[0], follower_id[1], follower_id[2], leader_id, follower_id[3])
+
+
+def source_stamp(traj_file: Union[str, Path]) -> str:
+    """The version of `traj_file` a store index is named after"""
+    stat = Path(traj_file).stat()
+    return f"{stat.st_size}_{stat.st_mtime_ns}"
+
+
+@contextlib.contextmanager
+def _locked(store_dir: Path):
+    # one builder per store, across the processes of a node
+    with open(store_dir / ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_store(
+    traj_file: Union[str, Path], store_dir: Union[str, Path] = None
+) -> Path:
+    """
+    Sort `traj_file` on the pair key and write the data file and its index to
+    `store_dir`. Nothing is done if the store is up to date with the source.
+    Concurrent callers wait for the one building it.
+    """
+    traj_file = Path(traj_file)
+    store_dir = Path(store_dir) if store_dir else default_store_dir(traj_file)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    stamp = source_stamp(traj_file)
+    data_file = store_dir / "data.arrow"
+    index_file = store_dir / f"index_{stamp}.parquet"
+    if data_file.exists() and index_file.exists():
+        return store_dir
+
+    with _locked(store_dir):
+        # built while this one waited
+        if not (data_file.exists() and index_file.exists()):
+            _build(traj_file, data_file, index_file)
+    return store_dir
+
+
+def _build(traj_file: Path, data_file: Path, index_file: Path) -> None:
+    store_dir = data_file.parent
+    df = (
+        pl.scan_parquet(traj_file)
+        # the equality filter of the full scan never matches a null key
+        .drop_nulls(list(KEY_COLUMNS))
+        .sort(*SORT_COLUMNS)
+        .collect()
+    )
+    index = (
+        df.select(*KEY_COLUMNS)
+        .with_row_index("offset")
+        .group_by(*KEY_COLUMNS, maintain_order=True)
+        .agg(pl.col("offset").first(), pl.len().alias("length"))
+        .join(
+            df.group_by(*KEY_COLUMNS).agg(DURATION),
+            on=list(KEY_COLUMNS),
+            how="left",
+        )
+    )
+
+    with tempfile.TemporaryDirectory(dir=store_dir) as tmp:
+        # uncompressed, so that it can be memory-mapped
+        df.write_ipc(Path(tmp) / data_file.name, compression="uncompressed")
+        index.write_parquet(Path(tmp) / index_file.name)
+        # readers that opened the old data keep their mapping of it. A stale
+        # index is dropped first, so no index ever points into new data
+        for stale in store_dir.glob("index_*.parquet"):
+            stale.unlink(missing_ok=True)
+        os.replace(Path(tmp) / data_file.name, data_file)
+        os.replace(Path(tmp) / index_file.name, index_file)
+
+
+def read_index(store_dir: Union[str, Path], stamp: str = None) -> pl.DataFrame:
+    """
+    The index of a store: the pair key, offset, length and duration. The one
+    built from the source version `stamp`, else the newest. Raises
+    FileNotFoundError if there is none
+    """
+    store_dir = Path(store_dir)
+    if stamp is not None:
+        return pl.read_parquet(store_dir / f"index_{stamp}.parquet")
+    index_files = sorted(
+        store_dir.glob("index_*.parquet"), key=lambda f: f.stat().st_mtime_ns
+    )
+    if not index_files:
+        raise FileNotFoundError(f"No trajectory store index in {store_dir}")
+    return pl.read_parquet(index_files[-1])
+
+
+class TrajectoryStore:
+    def __init__(self, store_dir: Union[str, Path], stamp: str = None) -> None:
+        self.store_dir = Path(store_dir)
+        self.stamp = stamp
+        # no rebuild swaps the files between reading the index and mapping
+        # the data
+        with _locked(self.store_dir):
+            index = read_index(self.store_dir, stamp)
+            self._df = pl.read_ipc(self.store_dir / "data.arrow", memory_map=True)
+        self._index = {
+            tuple(row[:-2]): (row[-2], row[-1])
+            for row in index.select(*KEY_COLUMNS, "offset", "length").iter_rows()
+        }
+
+    @classmethod
+    def open(
+        cls, traj_file: Union[str, Path], store_dir: Union[str, Path] = None
+    ) -> "TrajectoryStore":
+        """
+        The store of `traj_file`, built if needed and opened once per process
+        and version of `traj_file`
+        """
+        store_dir = build_store(traj_file, store_dir)
+        key = (store_dir, source_stamp(traj_file))
+        if key not in _STORES:
+            _STORES[key] = cls(*key)
+        return _STORES[key]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, follower_id: List, leader_id: int) -> pl.DataFrame:
+        """
+        The rows of one pair, sliced from the memory-mapped file. Raises
+        KeyError for a pair that is not in the store
+        """
+        key = pair_key(follower_id, leader_id)
+        if key not in self._index:
+            raise KeyError(f"Pair {key} is not in the store {self.store_dir}")
+        offset, length = self._index[key]
+        return self._df.slice(offset, length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("traj_file")
+    parser.add_argument("--store-dir", default=None)
+    args = parser.parse_args()
+
+    store = TrajectoryStore.open(args.traj_file, args.store_dir)
+    print(f"Indexed {len(store)} pairs in {store.store_dir}")
+
+
+if __name__ == "__main__":
+    main()
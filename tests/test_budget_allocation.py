@@ -0,0 +1,119 @@
+import math
+
+import pytest
+
+pytest.importorskip("nevergrad")
+pytest.importorskip("ray")
+pytest.importorskip("sumo_pipelines")
+
+from omegaconf import OmegaConf
+
+from functions.sumo_pipelines_adapter import budget_allocation
+from functions.sumo_pipelines_adapter.cf_config import CFModelParam, CFModelParameters
+from functions.sumo_pipelines_adapter.optimizer import optimize_single
+from functions.sumo_pipelines_adapter.warm_start import FEATURE_PREFIX
+
+
+class QuadraticRunner:
+    """Stands in for `BasicRunner`, counts the evaluations"""
+
+    def __init__(self):
+        self._best_loss = math.inf
+        self.trace = None
+        self.calls = 0
+
+    def __call__(self, **params):
+        self.calls += 1
+        return (params["tau"] - 1.2) ** 2
+
+
+def _opt_config(budget):
+    return OmegaConf.create(
+        {
+            "optimization_algo": "OnePlusOne",
+            "budget": budget,
+            "simulation_config": {},
+            "early_stopping": False,
+            "seed": 42,
+            "batch_size": 1,
+            "prescreen_budget": 0,
+            "parallel_runners": 1,
+            "checkpoint_interval": 5,
+        }
+    )
+
+
+def _cf_params():
+    return CFModelParameters(
+        model="IDM",
+        parameters={"tau": CFModelParam(val=1.0, search_space="uniform", args=[0.5, 2.0])},
+    )
+
+
+def test_promoted_pair_resumes_to_full_budget(tmp_path):
+    config = _opt_config(30)
+    runner = QuadraticRunner()
+
+    _, evaluations = optimize_single(
+        config, _cf_params(), runner, tmp_path, budget=10, final=False
+    )
+    assert evaluations == 10
+
+    # the final call of a promoted pair does not repeat the budget
+    _, evaluations = optimize_single(config, _cf_params(), runner, tmp_path)
+    assert evaluations == config.budget
+    assert runner.calls == config.budget
+
+
+def test_successive_halving_finalizes_promoted_pairs_at_full_budget(monkeypatch):
+    global_config = OmegaConf.create(
+        {
+            "Blocks": {
+                "CFOptimizeConfig": {
+                    "budget": 900,
+                    "checkpoint_interval": 50,
+                    "parallel_runners": 1,
+                },
+                "TrajectoryGenerator": {},
+                "BudgetAllocation": {"min_duration": 0.0},
+            }
+        }
+    )
+    overlays = [
+        OmegaConf.create({"Metadata": {"run_id": str(i), "cwd": f"/pairs/{i}"}})
+        for i in range(3)
+    ]
+
+    class History:
+        def __init__(self, cwd):
+            pass
+
+        def history(self):
+            # still improving at every rung
+            return [{"loss": 1000.0 - i} for i in range(400)]
+
+    def fake_run(batch, opt_conf, num_cpus, budget=None, final=True):
+        return [
+            {
+                "run_id": o.Metadata.run_id,
+                "loss": 2.0,
+                "evaluations": budget,
+                "converged": False,
+                "opt_time": 0.0,
+                f"{FEATURE_PREFIX}duration": 100.0,
+            }
+            for o in batch
+        ]
+
+    monkeypatch.setattr(budget_allocation, "pair_overlays", lambda *a: iter(overlays))
+    monkeypatch.setattr(budget_allocation, "write_base_config", lambda g: None)
+    monkeypatch.setattr(budget_allocation, "pair_config", lambda o: o)
+    monkeypatch.setattr(budget_allocation, "read_pair_summary", lambda cwd: None)
+    monkeypatch.setattr(budget_allocation, "Checkpoint", History)
+    monkeypatch.setattr(budget_allocation, "_run", fake_run)
+
+    results = {
+        r["run_id"]: r["evaluations"]
+        for r in budget_allocation.successive_halving(global_config)
+    }
+    assert results == {"0": 900, "1": 100, "2": 100}
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("nevergrad")
+pytest.importorskip("sumo_pipelines")
+pytest.importorskip("traci")
+if shutil.which("sumo") is None and "SUMO_HOME" not in os.environ:
+    pytest.skip("SUMO is not installed", allow_module_level=True)
+
+from benchmarks._common import PROJECT_ROOT, load_pair_config
+from functions.emulator_fidelity import THRESHOLDS, check, compare
+
+
+def _has_data(path):
+    # a clone without git-lfs only has the pointer files
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == b"PAR1"
+    except FileNotFoundError:
+        return False
+
+
+if not _has_data(PROJECT_ROOT / "data" / "processed_followers.parquet"):
+    pytest.skip("no trajectory data (git lfs pull)", allow_module_level=True)
+
+
+@pytest.mark.parametrize(
+    "model_file",
+    ["idm_calibration.yaml", "krauss_calibration.yaml", "w99_calibration.yaml"],
+)
+def test_emulator_tracks_sumo(model_file):
+    # the first pair of leaders.parquet
+    res = compare(load_pair_config(model_file, row=0), n=10)
+    assert res["model"] in THRESHOLDS
+    assert check(res) == []
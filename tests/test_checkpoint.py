@@ -0,0 +1,43 @@
+import pytest
+
+ng = pytest.importorskip("nevergrad")
+
+from functions.sumo_pipelines_adapter.checkpoint import Checkpoint
+
+
+def _loss(tau):
+    return (tau - 1.2) ** 2
+
+
+def _tell(optimizer, n):
+    for _ in range(n):
+        candidate = optimizer.ask()
+        optimizer.tell(candidate, _loss(**candidate.kwargs))
+
+
+def _optimizer():
+    parametrization = ng.p.Instrumentation(tau=ng.p.Scalar(lower=0.5, upper=2.0))
+    parametrization.random_state.seed(42)
+    return ng.optimizers.OnePlusOne(parametrization=parametrization, budget=100)
+
+
+def test_resumed_evaluations_reach_the_history(tmp_path):
+    checkpoint = Checkpoint(tmp_path, interval=5)
+    optimizer = _optimizer()
+    checkpoint.attach(optimizer)
+    _tell(optimizer, 10)
+    checkpoint.save(optimizer)
+
+    resumed = Checkpoint(tmp_path, interval=5)
+    optimizer = resumed.load()
+    assert optimizer.num_tell == 10
+    resumed.attach(optimizer)
+    _tell(optimizer, 7)
+    resumed.save(optimizer)
+
+    history = resumed.history()
+    assert len(history) == 17
+    assert resumed.best_loss() == min(r["loss"] for r in history)
+    assert [c for c in optimizer._callbacks["tell"] if isinstance(c, Checkpoint)] == [
+        resumed
+    ]
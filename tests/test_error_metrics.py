@@ -0,0 +1,103 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+
+from omegaconf import OmegaConf
+
+from functions.error_metrics import (
+    KERNELS,
+    ErrorKernel,
+    StreamingError,
+    error_metrics,
+    fast_error,
+)
+from functions.trajectory_loaders.trajectory import TimeStep, VelocityData
+
+STEP = 0.1
+N = 80
+
+
+def _reference():
+    lead, follow = [], []
+    for i in range(N):
+        t = i * STEP
+        lead.append(TimeStep(t, 10.0, 25.0 + 10.0 * t, length=5.0, accel=0.3))
+        follow.append(
+            TimeStep(
+                t,
+                10.0 + math.sin(t),
+                10.0 * t + 1.0 - math.cos(t),
+                # a gap, the join drops the row
+                accel=None if i == 30 else 0.5 + 0.2 * math.cos(t),
+            )
+        )
+    return VelocityData(lead, follow, real_world=True)
+
+
+def _simulated(reference):
+    rng = np.random.default_rng(7)
+    lead = [
+        TimeStep(t.time, t.velocity, t.s, length=t.length, accel=t.accel)
+        for t in reference.lead_data
+    ]
+    follow = [
+        TimeStep(
+            t.time,
+            t.velocity + rng.normal(0, 0.3),
+            t.s + rng.normal(0, 0.5),
+            accel=0.5 + rng.normal(0, 0.1),
+        )
+        for t in reference.follow_data
+    ]
+    return VelocityData(lead, follow)
+
+
+def _conf(error_func, method="spacing"):
+    return OmegaConf.create(
+        {"error_func": error_func, "method": method, "include_accel": True}
+    )
+
+
+@pytest.mark.parametrize("method", ["spacing", "velocity"])
+@pytest.mark.parametrize("error_func", sorted(KERNELS))
+def test_kernel_matches_pandas(error_func, method):
+    reference = _reference()
+    sim = _simulated(reference)
+    conf = _conf(error_func, method)
+
+    expected = fast_error(reference.to_df(), sim.to_df(), conf)
+    assert ErrorKernel(reference.reference(), conf)(sim) == pytest.approx(expected)
+
+
+def test_kernel_report_matches_error_metrics():
+    reference = _reference()
+    sim = _simulated(reference)
+    conf = _conf("nrmse_s_v")
+
+    expected = error_metrics(reference.to_df(), sim.to_df(), conf.copy())
+    report = ErrorKernel(reference.reference(), conf).report(sim)
+    for name, value in report.items():
+        assert value == pytest.approx(expected[name]), name
+
+
+@pytest.mark.parametrize("error_func", sorted(KERNELS))
+def test_streaming_bound_never_exceeds_the_error(error_func):
+    reference = _reference()
+    sim = _simulated(reference)
+    conf = _conf(error_func)
+    stream = StreamingError(reference.reference(), conf)
+
+    bounds = []
+    for lead, follow in sim:
+        stream.update(lead.s, follow.s, follow.velocity, follow.accel)
+        bounds.append(stream.lower_bound())
+
+    final = ErrorKernel(reference.reference(), conf)(sim)
+    assert stream.value == pytest.approx(final)
+    assert all(b <= final + 1e-9 for b in bounds)
+    if error_func != "mpe":
+        # it tightens to the error itself, mpe is never bounded
+        assert bounds[-1] == pytest.approx(final)
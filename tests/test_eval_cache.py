@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from functions.eval_cache import EvaluationCache, array_digest, cache_key, quantize
+
+
+def test_cache_key_is_stable():
+    params = {"tau": 1.2000000001, "accel": 2.5, "lcStrategic": 1}
+    key = cache_key(params=quantize(params), data="abc", sim={"step": 0.1})
+
+    # neither the order of the parameters nor float noise change it
+    reordered = {"lcStrategic": 1, "accel": 2.5, "tau": 1.2}
+    assert cache_key(sim={"step": 0.1}, data="abc", params=quantize(reordered)) == key
+    # anything else the loss depends on does
+    assert cache_key(params=quantize(params), data="abd", sim={"step": 0.1}) != key
+    moved = quantize({**params, "tau": 1.3})
+    assert cache_key(params=moved, data="abc", sim={"step": 0.1}) != key
+
+
+def test_array_digest_follows_the_content():
+    a = np.arange(10, dtype=np.float64)
+    assert array_digest(a, a * 2) == array_digest(a.copy(), a * 2)
+    assert array_digest(a) != array_digest(a.astype(np.float32))
+    assert array_digest(a) != array_digest(a[::-1])
+
+
+def test_disk_tier_is_shared_and_pruned(tmp_path):
+    cache = EvaluationCache(tmp_path, maxsize=2, max_disk_entries=3, prune_every=100)
+    for i in range(5):
+        cache.put(f"{i:064x}", {"loss": float(i)})
+        # distinct modification times, oldest first
+        path = cache._path(f"{i:064x}")
+        os.utime(path, (i, i))
+
+    # a second process only has the disk tier
+    other = EvaluationCache(tmp_path, max_disk_entries=3)
+    assert other.get(f"{4:064x}") == {"loss": 4.0}
+    assert other.get(f"{0:064x}") is None
+    assert len(list(tmp_path.glob("*/*.json"))) == 3
+    assert (other.hits, other.misses) == (1, 1)
@@ -0,0 +1,119 @@
+import pytest
+
+pl = pytest.importorskip("polars")
+pytest.importorskip("sumo_pipelines")
+
+from omegaconf import OmegaConf
+
+from functions.sumo_pipelines_adapter import loader_adapter
+from functions.sumo_pipelines_adapter.loader_adapter import (
+    STARTED_DIR,
+    _done_marker,
+    trajectory_pair_generator,
+)
+
+
+class Clock:
+    """Stands in for the `time` module, `sleep` runs the workers"""
+
+    def __init__(self, on_sleep=None):
+        self.now = 0.0
+        self.sleeps = 0
+        self.on_sleep = on_sleep
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps += 1
+        self.now += 60.0
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+
+def _generator(tmp_path, n_pairs=3, max_queue_size=1):
+    pair_file = tmp_path / "leaders.parquet"
+    pl.DataFrame(
+        {
+            "vehicle_id_leader": list(range(n_pairs)),
+            "vehicle_id": list(range(100, 100 + n_pairs)),
+            "lane": ["WBL1"] * n_pairs,
+            "lane_index": [0] * n_pairs,
+            "other_leader": [0] * n_pairs,
+        }
+    ).write_parquet(pair_file)
+    global_config = OmegaConf.create(
+        {
+            "Metadata": {"name": "test", "output": str(tmp_path / "sweep")},
+            "Blocks": {
+                "TrajectoryGenerator": {
+                    "pair_file": str(pair_file),
+                    "max_queue_size": max_queue_size,
+                    "pair_timeout": 1000.0,
+                    "start_timeout": 300.0,
+                    "schedule": "file",
+                    "leader_id": None,
+                    "follower_id": None,
+                },
+                "TrajectoryProcessing": {
+                    "kwargs": {"traj_file": "unused", "use_index": False}
+                },
+            },
+        }
+    )
+    return trajectory_pair_generator(
+        global_config.Blocks.TrajectoryGenerator,
+        global_config,
+        "Blocks.TrajectoryGenerator",
+    )
+
+
+def _finish(overlay):
+    marker = _done_marker(overlay)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
+def _start(overlay):
+    marker = _done_marker(overlay, STARTED_DIR)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
+def test_capped_pairs_wait_for_a_done_marker(tmp_path, monkeypatch):
+    handed_out = []
+    # a worker starts the pair in flight, and finishes it a minute later
+    clock = Clock(on_sleep=lambda: _finish(handed_out[-1]))
+    monkeypatch.setattr(loader_adapter, "time", clock)
+
+    for overlay in _generator(tmp_path, n_pairs=3, max_queue_size=1):
+        _start(overlay)
+        handed_out.append(overlay)
+
+    assert [o.Metadata.run_id for o in handed_out] == ["0", "1", "2"]
+    # one wait for each pair after the first
+    assert clock.sleeps == 2
+
+
+def test_lost_pair_no_longer_counts(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(loader_adapter, "time", clock)
+
+    handed_out = []
+    for overlay in _generator(tmp_path, n_pairs=2, max_queue_size=1):
+        # started and never finished, a killed worker
+        _start(overlay)
+        handed_out.append(overlay)
+
+    assert len(handed_out) == 2
+    assert clock.now > 1000.0
+
+
+def test_executor_taking_pairs_before_running_them_fails(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(loader_adapter, "time", clock)
+
+    with pytest.raises(RuntimeError, match="max_queue_size"):
+        # nothing ever starts
+        list(_generator(tmp_path, n_pairs=3, max_queue_size=1))
+    assert clock.now <= 400.0
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+pl = pytest.importorskip("polars")
+pytest.importorskip("pandas")
+pytest.importorskip("nevergrad")
+
+from omegaconf import OmegaConf
+
+from functions.sumo_pipelines_adapter.results import (
+    RECEIPT_ROWS,
+    RESULTS_FILE,
+    compact_results,
+    read_results,
+    result_schema,
+    sink_results,
+)
+from functions.sumo_pipelines_adapter.warm_start import warm_start_points
+
+
+def _global_config(tmp_path):
+    pair_file = tmp_path / "leaders.parquet"
+    pl.DataFrame(
+        {"vehicle_id_leader": [7], "vehicle_id": [12]},
+        schema={"vehicle_id_leader": pl.Int64, "vehicle_id": pl.Int64},
+    ).write_parquet(pair_file)
+    return OmegaConf.create(
+        {
+            "Metadata": {"output": str(tmp_path / "sweep")},
+            "Blocks": {
+                "TrajectoryGenerator": {"pair_file": str(pair_file)},
+                "CFModelParameters": {
+                    "model": "IDM",
+                    "parameters": {
+                        "tau": {"val": 1.0, "search_space": "uniform", "args": [0.5, 2.0]}
+                    },
+                },
+                "Error": {"method": "spacing", "error_func": "nrmse_s_v", "val": None},
+            },
+        }
+    )
+
+
+def _row(**overrides):
+    return {
+        "tau": 1.1,
+        "val": 0.3,
+        "leader_id": 7,
+        "follower_id": 12,
+        "cf_model": "IDM",
+        "run_id": "0",
+        "mode": "calibration",
+        "evaluations": 40,
+        "note": "kept in extra",
+        **overrides,
+    }
+
+
+@sink_results
+def consumer(config, global_config, *args, **kwargs):
+    return _row()
+
+
+def test_sink_results_round_trip_feeds_warm_start(tmp_path):
+    global_config = _global_config(tmp_path)
+
+    receipt = consumer(None, global_config)
+    assert receipt[RECEIPT_ROWS] == 1
+    assert receipt["run_id"] == "0"
+    assert receipt["evaluations"] == 40
+    assert "tau" not in receipt
+
+    results = read_results(global_config.Metadata.output)
+    assert results.height == 1
+    row = results.row(0, named=True)
+    assert row["tau"] == pytest.approx(1.1)
+    assert row["val"] == pytest.approx(0.3)
+    # the ids keep the dtype of the pair file
+    assert results.schema["leader_id"] == pl.Int64
+    assert row["leader_id"] == 7
+    assert json.loads(row["extra"]) == {"note": "kept in extra"}
+
+    # what benchmarks/warm_start.py does with the rows it reads back
+    points = warm_start_points(
+        global_config.Blocks.CFModelParameters, results, 7, 12, features={}
+    )
+    assert points == [{"tau": pytest.approx(1.1)}]
+
+
+def test_progress_is_not_sunk(tmp_path):
+    global_config = _global_config(tmp_path)
+    assert consumer(None, global_config, final=False) == _row()
+    assert read_results(global_config.Metadata.output).is_empty()
+
+
+def test_compact_results_merges_parts_and_rows(tmp_path):
+    global_config = _global_config(tmp_path)
+    consumer(None, global_config)
+    # a rerun of the pair replaces its row, an unsunk row is added
+    consumer(None, global_config)
+    rows = [_row(run_id="1", val=0.5, tau="1.4", evaluations=None)]
+
+    results = compact_results(global_config, rows)
+    output = tmp_path / "sweep"
+    assert list(output.glob("*.parquet")) == [output / RESULTS_FILE]
+    assert results.height == 2
+    assert dict(results.schema) == result_schema(global_config)
+    # conformed to the schema
+    row = results.filter(pl.col("run_id") == "1").row(0, named=True)
+    assert row["tau"] == pytest.approx(1.4)
+    assert row["evaluations"] is None
+    assert read_results(output).equals(results)
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pl = pytest.importorskip("polars")
+
+from functions.sumo_pipelines_adapter.scheduling import (
+    CostModel,
+    lpt_makespan,
+    pair_durations,
+    plan,
+)
+from functions.trajectory_loaders.trajectory_store import KEY_COLUMNS
+
+
+def _trajectories(tmp_path, seconds):
+    t0 = datetime(2023, 1, 1)
+    rows = [
+        {
+            "vehicle_id": 100 + i,
+            "lane": "WBL1",
+            "lane_index": 0,
+            "vehicle_id_leader": i,
+            "other_leader": 0,
+            "epoch_time": t0 + timedelta(seconds=s),
+            "front_s_smooth": float(s),
+        }
+        for i, duration in enumerate(seconds)
+        for s in range(duration + 1)
+    ]
+    path = tmp_path / "processed_followers.parquet"
+    pl.DataFrame(rows).write_parquet(path)
+    pairs = pl.DataFrame(rows).select(*KEY_COLUMNS).unique(maintain_order=True)
+    return path, pairs
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+def test_pair_durations(tmp_path, use_index):
+    traj_file, pairs = _trajectories(tmp_path, [5, 20, 10])
+    # in the order of the pair file, the store is only built with the index
+    durations = pair_durations(
+        pairs.reverse(), traj_file, tmp_path / "store", use_index=use_index
+    )
+    np.testing.assert_allclose(durations, [10.0, 20.0, 5.0])
+    assert (tmp_path / "store").exists() == use_index
+
+
+def test_plan_dispatches_longest_first():
+    schedule = plan(np.array([5.0, 20.0, 10.0, 20.0]), CostModel(), workers=2)
+    # the ties keep the file order
+    assert schedule["order"] == [1, 3, 2, 0]
+    assert schedule["predicted_makespan"] == 30.0
+    # longest first beats the file order
+    assert lpt_makespan([5.0, 20.0, 10.0, 20.0], 2) == 35.0
+
+
+def test_cost_model_fit_save_load(tmp_path):
+    model = CostModel.fit(np.array([10.0, 20.0, 40.0]), np.array([7.0, 12.0, 22.0]))
+    assert model.calibrated
+    assert model.slope == pytest.approx(0.5)
+    assert model.intercept == pytest.approx(2.0)
+
+    path = tmp_path / "cost_model.json"
+    model.save(path, "sweep")
+    assert CostModel.load(path, "sweep") == model
+    # an unknown sweep gets the uncalibrated model
+    assert CostModel.load(path, "other") == CostModel()
+    np.testing.assert_allclose(model(np.array([0.0, 100.0])), [2.0, 52.0])
@@ -0,0 +1,33 @@
+import pytest
+
+pl = pytest.importorskip("polars")
+
+from functions.sumo_pipelines_adapter.trace import OptimizationTrace, read_traces
+
+
+def _write_trace(cwd, model, n):
+    cwd.mkdir(parents=True)
+    trace = OptimizationTrace(cwd, flush_every=2, cf_model=model, run_id=cwd.name)
+    summary = {"loss": 0.5, "collision": False, "aborted": False}
+    for i in range(n):
+        trace.record({"tau": 1.0 + i}, summary, wall_time=0.1)
+    return trace
+
+
+def test_read_traces_of_a_multi_model_sweep(tmp_path):
+    _write_trace(tmp_path / "0" / "idm", "IDM", 3).close()
+    # still running, only its parts are on disk
+    _write_trace(tmp_path / "0" / "krauss", "Krauss", 4).flush()
+
+    traces = read_traces(tmp_path)
+    assert traces.height == 7
+    assert traces.group_by("cf_model").len().sort("cf_model").rows() == [
+        ("IDM", 3),
+        ("Krauss", 4),
+    ]
+    assert read_traces(tmp_path, lazy=True, model="IDM").collect().height == 3
+
+
+def test_read_traces_of_a_single_model_sweep(tmp_path):
+    _write_trace(tmp_path / "0", "IDM", 2).close()
+    assert read_traces(tmp_path)["cf_model"].to_list() == ["IDM", "IDM"]
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pl = pytest.importorskip("polars")
+
+from functions.trajectory_loaders.trajectory_store import TrajectoryStore, read_index
+
+
+def _write(path, seconds):
+    t0 = datetime(2023, 1, 1)
+    pl.DataFrame(
+        [
+            {
+                "vehicle_id": 100 + i,
+                "lane": "WBL1",
+                "lane_index": 0,
+                "vehicle_id_leader": i,
+                "other_leader": 0,
+                "epoch_time": t0 + timedelta(seconds=s),
+                "front_s_smooth": float(s),
+            }
+            for i, duration in enumerate(seconds)
+            for s in range(duration + 1)
+        ]
+    ).write_parquet(path)
+
+
+def test_get_slices_one_pair(tmp_path):
+    traj_file = tmp_path / "processed_followers.parquet"
+    _write(traj_file, [3, 5])
+    store = TrajectoryStore.open(traj_file, tmp_path / "store")
+
+    assert len(store) == 2
+    pair = store.get([101, "WBL1", 0, 0], 1)
+    assert pair.height == 6
+    assert pair["vehicle_id"].unique().to_list() == [101]
+
+    with pytest.raises(KeyError):
+        store.get([999, "WBL1", 0, 0], 1)
+
+
+def test_changed_source_opens_a_new_store(tmp_path):
+    traj_file = tmp_path / "processed_followers.parquet"
+    store_dir = tmp_path / "store"
+    _write(traj_file, [3, 5])
+    old = TrajectoryStore.open(traj_file, store_dir)
+    assert TrajectoryStore.open(traj_file, store_dir) is old
+
+    _write(traj_file, [3, 5, 8])
+    new = TrajectoryStore.open(traj_file, store_dir)
+    assert new is not old
+    assert len(new) == 3
+    assert new.get([102, "WBL1", 0, 0], 2).height == 9
+    # the stale index is gone
+    assert read_index(store_dir).height == 3
+    assert len(list(store_dir.glob("index_*.parquet"))) == 1